@@ -0,0 +1,89 @@
+"""Compare the sendfile and buffered data paths of send_file_data over loopback
+
+Usage: python bench/bench_sendfile.py [--size-mb N] [--repeat N] [--buffer-size N]
+"""
+import socket
+import threading
+import argparse
+import tempfile
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+import protocol_utils
+import tuning
+from protocol_utils import send_file_data
+
+def drain(sock: socket.socket):
+    """Read and discard everything sent to a socket until it is closed
+
+    Args:
+        sock (socket.socket): Socket to drain
+    """
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+        pass
+    sock.close()
+
+def run_once(path: str, size: int, use_sendfile: bool) -> tuple[float, float]:
+    """Send a file once over a fresh loopback connection
+
+    Args:
+        path (str): File to send
+        size (int): Size in bytes of the file
+        use_sendfile (bool): Whether to allow the sendfile path
+
+    Returns:
+        tuple[float, float]: Wall-clock seconds and CPU seconds spent by the sender
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+
+    reader = threading.Thread(target=drain, args=(receiver,))
+    reader.start()
+
+    with open(path, "rb") as f:
+        start_cpu = time.thread_time()
+        start = time.perf_counter()
+        send_file_data(sender, f, size, use_sendfile=use_sendfile)
+        elapsed = time.perf_counter() - start
+        cpu = time.thread_time() - start_cpu
+
+    sender.close()
+    reader.join()
+    return elapsed, cpu
+
+def main():
+    parser = argparse.ArgumentParser(description="sendfile vs buffered send benchmark")
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the test file in MiB")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per path, best is reported")
+    parser.add_argument("--buffer-size", type=int, default=None,
+                        help="Pin every chunk of the buffered path to this size instead of "
+                             "sizing them adaptively")
+    args = parser.parse_args()
+
+    if args.buffer_size is not None:
+        # The adaptive chunks grow from MIN_CHUNK to MAX_CHUNK, so all three are pinned
+        protocol_utils.DATA_BUFFER = tuning.MIN_CHUNK = tuning.MAX_CHUNK = args.buffer_size
+    size = args.size_mb * 1024 * 1024
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            tmp.write(chunk)
+        tmp.flush()
+
+        print(f"{'path':<10} {'MiB/s':>10} {'wall s':>8} {'cpu s':>8}")
+        for name, use_sendfile in (("sendfile", True), ("buffered", False)):
+            runs = [run_once(tmp.name, size, use_sendfile) for _ in range(args.repeat)]
+            elapsed, cpu = min(runs)
+            print(f"{name:<10} {args.size_mb / elapsed:>10.1f} {elapsed:>8.3f} {cpu:>8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Benchmark GET, PUT and LIST against a server on loopback
+
+Each scenario of the matrix (operation x file size x file count x concurrency x
+buffer size) gets a fresh server in a scratch directory, so its CPU time and peak
+RSS can be measured on their own. Results are written as JSON, and compared with a
+saved baseline if one is given.
+
+Data chunks normally adapt to the measured throughput, starting from DATA_BUFFER.
+Buffer sizes given with --buffer-sizes pin the chunk size of both ends instead, so
+a sweep measures each size on its own; without them scenarios run adaptively and
+are listed with the buffer size "auto".
+
+Usage: python bench/bench_transfers.py [--ops get,put,list] [--sizes 1K,1M,64M]
+           [--counts 1,16] [--concurrency 1,8] [--buffer-sizes 65536,262144]
+           [--output results.json] [--baseline baseline.json] [--tolerance 0.1]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import itertools
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "server")
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "client"))
+import protocol_utils
+import tuning
+from file_client import Client
+
+# Full listings requested per LIST scenario, whatever the file count
+LIST_OPS = 20
+# Seconds to wait for a freshly started server to accept connections
+SERVER_START_TIMEOUT = 10
+# Runs the server with its data chunk size pinned, as it has no option for it
+SERVER_BOOTSTRAP = """
+import sys
+sys.path.insert(0, {server_dir!r})
+import protocol_utils
+import tuning
+if {buffer_size!r} is not None:
+    protocol_utils.DATA_BUFFER = tuning.MIN_CHUNK = tuning.MAX_CHUNK = {buffer_size!r}
+import server
+sys.argv = ["server.py"] + {args!r}
+server.main()
+"""
+# Chunk sizing of this process's client, restored for scenarios that don't pin it
+ADAPTIVE_CHUNKS = (protocol_utils.DATA_BUFFER, tuning.MIN_CHUNK, tuning.MAX_CHUNK)
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 512, 1K, 64M or 4G
+
+    Args:
+        text (str): The size, optionally followed by a binary unit
+
+    Returns:
+        int: Size in bytes
+    """
+    text = text.strip().upper()
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+def parse_list(text: str, parse=int) -> list:
+    """Parse a comma separated option
+
+    Args:
+        text (str): The option's value
+        parse (_type_, optional): Converts each item. Defaults to int.
+
+    Returns:
+        list: The items
+    """
+    return [parse(item) for item in text.split(",") if item.strip()]
+
+def write_file(path: str, size: int):
+    """Create a file of incompressible data
+
+    Args:
+        path (str): File to create
+        size (int): Size in bytes
+    """
+    chunk = os.urandom(min(size, 1024 * 1024))
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            remaining -= f.write(chunk[:remaining])
+
+def free_port() -> int:
+    """Find a loopback port nothing is listening on
+
+    Returns:
+        int: The port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(root: str, buffer_size: int, server_args: list[str]) -> tuple[subprocess.Popen, int]:
+    """Start a server in a directory and wait until it accepts connections
+
+    Args:
+        root (str): Directory to serve
+        buffer_size (int): Chunk size to pin the server's data loops to, or None to
+            leave them adaptive
+        server_args (list[str]): Extra server command line options
+
+    Raises:
+        RuntimeError: Raised if the server doesn't come up
+
+    Returns:
+        tuple[subprocess.Popen, int]: The server process and its port
+    """
+    port = free_port()
+    code = SERVER_BOOTSTRAP.format(server_dir=os.path.abspath(SERVER_DIR), buffer_size=buffer_size,
+                                   args=[str(port)] + server_args)
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=root,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def peak_rss(pid: int) -> int:
+    """Get the peak RSS of a running process from /proc
+
+    Args:
+        pid (int): The process
+
+    Returns:
+        int | None: Peak RSS in KiB, or None if /proc doesn't give it
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def stop_server(process: subprocess.Popen) -> dict:
+    """Stop a server and collect its resource usage
+
+    Args:
+        process (subprocess.Popen): The server process
+
+    Returns:
+        dict: server_cpu seconds and server_peak_rss in KiB
+    """
+    # Read while the server is still running. ru_maxrss is only a fallback, as on
+    # Linux a child's includes the high-water mark of the bench process it forked from.
+    rss = peak_rss(process.pid)
+    process.terminate()
+    _, _, usage = os.wait4(process.pid, 0)
+    process.returncode = 0
+    return {"server_cpu": usage.ru_utime + usage.ru_stime,
+            "server_peak_rss": rss if rss is not None else usage.ru_maxrss}
+
+def percentile(values: list[float], q: float) -> float:
+    """Get a percentile by nearest rank
+
+    Args:
+        values (list[float]): Sorted values
+        q (float): Percentile between 0 and 1
+
+    Returns:
+        float: The value at that rank, or 0 if there are none
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+def pin_chunks(buffer_size: int = None):
+    """Pin the chunk size of this process's data loops, or make them adaptive again
+
+    Args:
+        buffer_size (int, optional): Size of every chunk, or None for the adaptive
+            sizing. Defaults to None.
+    """
+    if buffer_size is None:
+        protocol_utils.DATA_BUFFER, tuning.MIN_CHUNK, tuning.MAX_CHUNK = ADAPTIVE_CHUNKS
+    else:
+        protocol_utils.DATA_BUFFER = tuning.MIN_CHUNK = tuning.MAX_CHUNK = buffer_size
+
+def run_scenario(scenario: dict, server_args: list[str]) -> dict:
+    """Run one scenario against a fresh server
+
+    Args:
+        scenario (dict): op, size, count, concurrency and buffer_size, None for
+            adaptive chunks
+        server_args (list[str]): Extra server command line options
+
+    Returns:
+        dict: The scenario with its measurements added
+    """
+    op, size, count = scenario["op"], scenario["size"], scenario["count"]
+    pin_chunks(scenario["buffer_size"])
+
+    with tempfile.TemporaryDirectory() as server_root, tempfile.TemporaryDirectory() as client_root:
+        names = [f"bench-{i}.bin" for i in range(count)]
+        source = server_root if op != "put" else client_root
+        for name in names:
+            write_file(os.path.join(source, name), size)
+
+        process, port = start_server(server_root, scenario["buffer_size"], server_args)
+        previous_cwd = os.getcwd()
+        os.chdir(client_root)
+        try:
+            client = Client("127.0.0.1", port, max_connections=scenario["concurrency"], progress=None)
+
+            def run(name: str) -> tuple[float, bool]:
+                start = time.perf_counter()
+                try:
+                    if op == "get":
+                        done = client.get(name)
+                    elif op == "put":
+                        done = client.put(name)
+                    else:
+                        done = len(client.list()) >= count
+                except OSError:
+                    done = False
+                return time.perf_counter() - start, done
+
+            jobs = names if op != "list" else [None] * LIST_OPS
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start_cpu = time.process_time()
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=scenario["concurrency"]) as executor:
+                    results = list(executor.map(run, jobs))
+                elapsed = time.perf_counter() - start
+                client_cpu = time.process_time() - start_cpu
+            client.close()
+        finally:
+            os.chdir(previous_cwd)
+            usage = stop_server(process)
+
+    latencies = sorted(latency for latency, _ in results)
+    moved = size * count if op != "list" else 0
+    return dict(scenario, **usage, **{
+        "ops": len(jobs),
+        "failures": sum(not done for _, done in results),
+        "seconds": elapsed,
+        "ops_per_second": len(jobs) / elapsed,
+        "throughput": moved / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "client_cpu": client_cpu
+    })
+
+def scenario_key(result: dict) -> tuple:
+    """
+    Args:
+        result (dict): A scenario or its result
+
+    Returns:
+        tuple: The parameters identifying a scenario, to match it with the baseline
+    """
+    return result["op"], result["size"], result["count"], result["concurrency"], result["buffer_size"]
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Find scenarios that got slower than in the baseline
+
+    Args:
+        results (list[dict]): This run's results
+        baseline (list[dict]): Saved results to compare with
+        tolerance (float): Fraction by which a metric may worsen before it counts
+
+    Returns:
+        list[str]: Description of each regression
+    """
+    previous = {scenario_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(scenario_key(result))
+        if before is None:
+            continue
+        label = "{} size={} count={} concurrency={} buffer={}".format(
+            *scenario_key(result)[:4], result["buffer_size"] or "auto")
+        if result["ops_per_second"] < before["ops_per_second"] * (1 - tolerance):
+            regressions.append(f"{label}: {before['ops_per_second']:.1f} -> "
+                               f"{result['ops_per_second']:.1f} ops/s")
+        if result["p99"] > before["p99"] * (1 + tolerance):
+            regressions.append(f"{label}: p99 {before['p99'] * 1000:.2f} -> "
+                               f"{result['p99'] * 1000:.2f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of GET, PUT and LIST")
+    parser.add_argument("--ops", type=lambda text: parse_list(text, str), default=["get", "put", "list"],
+                        help="Operations to run, from get, put and list")
+    parser.add_argument("--sizes", type=lambda text: parse_list(text, parse_size),
+                        default=[1024, 1024 ** 2, 64 * 1024 ** 2], help="File sizes, e.g. 1K,1M,4G")
+    parser.add_argument("--counts", type=parse_list, default=[1, 16], help="Files per scenario")
+    parser.add_argument("--concurrency", type=parse_list, default=[1, 8],
+                        help="Operations in flight at once")
+    parser.add_argument("--buffer-sizes", type=parse_list, default=[None],
+                        help="Data chunk sizes to pin both ends to, instead of letting chunks "
+                             "adapt to the throughput")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario, best is reported")
+    parser.add_argument("--server-args", default="",
+                        help="Extra server options, e.g. \"--cache-size 0\"")
+    parser.add_argument("--output", help="File to write the results to as JSON")
+    parser.add_argument("--baseline", help="Results from an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Fraction ops/s or p99 latency may worsen by before it is a regression")
+    args = parser.parse_args()
+
+    scenarios = []
+    for op, size, count, concurrency, buffer_size in itertools.product(
+            args.ops, args.sizes, args.counts, args.concurrency, args.buffer_sizes):
+        if op == "list" and size != args.sizes[0]:
+            # Listings don't depend on file size
+            continue
+        scenarios.append({"op": op, "size": size, "count": count, "concurrency": concurrency,
+                          "buffer_size": buffer_size})
+
+    print(f"{'op':<5} {'size':>11} {'count':>5} {'conc':>4} {'buffer':>8} {'MiB/s':>9} {'ops/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'srv cpu':>8} {'srv MiB':>8} {'fail':>4}")
+    results = []
+    for scenario in scenarios:
+        runs = [run_scenario(scenario, args.server_args.split()) for _ in range(args.repeat)]
+        result = max(runs, key=lambda run: run["ops_per_second"])
+        results.append(result)
+        print(f"{result['op']:<5} {result['size']:>11} {result['count']:>5} "
+              f"{result['concurrency']:>4} {result['buffer_size'] or 'auto':>8} "
+              f"{result['throughput'] / 1024 ** 2:>9.1f} {result['ops_per_second']:>9.1f} "
+              f"{result['p50'] * 1000:>8.2f} {result['p99'] * 1000:>8.2f} {result['server_cpu']:>8.2f} "
+              f"{result['server_peak_rss'] / 1024:>8.1f} {result['failures']:>4}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
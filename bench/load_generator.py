@@ -0,0 +1,456 @@
+"""Simulate many concurrent clients against a running server
+
+Sessions connect, send a few requests drawn from a get/put/list mix, and close.
+They either run in a closed loop, each finished session replaced straight away, or
+arrive at a fixed average rate (open loop), which shows queueing once the server
+can't keep up. Errors, connect latency, request latency and goodput are recorded
+for every second of the run.
+
+Usage: python bench/load_generator.py HOST PORT [--sessions 1000] [--duration 30]
+           [--rate 200] [--mix get:70,put:20,list:10] [--sizes 4K:60,64K:30,1M:10]
+           [--requests 5] [--think-time 0.1] [--output load.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import contextlib
+from collections import Counter
+from typing import NamedTuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from protocol_utils import (REQ_TYPES, STATUS_CODES, LIST_PAGE_SIZE, DATA_BUFFER, async_send_message,
+                            async_get_response, async_send_file, async_allow, ServerBusyError)
+from bench_transfers import parse_size, percentile
+
+# Seconds sessions still running at the end of the run are given to finish
+FINISH_GRACE = 10
+# Part of the name of every file this run uploads, so runs repeated with the same seed
+# against one server don't collide with the files an earlier run left behind
+RUN_ID = os.urandom(3).hex()
+
+class Payload(NamedTuple):
+    """In-memory file contents, in the form async_send_file accepts"""
+    data: bytes
+    mtime_ns: int
+
+class LoadError(Exception):
+    """Raised when the server refuses a request or stops answering"""
+
+class LoadStats:
+    """Counters of a load run, overall and for each second of it"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.active = 0
+        self.connect_latencies = []
+        self.latencies = {req_type.value: [] for req_type in REQ_TYPES}
+        self.errors = Counter()
+        self.timeline = {}
+
+    def second(self) -> dict:
+        """
+        Returns:
+            dict: Counters of the current second of the run
+        """
+        second = int(time.monotonic() - self.start)
+        if second not in self.timeline:
+            self.timeline[second] = {"sessions": 0, "requests": 0, "errors": 0, "dropped": 0,
+                                     "bytes": 0, "active": 0, "connect": []}
+        bucket = self.timeline[second]
+        bucket["active"] = max(bucket["active"], self.active)
+        return bucket
+
+    def connected(self, latency: float):
+        """Record a session that connected
+
+        Args:
+            latency (float): Seconds the connection took
+        """
+        self.connect_latencies.append(latency)
+        bucket = self.second()
+        bucket["sessions"] += 1
+        bucket["connect"].append(latency)
+
+    def completed(self, op: str, latency: float, moved: int):
+        """Record a request that succeeded
+
+        Args:
+            op (str): Request type
+            latency (float): Seconds the request took
+            moved (int): Bytes of file data transferred
+        """
+        self.latencies[op].append(latency)
+        bucket = self.second()
+        bucket["requests"] += 1
+        bucket["bytes"] += moved
+
+    def failed(self, stage: str, error: Exception):
+        """Record an error, which ends its session
+
+        Args:
+            stage (str): "connect" or the request type that failed
+            error (Exception): The error
+        """
+        self.errors[f"{stage}: {type(error).__name__}"] += 1
+        self.second()["errors"] += 1
+
+    def dropped(self):
+        """Record an arrival turned away because the session limit was reached"""
+        self.errors["dropped: session limit reached"] += 1
+        self.second()["dropped"] += 1
+
+def parse_weights(text: str, parse=str) -> tuple[list, list[float]]:
+    """Parse a weighted choice such as get:70,put:20,list:10
+
+    Args:
+        text (str): Comma separated value:weight pairs, a missing weight counts as 1
+        parse (_type_, optional): Converts each value. Defaults to str.
+
+    Returns:
+        tuple[list, list[float]]: The values and their weights
+    """
+    values, weights = [], []
+    for item in text.split(","):
+        value, _, weight = item.partition(":")
+        values.append(parse(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+async def drain(sock: socket.socket, length: int) -> int:
+    """Receive and discard file data
+
+    Args:
+        sock (socket.socket): Non-blocking socket to receive from
+        length (int): Number of bytes to receive
+
+    Raises:
+        LoadError: Raised if the connection closes early
+
+    Returns:
+        int: Number of bytes received
+    """
+    loop = asyncio.get_running_loop()
+    view = memoryview(bytearray(min(DATA_BUFFER, max(length, 1))))
+    remaining = length
+    while remaining > 0:
+        received = await loop.sock_recv_into(sock, view[:remaining])
+        if not received:
+            raise LoadError("Connection closed during transfer")
+        remaining -= received
+    return length
+
+async def load_get(sock: socket.socket, size: int, rng: random.Random) -> int:
+    """Download one of the files created by prepare
+
+    Args:
+        sock (socket.socket): Connected non-blocking socket
+        size (int): File size drawn for the request
+        rng (random.Random): The session's random source
+
+    Returns:
+        int: Bytes of file data transferred
+    """
+    await async_send_message(sock, {"type": REQ_TYPES.GET.value, "filename": target_name(size),
+                                    "fast": True})
+    header = await async_get_response(sock)
+    if header.get("type") != REQ_TYPES.PUT.value:
+        raise LoadError(header.get("message") or "No response")
+    received = await drain(sock, header.get("content_length", 0))
+    await async_allow(sock, "File transfer complete")
+    return received
+
+async def load_put(sock: socket.socket, size: int, rng: random.Random) -> int:
+    """Upload a new file of the given size, named by the run and the session's random source
+
+    Args:
+        sock (socket.socket): Connected non-blocking socket
+        size (int): File size drawn for the request
+        rng (random.Random): The session's random source
+
+    Returns:
+        int: Bytes of file data transferred
+    """
+    name = f"load-{RUN_ID}-{rng.getrandbits(64):016x}"
+    if not await async_send_file(sock, name, True, cached=Payload(PAYLOADS[size], time.time_ns())):
+        raise LoadError("Upload failed")
+    return size
+
+async def load_list(sock: socket.socket, size: int, rng: random.Random) -> int:
+    """Fetch the first page of the listing
+
+    Args:
+        sock (socket.socket): Connected non-blocking socket
+        size (int): File size drawn for the request
+        rng (random.Random): The session's random source
+
+    Returns:
+        int: Bytes of file data transferred
+    """
+    await async_send_message(sock, {"type": REQ_TYPES.LIST.value, "limit": LIST_PAGE_SIZE})
+    response = await async_get_response(sock)
+    if response.get("status_code") != STATUS_CODES.ALLOW.value:
+        raise LoadError(response.get("message") or "No response")
+    return 0
+
+# Coroutine making each type of request in the mix
+REQUESTS = {REQ_TYPES.GET.value: load_get, REQ_TYPES.PUT.value: load_put,
+            REQ_TYPES.LIST.value: load_list}
+# Contents uploaded for each file size, shared by every session
+PAYLOADS = {}
+
+def target_name(size: int) -> str:
+    """
+    Args:
+        size (int): Size in bytes
+
+    Returns:
+        str: Name of the file of that size created for downloads
+    """
+    return f"load-target-{size}"
+
+async def connect(host: str, port: int, timeout: float) -> socket.socket:
+    """Open a non-blocking connection
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        timeout (float): Seconds to wait for the connection
+
+    Returns:
+        socket.socket: The connected socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (host, port)), timeout)
+    except BaseException:
+        sock.close()
+        raise
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+async def prepare(host: str, port: int, sizes: list[int], timeout: float):
+    """Upload the files downloads are served from, unless the server already has them
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        sizes (list[int]): Size in bytes of each file
+        timeout (float): Seconds to wait for each upload
+    """
+    for size in sizes:
+        PAYLOADS[size] = os.urandom(size)
+        sock = await connect(host, port, timeout)
+        with sock:
+            # Rejected if it already exists, which is just as good
+            await asyncio.wait_for(async_send_file(sock, target_name(size), False,
+                                                   cached=Payload(PAYLOADS[size], time.time_ns())),
+                                   timeout)
+
+async def run_session(args: argparse.Namespace, stats: LoadStats, rng: random.Random):
+    """Connect, send a few requests and disconnect, recording how it went
+
+    Args:
+        args (argparse.Namespace): Parsed command line options
+        stats (LoadStats): Where to record the session
+        rng (random.Random): Source of the request mix and file sizes
+    """
+    stats.active += 1
+    try:
+        start = time.monotonic()
+        try:
+            sock = await connect(args.host, args.port, args.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            stats.failed("connect", e)
+            return
+        stats.connected(time.monotonic() - start)
+
+        with sock:
+            for _ in range(args.requests):
+                op = rng.choices(*args.mix)[0]
+                size = rng.choices(*args.sizes)[0]
+                start = time.monotonic()
+                try:
+                    moved = await asyncio.wait_for(REQUESTS[op](sock, size, rng), args.timeout)
+                except (OSError, asyncio.TimeoutError, LoadError, ServerBusyError) as e:
+                    # The connection's state is unknown, or the server turned it away,
+                    # so the session ends here
+                    stats.failed(op, e)
+                    return
+                stats.completed(op, time.monotonic() - start, moved)
+                if args.think_time:
+                    await asyncio.sleep(rng.expovariate(1 / args.think_time))
+    finally:
+        stats.active -= 1
+
+async def generate_load(args: argparse.Namespace, stats: LoadStats):
+    """Start sessions until the run's duration is up
+
+    Args:
+        args (argparse.Namespace): Parsed command line options
+        stats (LoadStats): Where to record the sessions
+    """
+    rng = random.Random(args.seed)
+    deadline = stats.start + args.duration
+    tasks = set()
+
+    def start_session():
+        task = asyncio.create_task(run_session(args, stats, random.Random(rng.getrandbits(64))))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    if args.rate:
+        # Open loop: arrivals don't wait for earlier sessions to finish
+        while time.monotonic() < deadline:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            if len(tasks) >= args.sessions:
+                stats.dropped()
+            else:
+                start_session()
+    else:
+        # Closed loop: each session is replaced as soon as it ends
+        async def worker():
+            while time.monotonic() < deadline:
+                await start_session()
+        await asyncio.gather(*(worker() for _ in range(args.sessions)))
+
+    if tasks:
+        await asyncio.wait(tasks, timeout=FINISH_GRACE)
+
+async def report(stats: LoadStats, interval: float, out):
+    """Print the counters of the last few seconds every interval, until cancelled
+
+    Args:
+        stats (LoadStats): The run's counters
+        interval (float): Seconds between lines
+        out (_type_): Stream to print to
+    """
+    print(f"{'time':>5} {'active':>7} {'conn/s':>7} {'req/s':>8} {'err/s':>6} {'drop/s':>6} "
+          f"{'MiB/s':>8} {'conn p99 ms':>11}", file=out)
+    reported = 0
+    while True:
+        await asyncio.sleep(interval)
+        now = int(time.monotonic() - stats.start)
+        buckets = [stats.timeline.get(second) for second in range(reported, now)]
+        buckets = [bucket for bucket in buckets if bucket]
+        span = max(now - reported, 1)
+        reported = now
+        connect = sorted(latency for bucket in buckets for latency in bucket["connect"])
+        print(f"{now:>5} {stats.active:>7} {sum(b['sessions'] for b in buckets) / span:>7.1f} "
+              f"{sum(b['requests'] for b in buckets) / span:>8.1f} "
+              f"{sum(b['errors'] for b in buckets) / span:>6.1f} "
+              f"{sum(b['dropped'] for b in buckets) / span:>6.1f} "
+              f"{sum(b['bytes'] for b in buckets) / span / 1024 ** 2:>8.2f} "
+              f"{percentile(connect, 0.99) * 1000:>11.2f}", file=out)
+
+def summarize(stats: LoadStats, elapsed: float) -> dict:
+    """
+    Args:
+        stats (LoadStats): The run's counters
+        elapsed (float): Seconds the run took
+
+    Returns:
+        dict: Totals, goodput, connect and request latency percentiles, and errors
+    """
+    connect = sorted(stats.connect_latencies)
+    moved = sum(bucket["bytes"] for bucket in stats.timeline.values())
+    return {
+        "seconds": elapsed,
+        "sessions": len(connect),
+        "requests": sum(len(latencies) for latencies in stats.latencies.values()),
+        "goodput": moved / elapsed,
+        "connect": {"p50": percentile(connect, 0.5), "p99": percentile(connect, 0.99),
+                    "max": connect[-1] if connect else 0.0},
+        "latency": {op: {"count": len(latencies), "p50": percentile(sorted(latencies), 0.5),
+                         "p99": percentile(sorted(latencies), 0.99)}
+                    for op, latencies in stats.latencies.items() if latencies},
+        "errors": dict(stats.errors)
+    }
+
+async def run(args: argparse.Namespace, out) -> dict:
+    """Prepare the server, run the load and summarize it
+
+    Args:
+        args (argparse.Namespace): Parsed command line options
+        out (_type_): Stream to print progress to
+
+    Returns:
+        dict: The configuration, summary and per-second timeline of the run
+    """
+    await prepare(args.host, args.port, sorted(set(args.sizes[0])), args.timeout)
+
+    stats = LoadStats()
+    reporter = asyncio.create_task(report(stats, args.interval, out))
+    await generate_load(args, stats)
+    elapsed = time.monotonic() - stats.start
+    reporter.cancel()
+
+    timeline = [dict(bucket, second=second, connect_p99=percentile(sorted(bucket.pop("connect")), 0.99))
+                for second, bucket in sorted(stats.timeline.items())]
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    config["run_id"] = RUN_ID
+    return {"config": config, "summary": summarize(stats, elapsed), "timeline": timeline}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the SimPY File server")
+    parser.add_argument("host", help="Server address")
+    parser.add_argument("port", type=int, help="Server port")
+    parser.add_argument("--sessions", type=int, default=1000,
+                        help="Sessions open at once in a closed loop, or at most with --rate")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="New sessions per second on average, 0 for a closed loop")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to keep starting sessions")
+    parser.add_argument("--requests", type=int, default=5, help="Requests per session")
+    parser.add_argument("--think-time", type=float, default=0,
+                        help="Mean seconds a session waits between requests")
+    parser.add_argument("--mix", type=parse_weights, default="get:70,put:20,list:10",
+                        help="Weighted request types")
+    parser.add_argument("--sizes", type=lambda text: parse_weights(text, parse_size),
+                        default="4K:60,64K:30,1M:10", help="Weighted file sizes for get and put")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="Seconds to wait for a connection or a request")
+    parser.add_argument("--interval", type=float, default=1, help="Seconds between progress lines")
+    parser.add_argument("--seed", type=int, help="Seed for a repeatable run")
+    parser.add_argument("--output", help="File to write the summary and timeline to as JSON")
+    args = parser.parse_args()
+
+    unknown = set(args.mix[0]) - set(REQUESTS)
+    if unknown:
+        parser.error(f"Unknown request types {', '.join(unknown)}")
+
+    # Every session needs a descriptor, allow as many as the hard limit does
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.sessions > hard - 64:
+        print(f"Warning: only {hard} file descriptors are available for {args.sessions} sessions")
+
+    out = sys.stdout
+    # The protocol helpers report every transfer, which would drown the progress lines
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run(args, out))
+
+    summary = results["summary"]
+    print(f"{summary['sessions']} sessions, {summary['requests']} requests "
+          f"in {summary['seconds']:.1f}s, goodput {summary['goodput'] / 1024 ** 2:.2f} MiB/s")
+    print(f"connect p50 {summary['connect']['p50'] * 1000:.2f} ms, "
+          f"p99 {summary['connect']['p99'] * 1000:.2f} ms, "
+          f"max {summary['connect']['max'] * 1000:.2f} ms")
+    for op, latency in summary["latency"].items():
+        print(f"{op:<5} {latency['count']:>8} requests, p50 {latency['p50'] * 1000:.2f} ms, "
+              f"p99 {latency['p99'] * 1000:.2f} ms")
+    for error, count in sorted(summary["errors"].items()):
+        print(f"error {count:>6} {error}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,85 @@
-import socket
-import sys
-from protocol_utils import send_file, request_file, REQ_TYPES, get_listing
+import argparse
+import json
+import time
+import os
+from protocol_utils import REQ_TYPES, ServerBusyError
+from compression import CODECS
+from sync import SYNC_PARALLEL
+from file_client import Client
 
-cli_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def main():
+    parser = argparse.ArgumentParser(description="SimPY File client")
+    parser.add_argument("host", help="Server address")
+    parser.add_argument("port", type=int, help="Server port")
+    parser.add_argument("type", choices=[req_type.value for req_type in REQ_TYPES], help="Request type")
+    # Any number of files may be given, they are all transferred over one session
+    parser.add_argument("filenames", nargs="*", help="Files to transfer")
+    parser.add_argument("--handshake", action="store_true",
+                        help="Use the multi-step handshake instead of the fast path")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue interrupted transfers instead of starting over")
+    parser.add_argument("--streams", type=int, default=1,
+                        help="Download large files as this many byte ranges over parallel connections")
+    parser.add_argument("--archive", action="store_true",
+                        help="Download the files, directories or glob patterns given as one archive")
+    parser.add_argument("--delta", action="store_true",
+                        help="Replace the server's copy of a file by sending only what changed")
+    parser.add_argument("--update", action="store_true",
+                        help="Only download files whose local copy differs, compared by size and mtime")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Like --update, but compare by SHA-256 digest instead of mtime. "
+                             "Also applies to sync")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Skip sending files whose content the server already holds")
+    parser.add_argument("--compress", choices=[codec.value for codec in CODECS],
+                        help="Compress transfers with this codec when the data compresses well")
+    parser.add_argument("--parallel", type=int, default=SYNC_PARALLEL,
+                        help="Most transfers sync runs at once")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what sync would transfer")
+    parser.add_argument("--long", action="store_true", help="List sizes and modification times")
+    parser.add_argument("--sort", choices=["name", "size", "mtime"], default="name",
+                        help="Order of the listing")
+    parser.add_argument("--reverse", action="store_true", help="List in descending order")
+    parser.add_argument("--timeout", type=float,
+                        help="Seconds each operation may wait for the server, by default as long "
+                             "as it takes")
+    args = parser.parse_args()
 
-HOST,PORT,REQ_TYPE = sys.argv[1:4]
-FILENAME = ""
+    fast = not args.handshake
+    try:
+        with Client(args.host, args.port, compression=args.compress,
+                    operation_timeout=args.timeout) as client:
+            if args.type == REQ_TYPES.PUT.value:
+                for filename in args.filenames:
+                    client.put(filename, fast, args.resume, args.dedup, args.delta)
 
-if len(sys.argv) == 5:
-    FILENAME = sys.argv[4]
-    
-print(FILENAME)
+            elif args.type == REQ_TYPES.GET.value and args.archive:
+                client.get_archive(args.filenames)
 
-cli_sock.connect((HOST, int(PORT)))
-print(f"Connected to {HOST}:{PORT}")
+            elif args.type == REQ_TYPES.GET.value:
+                for filename in args.filenames:
+                    client.get(filename, fast, args.resume, args.update, args.checksum, args.streams)
 
-if REQ_TYPE == REQ_TYPES.PUT.value:
-    send_file(cli_sock, FILENAME)
+            elif args.type == REQ_TYPES.SYNC.value:
+                # A filename given with sync is the local directory to sync, by default the current one
+                if args.filenames:
+                    os.chdir(args.filenames[0])
+                client.sync(args.parallel, args.checksum, args.dry_run)
 
-elif REQ_TYPE == REQ_TYPES.GET.value:
-    request_file(cli_sock, FILENAME)
+            elif args.type == REQ_TYPES.LIST.value:
+                # A filename given with list is used as a prefix to filter by
+                prefix = args.filenames[0] if args.filenames else ""
+                for file in client.iter_list(prefix, args.sort, args.reverse, args.long):
+                    if args.long:
+                        modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(file["mtime"]))
+                        print(f"{file['size']:>12} {modified} {file['name']}")
+                    else:
+                        print(file)
 
-elif REQ_TYPE == REQ_TYPES.LIST.value:
-    files = get_listing(cli_sock)
-    for file in files:
-        print(file)
\ No newline at end of file
+            elif args.type == REQ_TYPES.STATS.value:
+                print(json.dumps(client.stats(), indent=2))
+    except ServerBusyError as e:
+        print(f"{e}, try again later")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import zlib
+import math
+import struct
+import hashlib
+from typing import Iterator
+
+# Blocks are kept between these sizes, and made larger still if a file would have
+# more than MAX_SIGNATURES of them, so the signature list fits in one message
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_SIGNATURES = 250000
+# Amount of the new file read at a time while looking for matching blocks
+DELTA_READ = 4 * 1024 * 1024
+# Literal data is sent once this much has built up, even before the next match
+MAX_LITERAL = 1024 * 1024
+
+# A delta is sent as DATA frames, each holding one instruction: copy a run of blocks
+# from the server's current copy, or insert literal data. An empty frame ends it.
+DELTA_COPY = b"C"
+DELTA_LITERAL = b"L"
+COPY_RUN = struct.Struct("!QI")
+
+# The weak checksum is Adler-32, which zlib computes quickly from scratch and which
+# can be rolled on a byte at a time with this modulus
+ADLER_MOD = 65521
+
+def choose_block_size(file_size: int) -> int:
+    """Pick the block size for a file's signatures
+
+    Roughly the square root of the file size, which balances the size of the
+    signature list against how much is resent around each change.
+
+    Args:
+        file_size (int): Size in bytes of the server's copy
+
+    Returns:
+        int: Block size in bytes, a power of two
+    """
+    block_size = 1 << round(math.log2(max(math.isqrt(file_size), 1)))
+    block_size = max(MIN_BLOCK_SIZE, min(block_size, MAX_BLOCK_SIZE))
+    while -(-file_size // block_size) > MAX_SIGNATURES:
+        block_size *= 2
+    return block_size
+
+def weak_checksum(block: bytes) -> tuple[int, int]:
+    """Compute the rolling checksum of a block from scratch
+
+    Args:
+        block (bytes): Data in the window
+
+    Returns:
+        tuple[int, int]: The two 16-bit halves of the checksum
+    """
+    checksum = zlib.adler32(block)
+    return checksum & 0xFFFF, checksum >> 16
+
+def strong_checksum(block: bytes) -> str:
+    """Compute the checksum that confirms a weak checksum match
+
+    Args:
+        block (bytes): Data in the block
+
+    Returns:
+        str: Hex digest
+    """
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def file_signatures(filename: str, block_size: int) -> list[list]:
+    """Compute the signature of every block of a file
+
+    Args:
+        filename (str): Name of the file
+        block_size (int): Size in bytes of each block, the last one may be shorter
+
+    Returns:
+        list[list]: Weak checksum and strong checksum of each block, in order
+    """
+    signatures = []
+    with open(filename, "rb") as f:
+        while block := f.read(block_size):
+            a, b = weak_checksum(block)
+            signatures.append([b << 16 | a, strong_checksum(block)])
+    return signatures
+
+def generate_delta(f, block_size: int, signatures: list[list], base_size: int) -> Iterator[tuple]:
+    """Compare a file against the signatures of another version of it
+
+    Blocks are looked up at every byte offset with a rolling checksum, so matches are
+    found even after data has been inserted or removed.
+
+    Args:
+        f (_type_): New version of the file, opened in binary mode
+        block_size (int): Block size the signatures were computed with
+        signatures (list[list]): Signatures of the other version
+        base_size (int): Size in bytes of the other version
+
+    Yields:
+        tuple: ("copy", block index) or ("literal", data), in file order
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    # Only the other version's last block can be shorter, and only at the end of the file
+    tail_size = base_size % block_size
+
+    buffer = b""
+    eof = False
+    pos = literal_start = 0
+    a = b = None
+    while True:
+        available = len(buffer) - pos
+        if available <= block_size and not eof:
+            # Rolling on needs a byte past the window, read more of the file
+            if pos > literal_start:
+                yield "literal", buffer[literal_start:pos]
+            chunk = f.read(max(DELTA_READ, block_size))
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = literal_start = 0
+            continue
+
+        if available < block_size:
+            break
+
+        if a is None:
+            a, b = weak_checksum(buffer[pos:pos + block_size])
+        matches = table.get(b << 16 | a)
+        if matches:
+            index = matches.get(strong_checksum(buffer[pos:pos + block_size]))
+            if index is not None:
+                if pos > literal_start:
+                    yield "literal", buffer[literal_start:pos]
+                yield "copy", index
+                pos += block_size
+                literal_start = pos
+                a = b = None
+                continue
+
+        if available == block_size:
+            # The window has reached the end of the file
+            break
+
+        # Roll the window on by one byte
+        old, new = buffer[pos], buffer[pos + block_size]
+        a = (a - old + new) % ADLER_MOD
+        b = (b - block_size * old + a - 1) % ADLER_MOD
+        pos += 1
+
+        if pos - literal_start >= MAX_LITERAL:
+            yield "literal", buffer[literal_start:pos]
+            literal_start = pos
+
+    tail_start = len(buffer) - tail_size
+    if tail_size and tail_start >= pos:
+        a, b = weak_checksum(buffer[tail_start:])
+        index = table.get(b << 16 | a, {}).get(strong_checksum(buffer[tail_start:]))
+        if index is not None:
+            if tail_start > literal_start:
+                yield "literal", buffer[literal_start:tail_start]
+            yield "copy", index
+            literal_start = len(buffer)
+
+    if len(buffer) > literal_start:
+        yield "literal", buffer[literal_start:]
+
+def copy_range(src_fd: int, dst_fd: int, src_offset: int, dst_offset: int, length: int):
+    """Copy a byte range between two files, inside the kernel where possible
+
+    Args:
+        src_fd (int): File descriptor to copy from
+        dst_fd (int): File descriptor to copy to
+        src_offset (int): Position to read from
+        dst_offset (int): Position to write to
+        length (int): Number of bytes to copy
+    """
+    while length > 0:
+        if hasattr(os, "copy_file_range"):
+            copied = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+        else:
+            copied = os.pwrite(dst_fd, os.pread(src_fd, min(length, MAX_LITERAL), src_offset), dst_offset)
+        if not copied:
+            raise IOError("Source file ended early")
+        src_offset += copied
+        dst_offset += copied
+        length -= copied
@@ -0,0 +1,456 @@
+import time
+import random
+import socket
+import select
+import asyncio
+import functools
+import threading
+from itertools import islice
+from contextlib import contextmanager
+from typing import Iterator, AsyncIterator
+from protocol_utils import (LIST_PAGE_SIZE, request_file, send_file, send_delta, get_listing,
+                            get_remote_file_size, get_remote_file_info, request_archive,
+                            get_conditions, get_stats, set_mtime, resumable_size, STATUS_CODES,
+                            ServerBusyError)
+from multistream import download_parallel, MIN_STREAM_SIZE
+from sync import sync_directory, SYNC_PARALLEL
+from progress_report import progress_bar
+from tuning import tune_socket
+
+# Most connections a client keeps open to its server at once
+POOL_SIZE = 8
+# Seconds to wait for a connection, from the pool or the server
+CONNECT_TIMEOUT = 10
+# Seconds each socket operation on a connection may wait for the server, None to wait
+# as long as it takes. The server can legitimately stay quiet for a long time, e.g.
+# while it hashes or builds delta signatures of a large file before replying.
+OPERATION_TIMEOUT = None
+# Pooled connections unused for this long are closed rather than reused, as the
+# server will be about to close them itself
+POOL_IDLE_TIMEOUT = 30
+# Times an operation the server turns away as busy is tried again
+BUSY_RETRIES = 3
+# Most seconds to wait before trying again, however long the server asks for
+MAX_RETRY_AFTER = 30
+
+class ConnectionPool:
+    """Thread-safe pool of reusable connections to one server"""
+
+    def __init__(self, host: str, port: int, max_connections: int = POOL_SIZE,
+                 timeout: float = CONNECT_TIMEOUT, idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 operation_timeout: float = OPERATION_TIMEOUT):
+        """
+        Args:
+            host (str): Server address
+            port (int): Server port
+            max_connections (int, optional): Most connections open at once. Defaults to POOL_SIZE.
+            timeout (float, optional): Seconds to wait for a connection, from the pool
+                or the server. Defaults to CONNECT_TIMEOUT.
+            idle_timeout (float, optional): Seconds an unused connection is kept for.
+                Defaults to POOL_IDLE_TIMEOUT.
+            operation_timeout (float, optional): Seconds each operation on a connection
+                may wait, None for no limit. Defaults to OPERATION_TIMEOUT.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.operation_timeout = operation_timeout
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def acquire(self) -> socket.socket:
+        """Take a connection from the pool, opening a new one if none are free
+
+        Raises:
+            TimeoutError: Raised if every connection stays in use for the whole timeout
+            OSError: Raised if a new connection can't be opened
+
+        Returns:
+            socket.socket: Connection for the caller's exclusive use until released
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No connection to {self.host}:{self.port} became free")
+
+        try:
+            with self.lock:
+                while self.idle:
+                    sock, released_at = self.idle.pop()
+                    if time.monotonic() - released_at < self.idle_timeout and is_reusable(sock):
+                        return sock
+                    sock.close()
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.settimeout(self.operation_timeout)
+            tune_socket(sock)
+            return sock
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, sock: socket.socket):
+        """Return a connection to the pool, or close it if it can't be used again
+
+        Args:
+            sock (socket.socket): Connection from acquire
+        """
+        with self.lock:
+            if not self.closed and is_reusable(sock):
+                self.idle.append((sock, time.monotonic()))
+            else:
+                sock.close()
+        self.slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[socket.socket]:
+        """Borrow a connection for the duration of a with block
+
+        Yields:
+            socket.socket: The connection
+        """
+        sock = self.acquire()
+        try:
+            yield sock
+        except BaseException:
+            # Failed part way through an exchange, so its state is unknown
+            sock.close()
+            raise
+        finally:
+            self.release(sock)
+
+    def close(self):
+        """Close every idle connection, and connections in use as they are released"""
+        with self.lock:
+            self.closed = True
+            for sock, _ in self.idle:
+                sock.close()
+            self.idle.clear()
+
+def is_reusable(sock: socket.socket) -> bool:
+    """Check that a connection is still open and has nothing unread waiting on it
+
+    Args:
+        sock (socket.socket): Connection to check
+
+    Returns:
+        bool: Whether the next request can be sent over it
+    """
+    if sock.fileno() == -1:
+        return False
+    # Anything readable between requests is either EOF or a stray reply
+    readable, _, _ = select.select([sock], [], [], 0)
+    return not readable
+
+def retry_when_busy(operation):
+    """Make a Client operation try again when the server turns it away as busy
+
+    Each wait is what the server asked for, doubled after every try and spread out a
+    little, so clients turned away together don't all come back at once.
+
+    Args:
+        operation (_type_): Client method to wrap
+
+    Returns:
+        _type_: The wrapped method, which raises ServerBusyError once the client's
+            busy_retries are used up
+    """
+    @functools.wraps(operation)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return operation(self, *args, **kwargs)
+            except ServerBusyError as e:
+                if attempt >= self.busy_retries:
+                    raise
+                delay = min(MAX_RETRY_AFTER, e.retry_after * 2 ** attempt * random.uniform(1, 1.5))
+                print(f"{e}, trying again in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+    return wrapper
+
+class Client:
+    """Client for a SimPY File server, reusing pooled connections between operations
+
+    Safe to use from many threads at once, each operation borrows its own connection.
+    """
+
+    def __init__(self, host: str, port: int, max_connections: int = POOL_SIZE,
+                 timeout: float = CONNECT_TIMEOUT, compression: str = None, progress=progress_bar,
+                 busy_retries: int = BUSY_RETRIES, operation_timeout: float = OPERATION_TIMEOUT):
+        """
+        Args:
+            host (str): Server address
+            port (int): Server port
+            max_connections (int, optional): Most connections open at once. Defaults to POOL_SIZE.
+            timeout (float, optional): Seconds to wait for a connection, from the pool
+                or the server. Defaults to CONNECT_TIMEOUT.
+            compression (str, optional): Codec transfers may be compressed with, if the
+                data is worth it. Defaults to None.
+            progress (Callable, optional): Called with a label and a byte count at the start
+                of each download, giving a context manager that yields a thread-safe
+                callback to report bytes with. None reports nothing. Defaults to progress_bar.
+            busy_retries (int, optional): Times to try an operation again when the server
+                is too busy to take it. Defaults to BUSY_RETRIES.
+            operation_timeout (float, optional): Seconds each operation on a connection
+                may wait for the server, None for no limit. Defaults to OPERATION_TIMEOUT.
+        """
+        self.host = host
+        self.port = port
+        self.compression = compression
+        self.progress = progress
+        self.busy_retries = busy_retries
+        self.pool = ConnectionPool(host, port, max_connections, timeout,
+                                   operation_timeout=operation_timeout)
+
+    @retry_when_busy
+    def get(self, filename: str, fast=True, resume=False, update=False, checksum=False,
+            streams: int = 1) -> bool:
+        """Download a file into the current directory
+
+        Args:
+            filename (str): Name of the file
+            fast (bool, optional): Skip the multi-step handshake. Defaults to True.
+            resume (bool, optional): Continue from the end of a partial local copy. Defaults to False.
+            update (bool, optional): Skip the download if the local copy has the same size
+                and modification time. Defaults to False.
+            checksum (bool, optional): Skip the download if the local copy has the same
+                digest. Defaults to False.
+            streams (int, optional): Download large files over this many parallel
+                connections, files too small to split use one. Defaults to 1.
+
+        Returns:
+            bool: Whether the local file now matches the server's copy
+        """
+        with self.pool.connection() as sock:
+            # A partial local copy is continued from where it ends
+            offset = resumable_size(filename) if resume else 0
+            conditions = None
+            if (update or checksum) and not offset:
+                conditions = get_conditions(filename, checksum)
+
+            # Parallel ranges start from scratch, so a partial copy is continued over one connection
+            if streams > 1 and not offset:
+                info = get_remote_file_info(sock, filename, conditions)
+                if info.get("status_code") == STATUS_CODES.NOT_MODIFIED.value:
+                    print(f"{filename} is up to date")
+                    set_mtime(filename, info.get("mtime_ns"))
+                    return True
+                file_size = info.get("file_size", -1)
+                if file_size < 0:
+                    return False
+                if file_size >= 2 * MIN_STREAM_SIZE:
+                    return download_parallel(self.host, self.port, filename, file_size, streams,
+                                             self.progress, info.get("mtime_ns"))
+                # Too small to split, so it comes over this connection like any other, without
+                # the conditions the server has already checked
+                conditions = None
+
+            return request_file(sock, filename, fast, offset, compression=self.compression,
+                                conditions=conditions, progress=self.progress)
+
+    @retry_when_busy
+    def put(self, filename: str, fast=True, resume=False, dedup=False, delta=False) -> bool:
+        """Upload a file from the current directory
+
+        Args:
+            filename (str): Name of the file
+            fast (bool, optional): Skip the multi-step handshake. Defaults to True.
+            resume (bool, optional): Continue an interrupted upload. Defaults to False.
+            dedup (bool, optional): Send nothing if the server already holds the content.
+                Defaults to False.
+            delta (bool, optional): Replace the server's copy, sending only what changed.
+                Defaults to False.
+
+        Returns:
+            bool: Whether the server accepted the whole file
+        """
+        with self.pool.connection() as sock:
+            if delta:
+                return send_delta(sock, filename)
+            return send_file(sock, filename, fast, resume, self.compression, dedup)
+
+    @retry_when_busy
+    def get_archive(self, names: list[str]) -> int:
+        """Download files, directories or glob patterns as one archive
+
+        Args:
+            names (list[str]): Names to download
+
+        Returns:
+            int: Number of files received
+        """
+        with self.pool.connection() as sock:
+            return request_archive(sock, names)
+
+    @retry_when_busy
+    def size(self, filename: str) -> int:
+        """Get the size of a file on the server
+
+        Args:
+            filename (str): Name of the file
+
+        Returns:
+            int: Size in bytes, or -1 if the file can't be downloaded
+        """
+        with self.pool.connection() as sock:
+            return get_remote_file_size(sock, filename)
+
+    @retry_when_busy
+    def list(self, prefix="", sort="name", reverse=False, detail=False, digests=False) -> list:
+        """Get the whole listing of the server's files
+
+        Args:
+            prefix (str, optional): Only list names starting with this. Defaults to "".
+            sort (str, optional): Sort by "name", "size" or "mtime". Defaults to "name".
+            reverse (bool, optional): Sort in descending order. Defaults to False.
+            detail (bool, optional): Give dicts with name, size and mtime. Defaults to False.
+            digests (bool, optional): Include SHA-256 digests in the details. Defaults to False.
+
+        Returns:
+            list: Filenames, or dicts if detail is set
+        """
+        return list(self.iter_list(prefix, sort, reverse, detail, digests))
+
+    def iter_list(self, prefix="", sort="name", reverse=False, detail=False,
+                  digests=False) -> Iterator:
+        """Stream the listing of the server's files, a page at a time
+
+        The connection is held until the iterator is exhausted or closed.
+
+        Args:
+            prefix (str, optional): Only list names starting with this. Defaults to "".
+            sort (str, optional): Sort by "name", "size" or "mtime". Defaults to "name".
+            reverse (bool, optional): Sort in descending order. Defaults to False.
+            detail (bool, optional): Give dicts with name, size and mtime. Defaults to False.
+            digests (bool, optional): Include SHA-256 digests in the details. Defaults to False.
+
+        Raises:
+            ServerBusyError: Raised if the server is too busy to take the request, as
+                the listing is not tried again once it has started
+
+        Yields:
+            str | dict: Filenames, or dicts if detail is set
+        """
+        with self.pool.connection() as sock:
+            yield from get_listing(sock, prefix, sort, reverse, detail, digests)
+
+    @retry_when_busy
+    def sync(self, parallel: int = SYNC_PARALLEL, checksum=False, dry_run=False) -> bool:
+        """Sync the current directory with the server's files in both directions
+
+        Args:
+            parallel (int, optional): Most transfers to run at once. Defaults to SYNC_PARALLEL.
+            checksum (bool, optional): Compare every file by digest. Defaults to False.
+            dry_run (bool, optional): Only print the plan. Defaults to False.
+
+        Returns:
+            bool: Whether every transfer succeeded
+        """
+        with self.pool.connection() as sock:
+            return sync_directory(self.host, self.port, sock, parallel, checksum, dry_run,
+                                  self.compression, self.progress)
+
+    @retry_when_busy
+    def stats(self) -> dict:
+        """Get the server's transfer metrics
+
+        Returns:
+            dict: Counters and latency histograms of each kind of request. Empty if the
+                request failed.
+        """
+        with self.pool.connection() as sock:
+            return get_stats(sock)
+
+    def close(self):
+        """Close the client's connections"""
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AsyncClient:
+    """asyncio interface to a Client
+
+    Each operation runs in a worker thread over the shared connection pool, so many
+    can be in flight from one event loop without blocking it.
+    """
+
+    def __init__(self, host: str, port: int, max_connections: int = POOL_SIZE,
+                 timeout: float = CONNECT_TIMEOUT, compression: str = None, progress=None,
+                 busy_retries: int = BUSY_RETRIES, operation_timeout: float = OPERATION_TIMEOUT):
+        """
+        Args:
+            host (str): Server address
+            port (int): Server port
+            max_connections (int, optional): Most connections open at once. Defaults to POOL_SIZE.
+            timeout (float, optional): Seconds to wait for a connection, from the pool
+                or the server. Defaults to CONNECT_TIMEOUT.
+            compression (str, optional): Codec transfers may be compressed with, if the
+                data is worth it. Defaults to None.
+            progress (Callable, optional): Progress reporting for downloads, as for Client.
+                Off by default, as concurrent operations would share the terminal.
+                Defaults to None.
+            busy_retries (int, optional): Times to try an operation again when the server
+                is too busy to take it. Defaults to BUSY_RETRIES.
+            operation_timeout (float, optional): Seconds each operation on a connection
+                may wait for the server, None for no limit. Defaults to OPERATION_TIMEOUT.
+        """
+        self.client = Client(host, port, max_connections, timeout, compression, progress,
+                             busy_retries, operation_timeout)
+
+    async def get(self, filename: str, **options) -> bool:
+        """Download a file, see Client.get"""
+        return await asyncio.to_thread(self.client.get, filename, **options)
+
+    async def put(self, filename: str, **options) -> bool:
+        """Upload a file, see Client.put"""
+        return await asyncio.to_thread(self.client.put, filename, **options)
+
+    async def get_archive(self, names: list[str]) -> int:
+        """Download files as one archive, see Client.get_archive"""
+        return await asyncio.to_thread(self.client.get_archive, names)
+
+    async def size(self, filename: str) -> int:
+        """Get the size of a file, see Client.size"""
+        return await asyncio.to_thread(self.client.size, filename)
+
+    async def list(self, **options) -> list:
+        """Get the whole listing, see Client.list"""
+        return await asyncio.to_thread(self.client.list, **options)
+
+    async def iter_list(self, **options) -> AsyncIterator:
+        """Stream the listing, see Client.iter_list
+
+        Yields:
+            str | dict: Filenames, or dicts if detail is set
+        """
+        entries = self.client.iter_list(**options)
+        try:
+            while batch := await asyncio.to_thread(lambda: list(islice(entries, LIST_PAGE_SIZE))):
+                for entry in batch:
+                    yield entry
+        finally:
+            await asyncio.to_thread(entries.close)
+
+    async def sync(self, **options) -> bool:
+        """Sync the current directory, see Client.sync"""
+        return await asyncio.to_thread(self.client.sync, **options)
+
+    async def stats(self) -> dict:
+        """Get the server's transfer metrics, see Client.stats"""
+        return await asyncio.to_thread(self.client.stats)
+
+    async def close(self):
+        """Close the client's connections"""
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
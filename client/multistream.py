@@ -0,0 +1,123 @@
+import socket
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import os
+from protocol_utils import (REQ_TYPES, PARTIAL_SUFFIX, send_message, get_response, allow, preallocate,
+                            receive_file_data, set_mtime)
+from progress_report import progress_bar
+from tuning import tune_socket
+
+# Ranges smaller than this aren't worth their own connection
+MIN_STREAM_SIZE = 8 * 1024 * 1024
+# Attempts made for each range before the download is given up on
+RANGE_ATTEMPTS = 3
+
+def download_parallel(host: str, port: int, filename: str, file_size: int, streams: int,
+                      progress=progress_bar, mtime_ns: int = None) -> bool:
+    """Download a file as several byte ranges over concurrent connections
+
+    The file is received into "<filename>.part", preallocated to its full size, with
+    each connection writing its range straight to the right offset, and only replaces
+    the local file once every range is there. Its size says nothing about which
+    ranges arrived, so it is never resumed from. A range whose connection fails is
+    retried from the last byte that arrived.
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        filename (str): Name of the file to download
+        file_size (int): Size in bytes of the remote file
+        streams (int): Maximum number of concurrent connections
+        progress (Callable, optional): Called with a label and the file size, giving a
+            context manager that yields the callback to report bytes with, which must be
+            safe to call from several threads. None reports nothing. Defaults to progress_bar.
+        mtime_ns (int, optional): Modification time of the server's copy, given to the
+            downloaded file. Defaults to None.
+
+    Returns:
+        bool: Whether every range was downloaded
+    """
+    if not file_size:
+        # Nothing to split into ranges
+        open(filename, "wb").close()
+        set_mtime(filename, mtime_ns)
+        print("File transfer complete")
+        return True
+
+    streams = max(1, min(streams, file_size // MIN_STREAM_SIZE))
+    range_size = -(-file_size // streams)
+    ranges = [(offset, min(range_size, file_size - offset))
+              for offset in range(0, file_size, range_size)]
+
+    partial = filename + PARTIAL_SUFFIX
+    with open(partial, "w+b") as f:
+        preallocate(f, file_size)
+
+    print(f"Downloading {filename} over {len(ranges)} streams")
+
+    with progress("Downloading", file_size) if progress else nullcontext() as report:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            results = list(executor.map(
+                lambda byte_range: download_range(host, port, filename, *byte_range, report, partial),
+                ranges))
+
+    if all(results):
+        os.replace(partial, filename)
+        set_mtime(filename, mtime_ns)
+        print("File transfer complete")
+        return True
+    os.remove(partial)
+    print("Error: some ranges could not be downloaded")
+    return False
+
+def download_range(host: str, port: int, filename: str, offset: int, length: int, progress=None,
+                   destination: str = None) -> bool:
+    """Download one byte range of a file into the same range of the local file
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        filename (str): Name of the remote file
+        offset (int): First byte of the range
+        length (int): Number of bytes in the range
+        progress (_type_, optional): Called with the number of bytes in each chunk. Defaults to None.
+        destination (str, optional): Local file to write the range into, which must
+            already exist. Defaults to filename.
+
+    Returns:
+        bool: Whether the whole range was downloaded
+    """
+    destination = destination or filename
+    received = 0
+
+    def count(chunk):
+        nonlocal received
+        received += chunk
+        if progress is not None:
+            progress(chunk)
+
+    for attempt in range(RANGE_ATTEMPTS):
+        try:
+            with socket.create_connection((host, port)) as sock, open(destination, "r+b") as f:
+                tune_socket(sock)
+                send_message(sock, {
+                    "type": REQ_TYPES.GET.value,
+                    "filename": filename,
+                    "fast": True,
+                    "offset": offset + received,
+                    "length": length - received
+                })
+
+                message = get_response(sock)
+                if message.get("type") != REQ_TYPES.PUT.value:
+                    print(f"Server error: {message.get('message')}")
+                    return False
+
+                receive_file_data(sock, f, message.get("content_length", 0), count,
+                                  offset=offset + received)
+                allow(sock, "File transfer complete")
+                return True
+        except OSError as e:
+            print(f"Range at {offset} interrupted after {received} bytes: {e}")
+
+    return False
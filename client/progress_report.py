@@ -0,0 +1,75 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# Least seconds between progress updates, so the data loop isn't held up redrawing
+PROGRESS_INTERVAL = 0.1
+
+class ThrottledProgress:
+    """Progress callback that passes byte counts on in batches
+
+    Counts are added up and handed to the wrapped callback once PROGRESS_INTERVAL has
+    passed since the last update, or once enough bytes have built up, so the cost of
+    reporting doesn't grow with the number of chunks. Safe to call from many threads.
+    """
+
+    def __init__(self, callback: Callable[[int], None], interval: float = PROGRESS_INTERVAL,
+                 min_bytes: int = None):
+        """
+        Args:
+            callback (Callable[[int], None]): Called with the number of bytes since its
+                last call
+            interval (float, optional): Least seconds between calls. Defaults to PROGRESS_INTERVAL.
+            min_bytes (int, optional): Bytes that trigger a call even before the interval
+                has passed, or None to only go by time. Defaults to None.
+        """
+        self.callback = callback
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.pending = 0
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self, received: int):
+        """Count some bytes, passing the total on if an update is due
+
+        Args:
+            received (int): Number of bytes in the chunk
+        """
+        with self.lock:
+            self.pending += received
+            now = time.monotonic()
+            if (now - self.last_update < self.interval
+                    and (self.min_bytes is None or self.pending < self.min_bytes)):
+                return
+            pending, self.pending = self.pending, 0
+            self.last_update = now
+            self.callback(pending)
+
+    def flush(self):
+        """Pass on any bytes counted since the last update"""
+        with self.lock:
+            if self.pending:
+                pending, self.pending = self.pending, 0
+                self.callback(pending)
+
+@contextmanager
+def progress_bar(label: str, total: int) -> Iterator[ThrottledProgress]:
+    """Show a progress bar on the terminal for the duration of a with block
+
+    Args:
+        label (str): Text shown before the bar
+        total (int): Number of bytes expected
+
+    Yields:
+        ThrottledProgress: Callback to report bytes with
+    """
+    # Imported here so the server and scripting users never load it
+    from progress.bar import ChargingBar
+
+    with ChargingBar(label, max=max(total, 1)) as bar:
+        progress = ThrottledProgress(bar.next)
+        yield progress
+        progress.flush()
+        bar.finish()
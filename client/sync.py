@@ -0,0 +1,161 @@
+import os
+import queue
+import socket
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from protocol_utils import (PARTIAL_SUFFIX, request_sync_plan, request_file, send_file, send_delta,
+                            set_mtime)
+from progress_report import progress_bar
+from tuning import tune_socket
+
+# Number of transfers run at once by default, each over its own connection
+SYNC_PARALLEL = 4
+
+def sync_directory(host: str, port: int, sock: socket.socket, parallel: int = SYNC_PARALLEL,
+                   checksum=False, dry_run=False, compression=None, progress=progress_bar) -> bool:
+    """Bring the current directory and the server's files in line in both directions
+
+    Files missing on one side are copied to it, and files on both sides that differ
+    are replaced by the more recently modified copy. Nothing is deleted.
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        sock (socket.socket): Connection to ask the server for the plan over
+        parallel (int, optional): Most transfers to run at once. Defaults to SYNC_PARALLEL.
+        checksum (bool, optional): Send every file's digest, so files are compared by
+            content even when their size and modification time match. Defaults to False.
+        dry_run (bool, optional): Only print the plan. Defaults to False.
+        compression (str, optional): Codec transfers may be compressed with. Defaults to None.
+        progress (Callable, optional): Progress reporting for downloads, as for
+            request_file. Only used when transfers run one at a time. Defaults to progress_bar.
+
+    Returns:
+        bool: Whether every transfer succeeded
+    """
+    manifest = build_manifest(checksum)
+    print(f"Comparing {len(manifest)} local files with the server")
+    plan = request_sync_plan(sock, manifest)
+    if not plan:
+        return False
+
+    if plan.get("check"):
+        # Same size but different mtime, only the content can tell
+        check = set(plan["check"])
+        checked = [dict(file, digest=file_digest(file["name"]))
+                   for file in manifest if file["name"] in check]
+        recheck = request_sync_plan(sock, checked, partial=True)
+        if not recheck:
+            return False
+        for key in ("get", "put", "replace"):
+            plan[key] += recheck.get(key, [])
+        plan["same"].update(recheck.get("same", {}))
+
+    transfers = ([("get", name) for name in plan.get("get", [])]
+                 + [("put", name) for name in plan.get("put", [])]
+                 + [("replace", name) for name in plan.get("replace", [])])
+
+    print(f"{len(plan['same'])} files up to date, {len(transfers)} to transfer")
+    for action, name in transfers:
+        print(f"  {action:<8} {name}")
+    if dry_run:
+        return True
+
+    # Matching copies are given the server's mtime, so they compare cheaply next time
+    for name, mtime_ns in plan["same"].items():
+        set_mtime(name, mtime_ns)
+
+    failed = run_transfers(host, port, transfers, parallel, compression, progress)
+    if failed:
+        print(f"Sync incomplete, {failed} transfers failed")
+        return False
+    print("Sync complete")
+    return True
+
+def build_manifest(checksum=False) -> list[dict]:
+    """Describe the files in the current directory
+
+    Args:
+        checksum (bool, optional): Include each file's SHA-256 digest. Defaults to False.
+
+    Returns:
+        list[dict]: name, size and mtime_ns of each file, and digest if asked for
+    """
+    manifest = []
+    with os.scandir(".") as scan:
+        for entry in scan:
+            if entry.name.endswith(PARTIAL_SUFFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            file = {"name": entry.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            if checksum:
+                file["digest"] = file_digest(entry.name)
+            manifest.append(file)
+    return manifest
+
+def file_digest(filename: str) -> str:
+    """Get the SHA-256 digest of a local file
+
+    Args:
+        filename (str): Name of the file
+
+    Returns:
+        str: Hex digest
+    """
+    with open(filename, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def run_transfers(host: str, port: int, transfers: list[tuple], parallel: int, compression=None,
+                  progress=progress_bar) -> int:
+    """Run transfers concurrently, each worker reusing one connection for many of them
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        transfers (list[tuple]): ("get" | "put" | "replace", filename) pairs
+        parallel (int): Most transfers to run at once
+        compression (str, optional): Codec transfers may be compressed with. Defaults to None.
+        progress (Callable, optional): Progress reporting for downloads, as for
+            request_file. Defaults to progress_bar.
+
+    Returns:
+        int: Number of transfers that failed
+    """
+    pending = queue.Queue()
+    for transfer in transfers:
+        pending.put(transfer)
+
+    workers = max(1, min(parallel, len(transfers)))
+    if workers > 1:
+        # Bars drawn by concurrent transfers would overwrite each other
+        progress = None
+
+    def worker() -> int:
+        failed = 0
+        sock = None
+        while True:
+            try:
+                action, name = pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if sock is None or sock.fileno() == -1:
+                    sock = socket.create_connection((host, port))
+                    tune_socket(sock)
+                if action == "get":
+                    done = request_file(sock, name, compression=compression, progress=progress)
+                elif action == "put":
+                    done = send_file(sock, name, compression=compression, keep_mtime=True)
+                else:
+                    done = send_delta(sock, name, keep_mtime=True)
+            except OSError as e:
+                print(f"Error transferring {name}: {e}")
+                done = False
+            failed += not done
+        if sock is not None:
+            sock.close()
+        return failed
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker) for _ in range(workers)]
+        return sum(future.result() for future in futures)
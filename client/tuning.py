@@ -0,0 +1,89 @@
+import time
+import socket
+
+# Buffered data loops (receiving, compressing, and sending without sendfile) size
+# each chunk to take about CHUNK_TIME at the throughput measured so far, between
+# these limits. Slow connections keep small buffers, fast ones move fewer, larger
+# chunks, and memory per connection follows what the link can actually carry.
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+CHUNK_TIME = 0.005
+# Weight given to the latest chunk's throughput in the running average
+RATE_SMOOTHING = 0.25
+
+class ChunkSizer:
+    """Chunk size for one transfer, adjusted from its measured throughput"""
+
+    def __init__(self, content_length: int, initial: int):
+        """
+        Args:
+            content_length (int): Number of bytes the transfer moves
+            initial (int): Chunk size to start with, before anything is measured
+        """
+        self.limit = max(1, min(MAX_CHUNK, content_length))
+        self.size = max(1, min(initial, self.limit))
+        self.rate = None
+        self.last = time.monotonic()
+        self.buffer = None
+
+    def update(self, moved: int):
+        """Measure a chunk that has just been moved and resize the next one to match
+
+        The size changes by at most a factor of two each time, so one stall or
+        burst doesn't swing it from one limit to the other.
+
+        Args:
+            moved (int): Number of bytes in the chunk
+        """
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        if elapsed <= 0 or not moved:
+            return
+        rate = moved / elapsed
+        self.rate = rate if self.rate is None else self.rate + (rate - self.rate) * RATE_SMOOTHING
+
+        target = max(MIN_CHUNK, 1 << int(self.rate * CHUNK_TIME).bit_length())
+        target = max(self.size // 2, min(target, self.size * 2))
+        self.size = max(1, min(target, self.limit))
+
+    def view(self) -> memoryview:
+        """Get a buffer of the current chunk size
+
+        Returns:
+            memoryview: The buffer, only reallocated when the chunk size has grown past it
+        """
+        if self.buffer is None or len(self.buffer) < self.size:
+            self.buffer = memoryview(bytearray(self.size))
+        return self.buffer[:self.size]
+
+def tune_socket(sock: socket.socket, buffer_size: int = None):
+    """Set the options every data connection uses
+
+    TCP_NODELAY sends small control messages straight away rather than holding them
+    for the peer's delayed ACK. Kernel buffer sizes are only set if asked for, as on
+    Linux that turns off autotuning, which already grows them to the link's
+    bandwidth-delay product.
+
+    Args:
+        sock (socket.socket): A connected TCP socket
+        buffer_size (int, optional): SO_SNDBUF and SO_RCVBUF to set, for links whose
+            bandwidth-delay product is beyond the kernel's autotuning limit. Defaults to None.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+def set_cork(sock: socket.socket, corked: bool):
+    """Hold back partial segments while a header and the data after it are written
+
+    Corking before a header and uncorking once the data is written lets the header
+    share a segment with the first data instead of going out on its own. Does
+    nothing where TCP_CORK isn't available.
+
+    Args:
+        sock (socket.socket): A connected TCP socket
+        corked (bool): Whether to cork the socket, uncorking flushes anything held back
+    """
+    if hasattr(socket, "TCP_CORK") and sock.fileno() != -1:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
@@ -0,0 +1,136 @@
+import zlib
+import lzma
+import bz2
+from typing import Iterator
+from enum import Enum
+
+# Bytes read from each sampled part of a file when checking whether it compresses
+COMPRESSION_SAMPLE = 64 * 1024
+# A sample has to shrink to at most this fraction of its size for compression to be used
+MAX_COMPRESSED_RATIO = 0.9
+# Transfers smaller than this are always sent as they are
+MIN_COMPRESSED_SIZE = 4 * 1024
+# Largest chunk produced at once when decompressing, so a small frame can't expand
+# into an unbounded amount of memory
+DECOMPRESS_CHUNK = 256 * 1024
+
+# Raised by the decompressors when given data that isn't valid for their codec
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+
+class CODECS(Enum):
+    ZLIB = "zlib"
+    LZMA = "lzma"
+    BZ2 = "bz2"
+
+def negotiate_codec(offered) -> str:
+    """Pick the codec to use from those a peer accepts
+
+    Args:
+        offered (list[str]): Codec names in the peer's order of preference
+
+    Returns:
+        str: The first supported codec, or None if there isn't one
+    """
+    supported = {codec.value for codec in CODECS}
+    for codec in offered or []:
+        if codec in supported:
+            return codec
+    return None
+
+def choose_codec(f, offset: int, content_length: int, codec: str) -> str:
+    """Decide whether a range of a file is worth compressing
+
+    The start and the middle of the range are compressed with fast zlib settings, so
+    already compressed data (archives, media) is sent as it is without spending CPU
+    on it.
+
+    Args:
+        f (_type_): File object opened in binary mode, its position is moved
+        offset (int): First byte of the range
+        content_length (int): Number of bytes in the range
+        codec (str): Codec the data would be compressed with
+
+    Returns:
+        str: The codec, or None if the data should be sent uncompressed
+    """
+    if codec is None or content_length < MIN_COMPRESSED_SIZE:
+        return None
+
+    sample_size = min(COMPRESSION_SAMPLE, content_length)
+    positions = {offset, offset + (content_length - sample_size) // 2}
+    raw = compressed = 0
+    for position in positions:
+        f.seek(position)
+        sample = f.read(sample_size)
+        raw += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+
+    if raw == 0 or compressed > raw * MAX_COMPRESSED_RATIO:
+        return None
+    return codec
+
+def get_compressor(codec: str):
+    """Create a streaming compressor
+
+    Args:
+        codec (str): Name of the codec, one of CODECS
+
+    Raises:
+        ValueError: Raised if the codec isn't supported
+
+    Returns:
+        _type_: Object with compress(data) and flush() methods
+    """
+    if codec == CODECS.ZLIB.value:
+        return zlib.compressobj(6)
+    if codec == CODECS.LZMA.value:
+        return lzma.LZMACompressor(preset=1)
+    if codec == CODECS.BZ2.value:
+        return bz2.BZ2Compressor(9)
+    raise ValueError(f"Unsupported compression {codec}")
+
+def get_decompressor(codec: str):
+    """Create a streaming decompressor
+
+    Args:
+        codec (str): Name of the codec, one of CODECS
+
+    Raises:
+        ValueError: Raised if the codec isn't supported
+
+    Returns:
+        _type_: Decompressor to pass to decompress_chunks
+    """
+    if codec == CODECS.ZLIB.value:
+        return zlib.decompressobj()
+    if codec == CODECS.LZMA.value:
+        return lzma.LZMADecompressor()
+    if codec == CODECS.BZ2.value:
+        return bz2.BZ2Decompressor()
+    raise ValueError(f"Unsupported compression {codec}")
+
+def decompress_chunks(decompressor, data: bytes) -> Iterator[bytes]:
+    """Decompress some data in chunks of at most DECOMPRESS_CHUNK bytes
+
+    Args:
+        decompressor (_type_): Decompressor from get_decompressor
+        data (bytes): Compressed data
+
+    Yields:
+        bytes: Decompressed chunks
+    """
+    if hasattr(decompressor, "unconsumed_tail"):
+        # zlib keeps the input it hasn't used yet in unconsumed_tail
+        while True:
+            chunk = decompressor.decompress(data, DECOMPRESS_CHUNK)
+            yield chunk
+            data = decompressor.unconsumed_tail
+            # A full chunk may have left output behind even with no input remaining
+            if not data and len(chunk) < DECOMPRESS_CHUNK:
+                return
+
+    # bz2 and lzma keep it internally until asked for more output
+    chunk = decompressor.decompress(data, DECOMPRESS_CHUNK)
+    yield chunk
+    while not decompressor.eof and not decompressor.needs_input:
+        yield decompressor.decompress(b"", DECOMPRESS_CHUNK)
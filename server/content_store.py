@@ -0,0 +1,105 @@
+import os
+import hashlib
+from protocol_utils import PARTIAL_SUFFIX
+
+# Directory, inside the served directory, holding one file per distinct content
+OBJECT_DIR = ".objects"
+
+class ContentStore:
+    """Store of file contents keyed by their SHA-256 digest
+
+    Each served name is a hard link to the object holding its content, so files with
+    the same content share their disk space, and everything that reads files by name
+    works unchanged. Published files are never written to in place, only replaced,
+    so sharing the data between names is safe.
+    """
+
+    def __init__(self, root: str = "."):
+        """
+        Args:
+            root (str, optional): Served directory. Defaults to ".".
+        """
+        self.root = root
+        self.objects = os.path.join(root, OBJECT_DIR)
+        os.makedirs(self.objects, exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        """Get where the object for some content is kept
+
+        Args:
+            digest (str): SHA-256 hex digest of the content
+
+        Returns:
+            str: Path of the object
+        """
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def link(self, digest: str, name: str, size: int = None) -> bool:
+        """Publish a name for content that is already stored
+
+        Args:
+            digest (str): SHA-256 hex digest of the content
+            name (str): Name to publish the content under, replacing any file with it
+            size (int, optional): Expected size of the content. Defaults to None.
+
+        Returns:
+            bool: Whether the content was found and the name published
+        """
+        if not isinstance(digest, str) or len(digest) != 64 or not digest.isascii():
+            return False
+        if not digest.isalnum():
+            return False
+        path = self.object_path(digest.lower())
+        try:
+            if size is not None and os.path.getsize(path) != size:
+                return False
+            # Linked under a temporary name first, so the name appears atomically
+            temporary = f"{os.path.join(self.root, name)}.{os.getpid()}{PARTIAL_SUFFIX}"
+            os.link(path, temporary)
+        except OSError:
+            return False
+        os.replace(temporary, os.path.join(self.root, name))
+        return True
+
+    def store(self, filename: str, name: str) -> str:
+        """Move a completed file into the store and publish it under a name
+
+        Args:
+            filename (str): File holding the content, it is moved or removed
+            name (str): Name to publish the content under
+
+        Returns:
+            str: SHA-256 hex digest of the content
+        """
+        with open(filename, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            # Already held, the new copy isn't needed
+            os.remove(filename)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(filename, path)
+
+        if not self.link(digest, name):
+            raise IOError(f"Could not publish {name}")
+        return digest
+
+    def prune(self) -> int:
+        """Remove objects that no name links to any more
+
+        Returns:
+            int: Number of objects removed
+        """
+        removed = 0
+        for root, _, files in os.walk(self.objects):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
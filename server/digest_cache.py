@@ -0,0 +1,65 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Most digests kept before the least recently used are dropped
+DIGEST_CACHE_SIZE = 10000
+
+class DigestCache:
+    """Cache of SHA-256 file digests keyed by (device, inode, size, mtime)
+
+    A file is only hashed again once it has been replaced or modified, however
+    many times its digest is asked for, and renaming it keeps its entry.
+    """
+
+    def __init__(self, max_entries: int = DIGEST_CACHE_SIZE):
+        """
+        Args:
+            max_entries (int, optional): Most digests to keep. Defaults to DIGEST_CACHE_SIZE.
+        """
+        self.max_entries = max_entries
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename: str) -> str:
+        """Get the digest of a file, hashing it only if it has changed
+
+        Args:
+            filename (str): Name of the file
+
+        Raises:
+            OSError: Raised if the file can't be read
+
+        Returns:
+            str: SHA-256 hex digest
+        """
+        with open(filename, "rb") as f:
+            key = file_key(os.fstat(f.fileno()))
+            with self.lock:
+                digest = self.digests.get(key)
+                if digest is not None:
+                    self.digests.move_to_end(key)
+                    return digest
+
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+            if file_key(os.fstat(f.fileno())) != key:
+                # Written to while it was being hashed, the digest can't be trusted later
+                return digest
+
+        with self.lock:
+            self.digests[key] = digest
+            if len(self.digests) > self.max_entries:
+                self.digests.popitem(last=False)
+        return digest
+
+def file_key(stat: os.stat_result) -> tuple:
+    """Get the cache key of a file
+
+    Args:
+        stat (os.stat_result): Result of stat on the file
+
+    Returns:
+        tuple: Device, inode, size and modification time in nanoseconds
+    """
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
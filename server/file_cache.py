@@ -0,0 +1,126 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from digest_cache import file_key
+
+# Bytes of file contents kept in memory by default
+FILE_CACHE_SIZE = 64 * 1024 * 1024
+# Files larger than this are always read from disk, so one big file can't push out
+# the many small ones that make up most requests
+CACHED_FILE_MAX = 4 * 1024 * 1024
+
+class CachedFile(NamedTuple):
+    data: bytes
+    mtime_ns: int
+
+# Returned by FileCache.get for files that are read from disk without trying the cache,
+# as they are too large or missing
+NOT_CACHEABLE = object()
+
+class FileCache:
+    """Cache of whole file contents, for serving frequently downloaded files from memory
+
+    Entries are keyed by name and checked against the file's (device, inode, size,
+    mtime) on every lookup, so a file that is modified or replaced is read again.
+    The least recently used entries are dropped once the byte budget is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = FILE_CACHE_SIZE, max_file_size: int = CACHED_FILE_MAX):
+        """
+        Args:
+            max_bytes (int, optional): Most bytes of file contents to keep.
+                Defaults to FILE_CACHE_SIZE.
+            max_file_size (int, optional): Largest file to keep. Defaults to CACHED_FILE_MAX.
+        """
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.files = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename: str) -> CachedFile:
+        """Look up a file, only checking its metadata on disk
+
+        Args:
+            filename (str): Name of the file
+
+        Returns:
+            CachedFile | None: The file's contents, None if they have to be loaded, or
+                NOT_CACHEABLE if the file isn't one the cache would hold, which isn't
+                counted as a miss
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return NOT_CACHEABLE
+        if stat.st_size > self.max_file_size:
+            return NOT_CACHEABLE
+        key = file_key(stat)
+
+        with self.lock:
+            entry = self.files.get(filename)
+            if entry is not None and entry[0] == key:
+                self.files.move_to_end(filename)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def load(self, filename: str) -> CachedFile:
+        """Read a file into the cache, run in a worker thread after a miss
+
+        Args:
+            filename (str): Name of the file
+
+        Returns:
+            CachedFile | None: The file's contents, or None if it is too large to cache
+                or can't be read
+        """
+        try:
+            with open(filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > self.max_file_size:
+                    return None
+                data = f.read()
+                key = file_key(os.fstat(f.fileno()))
+        except OSError:
+            return None
+        if key != file_key(stat) or len(data) != stat.st_size:
+            # Written to while it was being read
+            return None
+
+        cached = CachedFile(data, stat.st_mtime_ns)
+        with self.lock:
+            previous = self.files.pop(filename, None)
+            if previous is not None:
+                self.size -= len(previous[1].data)
+            self.files[filename] = (key, cached)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.files.popitem(last=False)
+                self.size -= len(evicted.data)
+        return cached
+
+    def invalidate(self, filename: str):
+        """Drop a file's entry, after the server has replaced it
+
+        Args:
+            filename (str): Name of the file
+        """
+        with self.lock:
+            entry = self.files.pop(filename, None)
+            if entry is not None:
+                self.size -= len(entry[1].data)
+
+    def stats(self) -> dict:
+        """Get the cache's counters
+
+        Returns:
+            dict: hits, misses, number of files and bytes held, and the byte budget
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "files": len(self.files),
+                    "bytes": self.size, "max_bytes": self.max_bytes}
@@ -0,0 +1,202 @@
+import os
+import time
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import NamedTuple
+from protocol_utils import PARTIAL_SUFFIX
+from digest_cache import DigestCache
+
+# Longest a LIST may go without checking the directory for changes made outside the
+# server. Changes that touch the directory itself are picked up straight away.
+REFRESH_INTERVAL = 5.0
+
+SORT_FIELDS = ("name", "size", "mtime")
+
+class FileEntry(NamedTuple):
+    name: str
+    size: int
+    mtime: float
+
+class ListingIndex:
+    """In-memory index of the files in a directory, for fast sorted and paginated listings
+
+    The index is rescanned when the directory's mtime changes or REFRESH_INTERVAL has
+    passed, reusing entries for files whose size and mtime are unchanged. The server
+    also updates single entries as its own uploads complete.
+    """
+
+    def __init__(self, root: str = ".", digests: DigestCache = None):
+        """
+        Args:
+            root (str, optional): Directory to index. Defaults to ".".
+            digests (DigestCache, optional): Cache to get file digests from, shared with
+                anything else that needs them. Defaults to a new cache.
+        """
+        self.root = root
+        self.digests = digests if digests is not None else DigestCache()
+        self.entries = {}
+        # Sort keys per field, the name order is kept up to date and the rest are
+        # rebuilt when first needed after a change
+        self.sorted_keys = {"name": []}
+        self.dir_mtime = None
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def needs_refresh(self) -> bool:
+        """Check whether the directory may have changed since the last scan
+
+        Returns:
+            bool: Whether refresh should be called before answering a query
+        """
+        if time.monotonic() - self.refreshed_at > REFRESH_INTERVAL:
+            return True
+        try:
+            return os.stat(self.root).st_mtime_ns != self.dir_mtime
+        except OSError:
+            return True
+
+    def refresh(self):
+        """Rescan the directory, keeping entries for files that haven't changed"""
+        # Taken before scanning, so changes made during the scan trigger another one
+        dir_mtime = os.stat(self.root).st_mtime_ns
+        refreshed_at = time.monotonic()
+
+        old_entries = self.entries
+        entries = {}
+        with os.scandir(self.root) as scan:
+            for dir_entry in scan:
+                if dir_entry.name.endswith(PARTIAL_SUFFIX):
+                    continue
+                try:
+                    if not dir_entry.is_file():
+                        continue
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+
+                entry = old_entries.get(dir_entry.name)
+                if entry is None or entry.size != stat.st_size or entry.mtime != stat.st_mtime:
+                    entry = FileEntry(dir_entry.name, stat.st_size, stat.st_mtime)
+                entries[dir_entry.name] = entry
+
+        name_keys = sorted((name,) for name in entries)
+        with self.lock:
+            self.entries = entries
+            self.sorted_keys = {"name": name_keys}
+            self.dir_mtime = dir_mtime
+            self.refreshed_at = refreshed_at
+
+    def update(self, name: str):
+        """Add, update or remove a single file after the server changes it
+
+        Args:
+            name (str): Name of the file
+        """
+        try:
+            stat = os.stat(os.path.join(self.root, name))
+        except OSError:
+            stat = None
+
+        with self.lock:
+            name_keys = self.sorted_keys["name"]
+            if stat is None:
+                if self.entries.pop(name, None) is not None:
+                    name_keys.pop(bisect_left(name_keys, (name,)))
+            else:
+                if name not in self.entries:
+                    insort(name_keys, (name,))
+                self.entries[name] = FileEntry(name, stat.st_size, stat.st_mtime)
+            self.sorted_keys = {"name": name_keys}
+
+    def query(self, prefix: str = "", sort: str = "name", reverse: bool = False, cursor=None,
+              limit: int = None) -> tuple[list[FileEntry], list]:
+        """Get one page of entries
+
+        Args:
+            prefix (str, optional): Only include names starting with this. Defaults to "".
+            sort (str, optional): Field to sort by, one of SORT_FIELDS. Defaults to "name".
+            reverse (bool, optional): Sort in descending order. Defaults to False.
+            cursor (list, optional): Cursor returned with the previous page. Defaults to None.
+            limit (int, optional): Maximum entries in the page, or None for all. Defaults to None.
+
+        Returns:
+            tuple[list[FileEntry], list]: The entries, and the cursor for the next page
+                or None if this is the last one
+        """
+        with self.lock:
+            entries = self.entries
+            keys = self.get_sorted_keys(sort)
+
+        if cursor is not None:
+            cursor = tuple(cursor)
+            start = bisect_left(keys, cursor) - 1 if reverse else bisect_right(keys, cursor)
+        elif reverse:
+            start = len(keys) - 1
+        elif sort == "name":
+            # Names matching the prefix are contiguous, jump straight to them
+            start = bisect_left(keys, (prefix,))
+        else:
+            start = 0
+
+        step = -1 if reverse else 1
+        page = []
+        index = start
+        while 0 <= index < len(keys):
+            key = keys[index]
+            name = key[-1]
+            if name.startswith(prefix):
+                if limit is not None and len(page) == limit:
+                    return page, list(page_key(page[-1], sort))
+                page.append(entries[name])
+            elif sort == "name" and not reverse and name > prefix:
+                break
+            index += step
+
+        return page, None
+
+    def get_sorted_keys(self, sort: str) -> list[tuple]:
+        """Get the sort keys of every entry in order, building them if needed
+
+        Must be called with the lock held.
+
+        Args:
+            sort (str): Field to sort by
+
+        Returns:
+            list[tuple]: Sorted keys, each ending with the file name
+        """
+        keys = self.sorted_keys.get(sort)
+        if keys is None:
+            keys = sorted(page_key(entry, sort) for entry in self.entries.values())
+            self.sorted_keys[sort] = keys
+        return keys
+
+    def get_digest(self, name: str) -> str:
+        """Get the SHA-256 digest of a file, hashing it only if it changed since last time
+
+        Args:
+            name (str): Name of the file
+
+        Returns:
+            str: Hex digest, or None if the file isn't in the index
+        """
+        if name not in self.entries:
+            return None
+        try:
+            return self.digests.get(os.path.join(self.root, name))
+        except OSError:
+            return None
+
+def page_key(entry: FileEntry, sort: str) -> tuple:
+    """Get the sort key of an entry
+
+    Args:
+        entry (FileEntry): Index entry
+        sort (str): Field to sort by
+
+    Returns:
+        tuple: The key, ending with the name so keys are unique
+    """
+    if sort == "name":
+        return (entry.name,)
+    return (getattr(entry, sort), entry.name)
@@ -1,70 +1,351 @@
+import io
 import socket
+import asyncio
 import json
 import os
-from progress.bar import ChargingBar
+import time
+import mmap
+import struct
+import weakref
+import hashlib
+import ctypes
+from typing import Iterator
+from contextlib import nullcontext, contextmanager
 from enum import Enum
+from compression import (negotiate_codec, choose_codec, get_compressor, get_decompressor,
+                         decompress_chunks, DECOMPRESS_ERRORS)
+from delta import generate_delta, copy_range, DELTA_COPY, DELTA_LITERAL, COPY_RUN
+from progress_report import progress_bar
+from tuning import ChunkSizer, set_cork
 
 RECV_BUFFER = 1024
+# Starting chunk size for the data phase of transfers, used by the receive loop and
+# by the send loop when the kernel's sendfile isn't available. Each transfer then
+# adjusts it to its measured throughput, see ChunkSizer.
+DATA_BUFFER = 256 * 1024
+
+# Every control message is sent as a frame: a fixed header carrying a magic value,
+# the protocol version, the frame type and the payload length, then the payload.
+# Peers that send bare JSON (the original unframed protocol) are detected from their
+# first message and are answered the same way.
+FRAME_MAGIC = b"SPYF"
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct("!4sBBI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Sockets whose peer speaks the original unframed protocol
+LEGACY_SOCKETS = weakref.WeakSet()
+# Seconds each send or receive on a non-blocking socket may wait for its peer before
+# failing with TimeoutError, by socket. Sockets not in here wait as long as it takes.
+SOCKET_TIMEOUTS = weakref.WeakKeyDictionary()
+
+# Uploads are received into "<filename>.part" and only renamed once complete, so an
+# interrupted upload can be resumed and is never visible as a finished file
+PARTIAL_SUFFIX = ".part"
+# A file received through a memory map is sized before its data arrives, so while that
+# runs it is marked by an empty "<filename>.mapped.part". A mark left behind by a crash
+# means the file's size can't be trusted to say how much arrived.
+MAPPED_SUFFIX = ".mapped" + PARTIAL_SUFFIX
+# fallocate mode that reserves disk space without changing the file's size, so a file
+# being received is only ever as long as the data that has reached it
+FALLOC_FL_KEEP_SIZE = 1
+
+# Compressed file data is sent as a series of DATA frames ending with an empty one.
+# content_length always counts the uncompressed bytes, the size on the wire is
+# carried by the frames and reported back as wire_length when the transfer completes.
+
+# Number of entries requested per LIST page
+LIST_PAGE_SIZE = 1000
 
 class REQ_TYPES(Enum):
     PUT = "put"
     GET = "get"
     LIST = "list"
+    SYNC = "sync"
+    STATS = "stats"
 
 class STATUS_CODES(Enum):
     ALLOW = "000"
     DENY = "100"
+    NOT_MODIFIED = "010"
+    BUSY = "001"
+
+class ServerBusyError(Exception):
+    """Raised when the server turns a request away because it is overloaded"""
+
+    def __init__(self, message: str, retry_after: float):
+        """
+        Args:
+            message (str): The server's reason
+            retry_after (float): Seconds the server asked to wait before trying again
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FRAME_TYPES(Enum):
+    MESSAGE = 1
+    DATA = 2
 
-def request_file(sock: socket.socket, filename: str):
+def request_file(sock: socket.socket, filename: str, fast=True, offset=0, length=None,
+                 compression=None, conditions=None, progress=progress_bar) -> bool:
     """Attempts to download a file from the server
 
     Args:
         sock (socket.socket): Socket to download the file from
         filename (str): Name of the desired file
+        fast (bool, optional): Ask the server to stream the file straight after its
+            reply instead of using the multi-step handshake. Defaults to True.
+        offset (int, optional): First byte to download. The local file is written from
+            the same position, so this resumes a partial download. Defaults to 0.
+        length (int, optional): Number of bytes to download, or None for the rest
+            of the file. Defaults to None.
+        compression (str, optional): Codec the server may compress the data with, if
+            it is worth it. Defaults to None.
+        conditions (dict, optional): Description of the local copy from get_conditions,
+            so nothing is sent if the server's copy is the same. Defaults to None.
+        progress (Callable, optional): Called with a label and the number of bytes to
+            receive, giving a context manager that yields the callback to report bytes
+            with. None reports nothing. Defaults to progress_bar.
+
+    Returns:
+        bool: Whether the local file now matches the server's copy
     """
     
     # Initiate GET request with server
     try:
         print(f"Requesting {filename}")
-        request = json.dumps({
-                    "type": REQ_TYPES.GET.value,
-                    "filename": filename
-                })
-
-        sock.sendall(request.encode())
+        send_message(sock, {
+            "type": REQ_TYPES.GET.value,
+            "filename": filename,
+            "fast": fast,
+            "offset": offset,
+            "length": length,
+            "compression": [compression] if compression else [],
+            **(conditions or {})
+        })
     except socket.error:
         print("Error sending file request")
         sock.close()
         print("--Closed connection--")
-        return
+        return False
     
     # We expect back a PUT packet with the file info
     message = get_response(sock)
+    if message.get("status_code") == STATUS_CODES.NOT_MODIFIED.value:
+        print(f"{filename} is up to date")
+        set_mtime(filename, message.get("mtime_ns"))
+        return True
+
     if message.get("type") == REQ_TYPES.PUT.value:
         content_length = message.get("content_length", None)
         if content_length is None:
             print("Unknown file size")
             sock.close()
             print("--Closed connection--")
-            return
+            return False
 
-        # We send back approval of the file info
-        allow(sock, "File info received. Continue to send file.")
+        offset = message.get("offset", 0)
+        codec = message.get("compression")
+        # Once the whole file is here it is given the server's mtime, so the next
+        # conditional request can tell it is unchanged
+        complete = offset + content_length == message.get("file_size")
+        mtime_ns = message.get("mtime_ns") if complete else None
 
-        # First we expect an acknowledgement that the file will be sent
-        message = get_response(sock)
-        
-        if message.get("status_code") == STATUS_CODES.ALLOW.value:
-            # Now we are expecting the file data
-            receive_file(sock, filename, content_length)
-            return
-        else:
-            print(f"Server rejected file transfer: {message.get('message')}")
+        # On the fast path the file data follows the header straight away
+        if not message.get("fast"):
+            # We send back approval of the file info
+            allow(sock, "File info received. Continue to send file.")
+
+            # First we expect an acknowledgement that the file will be sent
+            message = get_response(sock)
+            if message.get("status_code") != STATUS_CODES.ALLOW.value:
+                print(f"Server rejected file transfer: {message.get('message')}")
+                return False
+
+        # Now we are expecting the file data
+        with progress("Downloading", content_length) if progress else nullcontext() as report:
+            received = receive_file(sock, filename, content_length, offset=offset, compression=codec,
+                                    progress=report)
+        if received:
+            print("File transfer complete")
+            set_mtime(filename, mtime_ns)
+            return True
+        return False
+    elif message:
+        print(f"Server error: {message.get('message')}")
     else:
-        print(f"Server error: {message.get("message")}")
+        # No valid reply, the connection can't be used for anything else
+        print("Server error: no response")
+        sock.close()
+        print("--Closed connection--")
+    return False
+
+def get_conditions(filename: str, use_digest=False) -> dict:
+    """Describe the local copy of a file for a conditional GET
+
+    Args:
+        filename (str): Name of the local file
+        use_digest (bool, optional): Compare by SHA-256 digest instead of by modification
+            time. Slower, but works for copies that didn't come from the server.
+            Defaults to False.
+
+    Returns:
+        dict: Request fields to pass to request_file, empty if there is no local copy
+    """
+    try:
+        with open(filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if use_digest:
+                return {
+                    "if_size": stat.st_size,
+                    "if_digest": hashlib.file_digest(f, "sha256").hexdigest()
+                }
+    except FileNotFoundError:
+        return {}
+    return {"if_size": stat.st_size, "if_mtime_ns": stat.st_mtime_ns}
+
+def set_mtime(filename: str, mtime_ns):
+    """Give a downloaded file the modification time of the server's copy
+
+    Args:
+        filename (str): Name of the local file
+        mtime_ns (int): Modification time in nanoseconds, or None to leave it as it is
+    """
+    if mtime_ns is None:
+        return
+    try:
+        os.utime(filename, ns=(os.stat(filename).st_atime_ns, mtime_ns))
+    except OSError:
+        pass
+
+def get_remote_file_size(sock: socket.socket, filename: str) -> int:
+    """Ask the server for the size of a file without downloading any of it
+
+    Args:
+        sock (socket.socket): Socket connected to the server
+        filename (str): Name of the remote file
+
+    Returns:
+        int: Size in bytes, or -1 if the file can't be downloaded
+    """
+    message = get_remote_file_info(sock, filename)
+    return message.get("file_size", message.get("content_length", -1)) if message else -1
+
+def get_remote_file_info(sock: socket.socket, filename: str, conditions: dict = None) -> dict:
+    """Ask the server about a file without downloading any of it
+
+    Args:
+        sock (socket.socket): Socket connected to the server
+        filename (str): Name of the remote file
+        conditions (dict, optional): Fields from get_conditions, so the server answers
+            NOT MODIFIED if the local copy already matches. Defaults to None.
+
+    Returns:
+        dict: The server's header for the file, with its file_size and mtime_ns, or its
+            NOT MODIFIED reply. Empty if the file can't be downloaded.
+    """
+    try:
+        send_message(sock, {
+            "type": REQ_TYPES.GET.value,
+            "filename": filename,
+            "fast": True,
+            "offset": 0,
+            "length": 0,
+            **(conditions or {})
+        })
+    except socket.error:
+        print("Error sending file request")
+        return {}
+
+    message = get_response(sock)
+    if message.get("status_code") == STATUS_CODES.NOT_MODIFIED.value:
+        return message
+    if message.get("type") != REQ_TYPES.PUT.value:
+        print(f"Server error: {message.get('message')}")
+        return {}
+
+    # An empty range has no data to follow, so it is complete straight away
+    allow(sock, "File transfer complete")
+    return message
+
+def request_archive(sock: socket.socket, names: list[str]) -> int:
+    """Download many files in one request, streamed back to back as a single archive
+
+    Each entry of the archive is a PUT header followed by the file's data, and a final
+    ALLOW marks the end. Files are written out as they arrive, with the directory
+    structure they have on the server.
 
-    sock.close()
-    print("--Closed connection--")
+    Args:
+        sock (socket.socket): Socket to download the files from
+        names (list[str]): File names, directories or glob patterns to download
+
+    Returns:
+        int: Number of files received
+    """
+    try:
+        print(f"Requesting archive of {' '.join(names)}")
+        send_message(sock, {
+            "type": REQ_TYPES.GET.value,
+            "filenames": names
+        })
+    except socket.error:
+        print("Error sending archive request")
+        sock.close()
+        print("--Closed connection--")
+        return 0
+
+    received = 0
+    while True:
+        message = get_response(sock)
+
+        if message.get("type") != REQ_TYPES.PUT.value:
+            if message.get("status_code") == STATUS_CODES.ALLOW.value:
+                print(f"Archive complete, {received} files received")
+                allow(sock, "Archive received")
+            elif message:
+                print(f"Server error: {message.get('message')}")
+            else:
+                print("Server error: archive ended unexpectedly")
+                sock.close()
+                print("--Closed connection--")
+            return received
+
+        filename = message.get("filename", "")
+        content_length = message.get("content_length", 0)
+        if not is_safe_path(filename):
+            # The data can't be skipped safely, so give up on the connection
+            print(f"Error: refusing to write {filename} outside the current directory")
+            sock.close()
+            print("--Closed connection--")
+            return received
+
+        print(f"Receiving {filename} ({content_length} bytes)")
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, "w+b") as f:
+            preallocate(f, content_length)
+            try:
+                receive_file_data(sock, f, content_length)
+            except IOError:
+                print("Error writing data to file")
+                sock.close()
+                print("--Closed connection--")
+                return received
+        received += 1
+
+def is_safe_path(filename: str) -> bool:
+    """Check that a file name stays inside the current directory
+
+    Args:
+        filename (str): Relative file name, possibly with directories
+
+    Returns:
+        bool: Whether the name is relative and has no ".." components
+    """
+    if not filename or os.path.isabs(filename):
+        return False
+    return ".." not in filename.replace("\\", "/").split("/")
 
 def get_file_size(filename) -> int:
     """Get the size in bytes of a locally stored file
@@ -83,211 +364,1677 @@ def get_file_size(filename) -> int:
         print("Error: file not found")
         return -1
 
-def send_file(sock: socket.socket, filename: str):
+def send_file(sock: socket.socket, filename: str, fast=True, resume=False, compression=None,
+              dedup=False, keep_mtime=False) -> bool:
     """Sends a file to a socket connection
 
     Args:
         sock (socket.socket): Socket to send file through
         filename (str): Name of local file to be sent
+        fast (bool, optional): Stream the data straight after the header instead of
+            waiting for the multi-step handshake. Defaults to True.
+        resume (bool, optional): Continue an interrupted upload from wherever the
+            server's partial copy ends. Uses the handshake, as the server has to say
+            where that is. Defaults to False.
+        compression (str, optional): Codec to compress the data with, if a sample of
+            the file shows it is worth it. Defaults to None.
+        dedup (bool, optional): Send the file's digest first, so no data is sent if the
+            server already holds the same content. Uses the handshake. Defaults to False.
+        keep_mtime (bool, optional): Have the server give its copy the local file's
+            modification time. Defaults to False.
+
+    Returns:
+        bool: Whether the server accepted the whole file
     """
     content_length = get_file_size(filename)
     if content_length < 0:
-        reject(sock, "File does not exist")
         print("Error: Invalid content length")
-        return
-    
-    bytes_sent = 0
+        return False
+
+    if resume or dedup:
+        fast = False
 
     try:
         print(f"Requesting to send {filename}")
         with open(filename, "rb") as f:
-            request = json.dumps({
+            codec = choose_codec(f, 0, content_length, compression)
+            f.seek(0)
+            digest = hashlib.file_digest(f, "sha256").hexdigest() if dedup else None
+            if fast:
+                # Let the header share its segment with the first of the data
+                set_cork(sock, True)
+            send_message(sock, {
                 "type": REQ_TYPES.PUT.value,
                 "filename": filename,
-                "content_length": content_length
+                "content_length": content_length,
+                "fast": fast,
+                "resume": resume,
+                "compression": codec,
+                "digest": digest,
+                "mtime_ns": os.fstat(f.fileno()).st_mtime_ns if keep_mtime else None
             })
-            sock.sendall(request.encode("utf-8"))
 
-            message = get_response(sock)
-            status_code = message.get("status_code")
+            offset = 0
+            if fast:
+                # Fast path: the data follows the header without waiting for approval
+                status_code = STATUS_CODES.ALLOW.value
+            else:
+                message = get_response(sock)
+                status_code = message.get("status_code")
+                offset = message.get("offset", 0)
+                if status_code == STATUS_CODES.ALLOW.value and message.get("stored"):
+                    print("Server already holds this content, nothing to send")
+                    print("File sent successfully")
+                    return True
 
             if status_code == STATUS_CODES.ALLOW.value:
-                # First we acknowledge that we are going to send the file
-                allow(sock, "File approval acknowledged. Sending file...")
-                print(f"Sending {filename}...")
+                if not fast:
+                    # First we acknowledge that we are going to send the file
+                    set_cork(sock, True)
+                    allow(sock, "File approval acknowledged. Sending file...")
+                if offset:
+                    print(f"Resuming {filename} from byte {offset}...")
+                else:
+                    print(f"Sending {filename}...")
                 # Then we send the file
-                while bytes_sent < content_length:
-                    file_content = f.read(RECV_BUFFER)
-                    sock.sendall(file_content)
-                    bytes_sent += len(file_content)
+                f.seek(offset)
+                if codec:
+                    wire_length = send_compressed_data(sock, f, content_length - offset, codec)
+                    print(f"Compressed {content_length - offset} bytes to {wire_length} with {codec}")
+                else:
+                    send_file_data(sock, f, content_length - offset)
+                set_cork(sock, False)
 
                 message = get_response(sock)
                 status_code = message.get("status_code")
 
                 if status_code == STATUS_CODES.ALLOW.value:
                     print("File sent successfully")
-                else:
-                    print(f"Error sending file: {message.get("message")}")
+                    return True
+                print(f"Error sending file: {message.get('message')}")
             else:
-                print(f"Remote error: {message.get("message")}")
+                print(f"Remote error: {message.get('message')}")
+    except FileNotFoundError:
+        print("File not found")
+    except socket.error as e:
+        # On the fast path this is how the server aborts an upload it won't accept
+        print("Error sending packet:")
+        print(e)
+        sock.close()
+        print("--Closed connection--")
+    return False
+
+def send_delta(sock: socket.socket, filename: str, keep_mtime=False) -> bool:
+    """Upload a new version of a file by sending only what differs from the server's copy
+
+    The server replies with signatures of the blocks of its copy, and the file is sent
+    as references to blocks that match plus the data in between. The server rebuilds
+    the file and replaces its copy once the result matches the digest of the original.
+
+    Args:
+        sock (socket.socket): Socket to send the file through
+        filename (str): Name of local file to be sent
+        keep_mtime (bool, optional): Have the server give its copy the local file's
+            modification time. Defaults to False.
+
+    Returns:
+        bool: Whether the server rebuilt the file
+    """
+    content_length = get_file_size(filename)
+    if content_length < 0:
+        print("Error: Invalid content length")
+        return False
+
+    try:
+        print(f"Requesting to send {filename} as a delta")
+        with open(filename, "rb") as f:
+            send_message(sock, {
+                "type": REQ_TYPES.PUT.value,
+                "filename": filename,
+                "content_length": content_length,
+                "delta": True,
+                "digest": hashlib.file_digest(f, "sha256").hexdigest(),
+                "mtime_ns": os.fstat(f.fileno()).st_mtime_ns if keep_mtime else None
+            })
+
+            message = get_response(sock)
+            if message.get("status_code") != STATUS_CODES.ALLOW.value:
+                print(f"Remote error: {message.get('message')}")
+                return False
+
+            f.seek(0)
+            block_size = message.get("block_size")
+            base_size = message.get("base_size", 0)
+            ops = generate_delta(f, block_size, message.get("signatures", []), base_size)
+            literal_length = send_delta_ops(sock, ops)
+            print(f"Sent {literal_length} of {content_length} bytes, "
+                  f"the rest was copied from the server's {base_size} byte version")
+
+        message = get_response(sock)
+        if message.get("status_code") == STATUS_CODES.ALLOW.value:
+            print("File sent successfully")
+            return True
+        print(f"Error sending file: {message.get('message')}")
     except FileNotFoundError:
         print("File not found")
     except socket.error as e:
         print("Error sending packet:")
         print(e)
-    finally:
         sock.close()
         print("--Closed connection--")
+    return False
+
+def send_delta_ops(sock: socket.socket, ops) -> int:
+    """Send the instructions of a delta as DATA frames, merging consecutive block copies
+
+    Args:
+        sock (socket.socket): Blocking socket to send the delta through
+        ops (_type_): ("copy", block index) and ("literal", data) tuples from generate_delta
+
+    Returns:
+        int: Number of bytes of literal data sent
+    """
+    literal_length = 0
+    run_start = run_length = 0
+    for op, value in ops:
+        if op == "copy" and run_length and value == run_start + run_length:
+            run_length += 1
+            continue
+        if run_length:
+            sock.sendall(encode_frame(FRAME_TYPES.DATA, DELTA_COPY + COPY_RUN.pack(run_start, run_length)))
+            run_length = 0
+
+        if op == "copy":
+            run_start, run_length = value, 1
+        else:
+            send_data_frames(sock, DELTA_LITERAL + value)
+            literal_length += len(value)
+
+    if run_length:
+        sock.sendall(encode_frame(FRAME_TYPES.DATA, DELTA_COPY + COPY_RUN.pack(run_start, run_length)))
+    # An empty frame marks the end of the delta
+    sock.sendall(encode_frame(FRAME_TYPES.DATA, b""))
+    return literal_length
+
+def send_file_data(sock: socket.socket, f, content_length: int, use_sendfile=True) -> int:
+    """Send the contents of an open file, using the kernel's zero-copy sendfile if possible
+
+    Args:
+        sock (socket.socket): Blocking socket to send the data through
+        f (_type_): File object opened in binary mode, positioned at the start of the data
+        content_length (int): Number of bytes to send
+        use_sendfile (bool, optional): Allow the sendfile path. Defaults to True.
+
+    Returns:
+        int: Number of bytes sent
+    """
+    if content_length == 0:
+        return 0
+
+    if use_sendfile and hasattr(os, "sendfile"):
+        return sock.sendfile(f, f.tell(), content_length)
+
+    # Fall back to large buffered reads, sized to the connection's throughput
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    bytes_sent = 0
+    while bytes_sent < content_length:
+        view = sizer.view()
+        read = f.readinto(view[:content_length - bytes_sent])
+        if not read:
+            break
+        sock.sendall(view[:read])
+        bytes_sent += read
+        sizer.update(read)
+    return bytes_sent
+
+def send_compressed_data(sock: socket.socket, f, content_length: int, codec: str) -> int:
+    """Compress the contents of an open file as it is sent, in DATA frames
+
+    Args:
+        sock (socket.socket): Blocking socket to send the data through
+        f (_type_): File object opened in binary mode, positioned at the start of the data
+        content_length (int): Number of uncompressed bytes to send
+        codec (str): Codec to compress the data with
+
+    Returns:
+        int: Number of compressed bytes sent
+    """
+    compressor = get_compressor(codec)
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    bytes_read = 0
+    wire_length = 0
+    while bytes_read < content_length:
+        view = sizer.view()
+        read = f.readinto(view[:content_length - bytes_read])
+        if not read:
+            break
+        bytes_read += read
+        wire_length += send_data_frames(sock, compressor.compress(view[:read]))
+        sizer.update(read)
+    wire_length += send_data_frames(sock, compressor.flush())
+    # An empty frame marks the end of the data
+    sock.sendall(encode_frame(FRAME_TYPES.DATA, b""))
+    return wire_length
+
+def send_data_frames(sock: socket.socket, data: bytes) -> int:
+    """Send some data as DATA frames no bigger than MAX_FRAME_SIZE
+
+    Args:
+        sock (socket.socket): Blocking socket to send the data through
+        data (bytes): Data to send, nothing is sent if it is empty
+
+    Returns:
+        int: Number of bytes of data sent
+    """
+    for start in range(0, len(data), MAX_FRAME_SIZE):
+        sock.sendall(encode_frame(FRAME_TYPES.DATA, data[start:start + MAX_FRAME_SIZE]))
+    return len(data)
 
-def receive_file(socket: socket.socket, filename: str, content_length):
+def receive_file(socket: socket.socket, filename: str, content_length, use_mmap=False, offset=0,
+                 compression=None, progress=None) -> bool:
     """Receive a file from a socket connection
 
+    If the transfer is interrupted the data received so far is kept, so it can be
+    resumed from where it stopped.
+
     Args:
         socket (socket.socket): Socket to receive file over
         filename (str): Name of the file to be received
-        content_length (_type_): Size in bytes of the file
+        content_length (_type_): Size in bytes of the data to be received
+        use_mmap (bool, optional): Receive straight into a memory map of the file. Defaults to False.
+        offset (int, optional): Position in the file the data starts at. Defaults to 0.
+        compression (str, optional): Codec the data is compressed with, or None if it
+            is sent as it is. Defaults to None.
+        progress (_type_, optional): Called with the number of bytes in each chunk.
+            Defaults to None.
 
-    Raises:
-        IOError: Raised if there is an error writing the file
+    Returns:
+        bool: Whether the whole file was received
     """
-    bytes_received = 0
-    
-    # Using 'wb' as opposed to 'xb' as this function is shared by server
+    # Using 'w+b' as opposed to 'xb' as this function is shared by server
     # and client, and the client should be allowed to overwrite existing files.
+    # Read access is needed as well in case the file is memory mapped.
     
     # Overwrite checking for the server is performed with the initial request
     # handling in server.py
-    with open(filename, "wb") as f:
-
-        with ChargingBar("Downloading", max=content_length/RECV_BUFFER) as bar:
-
-            while bytes_received < content_length:
-                data = socket.recv(RECV_BUFFER)
-                try:
-                    if not data:
-                        print("--Connection closed unexpectedly--")
-                        raise IOError
-
-                    bytes_received += len(data)
-                    f.write(data)
-                except IOError:
-                    print("Error writing data to file")
-                    socket.close()
-                    os.remove(filename)
-                    return
-                    
-                bar.next()
-            bar.finish()
+    with mark_mapped(filename, use_mmap), open_for_receive(filename, offset) as f:
+        preallocate(f, content_length, offset)
+        bytes_received = 0
 
-    print("File transfer complete")
+        def count(received):
+            nonlocal bytes_received
+            bytes_received += received
+            if progress is not None:
+                progress(received)
 
-    # We tell the connection we have successfully received the file
-    allow(socket, "File transfer complete")
+        try:
+            if compression:
+                wire_length = receive_compressed_data(socket, f, content_length, compression,
+                                                      count, offset)
+            else:
+                wire_length = receive_file_data(socket, f, content_length, count, use_mmap, offset)
+        except IOError:
+            print("Error writing data to file")
+            socket.close()
+            # Keep what arrived, so a retry only has to move the missing bytes
+            f.truncate(offset + bytes_received)
+            return False
+        except BaseException:
+            # Interrupted, e.g. by Ctrl-C, what arrived can still be resumed from
+            f.truncate(offset + bytes_received)
+            raise
 
-    socket.close()
-    print("--Closed connection--")
+    # We tell the connection we have successfully received the file
+    allow(socket, "File transfer complete", wire_length=wire_length)
+    return True
 
-def get_listing(sock: socket.socket) -> list[str]:
-    """Request a listing of files in the remote directory
+def open_for_receive(filename: str, offset: int):
+    """Open a file to receive data into, keeping what is before offset
 
     Args:
-        sock (socket.socket): Socket to be used
+        filename (str): Name of the file
+        offset (int): Position the received data starts at
+
+    Returns:
+        _type_: File object opened for reading and writing
+    """
+    if offset and os.path.exists(filename):
+        return open(filename, "r+b")
+    return open(filename, "w+b")
+
+def load_fallocate():
+    """Find the C library's fallocate, as os only has posix_fallocate, which sets the size
 
     Returns:
-        list[str]: A list of filename strings
+        _type_: The function, or None where it isn't available
     """
     try:
-        print("Requesting directory listing")
-        request = json.dumps({
-            "type": REQ_TYPES.LIST.value
-        })
-        sock.sendall(request.encode())
-    except socket.error:
-        print("Error requesting directory listing")
-        return []
-    
-    response = get_response(sock)
-    sock.close()
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate64 if hasattr(libc, "fallocate64") else libc.fallocate
+    except (OSError, AttributeError, TypeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
 
-    if response.get("status_code") == STATUS_CODES.ALLOW.value:
-        print("Directory listing from server:")
-        return response.get("files")
-    else:
-        return []
+FALLOCATE = load_fallocate()
+
+def resumable_size(filename: str) -> int:
+    """Get how much of a partially received file a transfer can resume from
 
-def send_listing(sock: socket.socket):
-    """Send a list of files in the local directory
+    A file still marked as being received through a memory map was cut off by a
+    crash, so it is emptied and started over.
 
     Args:
-        sock (socket.socket): Socket to be sent over
+        filename (str): Name of the partial file
+
+    Returns:
+        int: Bytes received into the file, 0 if there is none
     """
-    files = os.listdir(".")
+    marker = filename + MAPPED_SUFFIX
+    if os.path.exists(marker):
+        if os.path.exists(filename):
+            os.truncate(filename, 0)
+        os.remove(marker)
+        return 0
     try:
-        print("Sending directory listing")
-        response = json.dumps({
-            "status_code": STATUS_CODES.ALLOW.value,
-            "message": "File listing message",
-            "files": files
-        })
-        sock.sendall(response.encode())
-    except socket.error:
-        print("Error sending directory listing")
-    else:
-        print("Successfully sent directory listing")
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+@contextmanager
+def mark_mapped(filename: str, use_mmap=True) -> Iterator:
+    """Mark a file as being received through a memory map for the duration of a with block
+
+    Args:
+        filename (str): Name of the file
+        use_mmap (bool, optional): Whether it is, nothing is marked if not. Defaults to True.
+    """
+    if not use_mmap:
+        yield
+        return
+    marker = filename + MAPPED_SUFFIX
+    open(marker, "wb").close()
+    try:
+        yield
     finally:
-        sock.close()
-        print("--Closed connection--")
+        os.remove(marker)
 
-def get_response(sock: socket.socket) -> dict:
-    """Receive a packet and decode the JSON
+def preallocate(f, content_length: int, offset=0):
+    """Reserve disk space for data that is about to be written to a file
+
+    The file's size is left alone, so if the transfer is cut off, even by a crash,
+    the size still says how much data arrived and it can be resumed from there. Does
+    nothing where space can't be reserved that way.
 
     Args:
-        sock (socket.socket): Socket to be received from
+        f (_type_): File object opened for writing
+        content_length (int): Number of bytes that will be written
+        offset (int, optional): Position the data will be written at. Defaults to 0.
+    """
+    if content_length <= 0 or FALLOCATE is None:
+        return
+    # A failure only loses the reservation, e.g. on filesystems without fallocate
+    FALLOCATE(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, content_length)
+
+def receive_file_data(sock: socket.socket, f, content_length: int, progress=None, use_mmap=False,
+                      offset=0) -> int:
+    """Receive file data into an open file without allocating per chunk
+
+    Data is read with recv_into, either into one reused buffer that is then written
+    out, or directly into a memory map of the file.
+
+    Args:
+        sock (socket.socket): Blocking socket to receive from
+        f (_type_): File object opened for reading and writing
+        content_length (int): Number of bytes to receive
+        progress (_type_, optional): Called with the number of bytes in each chunk. Defaults to None.
+        use_mmap (bool, optional): Receive straight into a memory map of the file. Defaults to False.
+        offset (int, optional): Position in the file to write the data at. Defaults to 0.
+
+    Raises:
+        IOError: Raised if the connection closes before all the data arrives
 
     Returns:
-        dict: A dictionary corresponding to the JSON data
+        int: Number of bytes received
     """
-    response = sock.recv(RECV_BUFFER)
+    if content_length == 0:
+        return 0
+
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    if use_mmap:
+        # The mapped range has to be backed by the file, so it is sized up front. The
+        # caller cuts it back to the data that arrived if the transfer stops short.
+        if os.fstat(f.fileno()).st_size < offset + content_length:
+            f.truncate(offset + content_length)
+        # Mappings have to start on an allocation boundary
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(f.fileno(), offset + content_length - start, offset=start)
+        mapped = memoryview(mapping)[offset - start:]
+    else:
+        mapping = None
+        f.seek(offset)
+
+    bytes_received = 0
     try:
-        message = json.loads(response)
-        return message
-    except json.JSONDecodeError:
-        print("Error decoding response")
-        return {}
+        while bytes_received < content_length:
+            remaining = content_length - bytes_received
+            if mapping is not None:
+                with mapped[bytes_received:bytes_received + sizer.size] as chunk:
+                    received = sock.recv_into(chunk)
+            else:
+                view = sizer.view()
+                received = sock.recv_into(view[:remaining])
+                f.write(view[:received])
 
-def allow(sock: socket.socket, message="Approved"):
-    """Sends an ALLOW packet
+            if not received:
+                print("--Connection closed unexpectedly--")
+                raise IOError("Connection closed unexpectedly")
+
+            bytes_received += received
+            sizer.update(received)
+            if progress is not None:
+                progress(received)
+    finally:
+        if mapping is not None:
+            mapped.release()
+            mapping.close()
+
+    return bytes_received
+
+def receive_compressed_data(sock: socket.socket, f, content_length: int, codec: str, progress=None,
+                            offset=0) -> int:
+    """Receive compressed file data sent as DATA frames and write it out decompressed
 
     Args:
-        sock (socket.socket): Socket to be sent over
-        message (str, optional): Message to be sent. Defaults to "Approved".
+        sock (socket.socket): Blocking socket to receive from
+        f (_type_): File object opened for writing
+        content_length (int): Number of uncompressed bytes expected
+        codec (str): Codec the data is compressed with
+        progress (_type_, optional): Called with the number of uncompressed bytes in each
+            chunk. Defaults to None.
+        offset (int, optional): Position in the file to write the data at. Defaults to 0.
+
+    Raises:
+        IOError: Raised if the connection closes early or the data doesn't decompress
+            to content_length bytes
+
+    Returns:
+        int: Number of compressed bytes received
     """
-    try:
-        approval = json.dumps({
-                "status_code": STATUS_CODES.ALLOW.value,
-                "message": message
-            })
-        sock.sendall(approval.encode())
-    except socket.error:
-        print("Error sending approval packet")
-        sock.close()
-        print("--Closed connection--")
+    decompressor = get_decompressor(codec)
+    f.seek(offset)
+    bytes_received = 0
+    wire_length = 0
+    while True:
+        length = parse_frame_header(recv_exactly(sock, FRAME_HEADER.size), FRAME_TYPES.DATA)
+        if length == 0:
+            break
+        data = recv_exactly(sock, length) if length is not None else b""
+        if length is None or len(data) < length:
+            print("--Connection closed unexpectedly--")
+            raise IOError("Connection closed unexpectedly")
+        wire_length += length
+
+        chunks = decompress_chunks(decompressor, data)
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except DECOMPRESS_ERRORS as e:
+                print(f"Error decompressing data: {e}")
+                raise IOError("Invalid compressed data")
+            if chunk is None:
+                break
+            if bytes_received + len(chunk) > content_length:
+                print("Error: compressed data is longer than expected")
+                raise IOError("More data than expected")
+            f.write(chunk)
+            bytes_received += len(chunk)
+            if progress is not None:
+                progress(len(chunk))
 
-def reject(sock: socket.socket, message="Rejected"):
-    """Sends a REJECT packet and closes the connection
+    if bytes_received != content_length:
+        print("Error: compressed data ended early")
+        raise IOError("Compressed data ended early")
+    return wire_length
+
+def get_listing(sock: socket.socket, prefix="", sort="name", reverse=False, detail=False,
+                digests=False, page_size=LIST_PAGE_SIZE) -> Iterator:
+    """Request a listing of files in the remote directory, one page at a time
+
+    Pages are only requested as the listing is iterated over, so only one page is
+    held in memory at a time.
 
     Args:
-        sock (socket.socket): Socket to be sent over
-        message (str, optional): Message to be sent. Defaults to "Rejected".
+        sock (socket.socket): Socket to be used
+        prefix (str, optional): Only list names starting with this. Defaults to "".
+        sort (str, optional): Sort by "name", "size" or "mtime". Defaults to "name".
+        reverse (bool, optional): Sort in descending order. Defaults to False.
+        detail (bool, optional): Yield dicts with name, size and mtime instead of
+            just names. Defaults to False.
+        digests (bool, optional): Include each file's SHA-256 digest in the details.
+            Defaults to False.
+        page_size (int, optional): Entries per page. Defaults to LIST_PAGE_SIZE.
+
+    Yields:
+        str | dict: Filename strings, or dicts if detail is set
     """
-    try:
-        rejection = json.dumps({
-                "status_code": STATUS_CODES.DENY.value,
-                "message": message
+    cursor = None
+    first_page = True
+    while True:
+        try:
+            if first_page:
+                print("Requesting directory listing")
+            send_message(sock, {
+                "type": REQ_TYPES.LIST.value,
+                "prefix": prefix,
+                "sort": sort,
+                "reverse": reverse,
+                "detail": detail or digests,
+                "digests": digests,
+                "limit": page_size,
+                "cursor": cursor
             })
-        sock.sendall(rejection.encode())
-    except socket.error:
-        print("Error sending rejection packet")
-    finally:
-        sock.close()
-        print("--Closed connection--")
\ No newline at end of file
+        except socket.error:
+            print("Error requesting directory listing")
+            return
+
+        response = get_response(sock)
+        if response.get("status_code") != STATUS_CODES.ALLOW.value:
+            if response:
+                print(f"Server error: {response.get('message')}")
+            return
+
+        if first_page:
+            print("Directory listing from server:")
+            first_page = False
+        yield from response.get("files", [])
+
+        cursor = response.get("next_cursor")
+        if cursor is None:
+            return
+
+def request_sync_plan(sock: socket.socket, files: list[dict], partial=False) -> dict:
+    """Send a manifest of local files and get back the transfers that would sync them
+
+    Args:
+        sock (socket.socket): Socket connected to the server
+        files (list[dict]): name, size and mtime_ns of each local file, and digest if known
+        partial (bool, optional): Only compare the files in the manifest, instead of
+            treating every other file on the server as missing locally. Defaults to False.
+
+    Returns:
+        dict: Names to "get", "put" and "check" (send again with digests), and "same"
+            mapping unchanged names to the server's mtime_ns. Empty if the request failed.
+    """
+    try:
+        send_message(sock, {
+            "type": REQ_TYPES.SYNC.value,
+            "files": files,
+            "partial": partial
+        })
+    except socket.error:
+        print("Error sending sync request")
+        return {}
+
+    response = get_response(sock)
+    if response.get("status_code") != STATUS_CODES.ALLOW.value:
+        if response:
+            print(f"Server error: {response.get('message')}")
+        return {}
+    return response
+
+def get_stats(sock: socket.socket) -> dict:
+    """Ask the server for its transfer metrics
+
+    Args:
+        sock (socket.socket): Socket connected to the server
+
+    Returns:
+        dict: The server's counters and latency histograms. Empty if the request failed.
+    """
+    try:
+        send_message(sock, {"type": REQ_TYPES.STATS.value})
+    except socket.error:
+        print("Error sending stats request")
+        return {}
+
+    response = get_response(sock)
+    if response.get("status_code") != STATUS_CODES.ALLOW.value:
+        if response:
+            print(f"Server error: {response.get('message')}")
+        return {}
+    return response.get("stats", {})
+
+def send_listing(sock: socket.socket, files=None, next_cursor=None):
+    """Send a list of files, by default those in the local directory
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        files (list, optional): Page of the listing to send. Defaults to None.
+        next_cursor (list, optional): Cursor for the page after this one, or None
+            if this is the last page. Defaults to None.
+    """
+    if files is None:
+        files = [name for name in os.listdir(".") if not name.endswith(PARTIAL_SUFFIX)]
+    try:
+        print("Sending directory listing")
+        send_message(sock, {
+            "status_code": STATUS_CODES.ALLOW.value,
+            "message": "File listing message",
+            "files": files,
+            "next_cursor": next_cursor
+        })
+    except socket.error:
+        print("Error sending directory listing")
+        sock.close()
+        print("--Closed connection--")
+    else:
+        print("Successfully sent directory listing")
+
+def get_response(sock: socket.socket) -> dict:
+    """Receive a packet and decode the JSON
+
+    Args:
+        sock (socket.socket): Socket to be received from
+
+    Raises:
+        ServerBusyError: Raised if the server turned the request away as it is overloaded
+
+    Returns:
+        dict: A dictionary corresponding to the JSON data
+    """
+    if sock in LEGACY_SOCKETS:
+        return check_busy(get_legacy_message(sock))
+
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header.startswith(b"{"):
+        # Bare JSON from a peer using the original unframed protocol
+        LEGACY_SOCKETS.add(sock)
+        return check_busy(get_legacy_message(sock, header))
+
+    length = parse_frame_header(header, FRAME_TYPES.MESSAGE)
+    if length is None:
+        return {}
+    return check_busy(decode_message(recv_exactly(sock, length)))
+
+def check_busy(message: dict) -> dict:
+    """Turn a BUSY reply into an exception, so callers can back off and retry
+
+    Args:
+        message (dict): A decoded reply
+
+    Raises:
+        ServerBusyError: Raised if the reply is BUSY
+
+    Returns:
+        dict: The reply
+    """
+    if isinstance(message, dict) and message.get("status_code") == STATUS_CODES.BUSY.value:
+        raise ServerBusyError(message.get("message", "Server busy"), message.get("retry_after", 1))
+    return message
+
+def get_legacy_message(sock: socket.socket, prefix: bytes = b"") -> dict:
+    """Receive one unframed JSON message without consuming any data sent after it
+
+    Args:
+        sock (socket.socket): Socket to be received from
+        prefix (bytes, optional): Start of the message, already received. Defaults to b"".
+
+    Returns:
+        dict: A dictionary corresponding to the JSON data
+    """
+    data = prefix + sock.recv(RECV_BUFFER - len(prefix), socket.MSG_PEEK)
+    end = find_message_end(data)
+    if end is None:
+        # Not a complete message, take what there is as the original protocol did
+        end = len(data)
+    recv_exactly(sock, end - len(prefix))
+    return decode_message(data[:end])
+
+def find_message_end(data: bytes):
+    """Find where the first JSON message in some data ends
+
+    Args:
+        data (bytes): Data starting with a JSON message
+
+    Returns:
+        int | None: Offset just past the message, or None if it isn't complete
+    """
+    # json.dumps escapes anything outside ASCII, so character offsets are byte offsets
+    try:
+        _, end = json.JSONDecoder().raw_decode(data.decode("latin-1"))
+        return end
+    except json.JSONDecodeError:
+        return None
+
+def send_message(sock: socket.socket, message: dict):
+    """Encode a message as JSON and send it, framed unless the peer is a legacy one
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (dict): Message to be sent
+    """
+    payload = json.dumps(message).encode()
+    if sock in LEGACY_SOCKETS:
+        # Legacy peers read each message with a single recv(RECV_BUFFER). Padding the
+        # JSON with whitespace to that size stops any data that follows from being
+        # read along with it.
+        sock.sendall(payload.ljust(RECV_BUFFER))
+    else:
+        sock.sendall(encode_frame(FRAME_TYPES.MESSAGE, payload))
+
+def recv_exactly(sock: socket.socket, length: int) -> bytes:
+    """Receive exactly length bytes, or fewer if the connection closes first
+
+    Args:
+        sock (socket.socket): Socket to be received from
+        length (int): Number of bytes to receive
+
+    Returns:
+        bytes: The data received
+    """
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+def encode_frame(frame_type: FRAME_TYPES, payload: bytes) -> bytes:
+    """Prefix a payload with a frame header
+
+    Args:
+        frame_type (FRAME_TYPES): Type of the frame
+        payload (bytes): Frame payload
+
+    Returns:
+        bytes: Header followed by the payload
+    """
+    return FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, frame_type.value, len(payload)) + payload
+
+def parse_frame_header(header: bytes, expected_type: FRAME_TYPES):
+    """Validate a frame header and get the length of its payload
+
+    Args:
+        header (bytes): Header bytes received from the peer
+        expected_type (FRAME_TYPES): Frame type the caller is waiting for
+
+    Returns:
+        int | None: Payload length, or None if the header is not acceptable
+    """
+    if len(header) < FRAME_HEADER.size:
+        # Connection closed before a whole header arrived
+        return None
+
+    magic, version, frame_type, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        print("Error decoding response: bad frame header")
+        return None
+    if version > PROTOCOL_VERSION:
+        print(f"Error decoding response: unsupported protocol version {version}")
+        return None
+    if frame_type != expected_type.value:
+        print(f"Error decoding response: unexpected frame type {frame_type}")
+        return None
+    if length > MAX_FRAME_SIZE:
+        print(f"Error decoding response: frame of {length} bytes is too large")
+        return None
+    return length
+
+def decode_message(data: bytes) -> dict:
+    """Decode a JSON message
+
+    Args:
+        data (bytes): Encoded message
+
+    Returns:
+        dict: The decoded message, or an empty dict if it is invalid
+    """
+    try:
+        message = json.loads(data)
+        return message
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        print("Error decoding response")
+        return {}
+
+def allow(sock: socket.socket, message="Approved", **fields):
+    """Sends an ALLOW packet
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Approved".
+        **fields: Extra fields to include in the packet
+    """
+    try:
+        send_message(sock, {
+            "status_code": STATUS_CODES.ALLOW.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending approval packet")
+        sock.close()
+        print("--Closed connection--")
+
+def reject(sock: socket.socket, message="Rejected", **fields):
+    """Sends a REJECT packet
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Rejected".
+        **fields: Extra fields to include in the packet
+    """
+    try:
+        send_message(sock, {
+            "status_code": STATUS_CODES.DENY.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending rejection packet")
+        sock.close()
+        print("--Closed connection--")
+
+# Non-blocking variants of the helpers above, for use with the asyncio server.
+# These expect a socket that has been put into non-blocking mode and drive it
+# through the running event loop, so many transfers can be in flight at once.
+
+async def async_send_file(sock: socket.socket, filename: str, fast=False, offset=0, length=None,
+                          compression=None, cached=None, metrics: dict = None, throttle=None) -> bool:
+    """Sends a file, or a byte range of it, to a non-blocking socket connection
+
+    Args:
+        sock (socket.socket): Socket to send file through
+        filename (str): Name of local file to be sent
+        fast (bool, optional): Stream the data straight after the header instead of
+            waiting for the multi-step handshake. Defaults to False.
+        offset (int, optional): First byte to send. Defaults to 0.
+        length (int, optional): Number of bytes to send, or None for the rest of
+            the file. Defaults to None.
+        compression (list[str], optional): Codecs the client accepts, the data is
+            compressed with the first supported one if it is worth it. Defaults to None.
+        cached (CachedFile, optional): The file's data and mtime_ns already held in
+            memory, sent instead of reading the file. Defaults to None.
+        metrics (dict, optional): Filled in with the "bytes" and "wire_bytes" sent and
+            the "handshake" seconds spent waiting for approval. Defaults to None.
+        throttle (_type_, optional): Awaited with the number of bytes in each chunk before
+            it is sent, to hold the transfer to a rate limit. Defaults to None.
+
+    Returns:
+        bool: Whether the client confirmed it received the whole file
+    """
+    metrics = {} if metrics is None else metrics
+    file_size = len(cached.data) if cached is not None else get_file_size(filename)
+    if file_size < 0:
+        await async_reject(sock, "File does not exist")
+        print("Error: Invalid content length")
+        return False
+
+    if offset < 0 or offset > file_size:
+        await async_reject(sock, "Offset is outside the file")
+        return False
+
+    content_length = file_size - offset
+    if length is not None:
+        content_length = max(0, min(length, content_length))
+
+    try:
+        print(f"Requesting to send {filename}")
+        with io.BytesIO(cached.data) if cached is not None else open(filename, "rb") as f:
+            mtime_ns = cached.mtime_ns if cached is not None else os.fstat(f.fileno()).st_mtime_ns
+            codec = choose_codec(f, offset, content_length, negotiate_codec(compression))
+            if fast:
+                # Let the header share its segment with the first of the data
+                set_cork(sock, True)
+            await async_send_message(sock, {
+                "type": REQ_TYPES.PUT.value,
+                "filename": filename,
+                "content_length": content_length,
+                "offset": offset,
+                "file_size": file_size,
+                "mtime_ns": mtime_ns,
+                "fast": fast,
+                "compression": codec
+            })
+
+            if fast:
+                # Fast path: the data follows the header without waiting for approval
+                status_code = STATUS_CODES.ALLOW.value
+            else:
+                handshake_start = time.monotonic()
+                message = await async_get_response(sock)
+                status_code = message.get("status_code")
+                metrics["handshake"] = time.monotonic() - handshake_start
+
+            if status_code == STATUS_CODES.ALLOW.value:
+                if not fast:
+                    # First we acknowledge that we are going to send the file
+                    set_cork(sock, True)
+                    await async_allow(sock, "File approval acknowledged. Sending file...")
+                print(f"Sending {filename}...")
+                # Then we send the file
+                f.seek(offset)
+                if codec:
+                    wire_length = await async_send_compressed_data(sock, f, content_length, codec,
+                                                                   throttle)
+                    print(f"Compressed {content_length} bytes to {wire_length} with {codec}")
+                else:
+                    wire_length = await async_send_file_data(sock, f, content_length, throttle=throttle)
+                set_cork(sock, False)
+                metrics["bytes"] = content_length if codec else wire_length
+                metrics["wire_bytes"] = wire_length
+
+                message = await async_get_response(sock)
+                status_code = message.get("status_code")
+
+                if status_code == STATUS_CODES.ALLOW.value:
+                    print("File sent successfully")
+                    return True
+                print(f"Error sending file: {message.get('message')}")
+            else:
+                print(f"Remote error: {message.get('message')}")
+    except FileNotFoundError:
+        print("File not found")
+    except socket.error as e:
+        print("Error sending packet:")
+        print(e)
+        sock.close()
+        print("--Closed connection--")
+    return False
+
+async def async_send_file_data(sock: socket.socket, f, content_length: int, use_sendfile=True,
+                               throttle=None) -> int:
+    """Send the contents of an open file over a non-blocking socket, using sendfile if possible
+
+    Args:
+        sock (socket.socket): Non-blocking socket to send the data through
+        f (_type_): File object opened in binary mode, positioned at the start of the data
+        content_length (int): Number of bytes to send
+        use_sendfile (bool, optional): Allow the sendfile path. Defaults to True.
+        throttle (_type_, optional): Awaited with the number of bytes in each chunk before
+            it is sent, to hold the transfer to a rate limit. Defaults to None.
+
+    Returns:
+        int: Number of bytes sent
+    """
+    loop = asyncio.get_running_loop()
+
+    if content_length == 0:
+        return 0
+
+    timeout = SOCKET_TIMEOUTS.get(sock)
+    # Data goes out a chunk at a time when each chunk has to wait for its turn, or
+    # has to arrive within the socket's timeout
+    chunked = throttle is not None or timeout is not None
+
+    if isinstance(f, io.BytesIO):
+        # Already in memory, send it without copying. getvalue() gives back the bytes
+        # the BytesIO was made from, and unlike getbuffer() a view of them doesn't stop
+        # the BytesIO closing if a failed send leaves the view referenced.
+        start = f.tell()
+        data = memoryview(f.getvalue())[start:start + content_length]
+        sizer = ChunkSizer(len(data), DATA_BUFFER)
+        bytes_sent = 0
+        while bytes_sent < len(data):
+            count = min(sizer.size, len(data) - bytes_sent) if chunked else len(data)
+            if throttle is not None:
+                await throttle(count)
+            async with asyncio.timeout(timeout):
+                await loop.sock_sendall(sock, data[bytes_sent:bytes_sent + count])
+            bytes_sent += count
+            sizer.update(count)
+        f.seek(start + bytes_sent)
+        return bytes_sent
+
+    if use_sendfile:
+        try:
+            if not chunked:
+                return await loop.sock_sendfile(sock, f, f.tell(), content_length, fallback=False)
+            # One sendfile call per chunk
+            sizer = ChunkSizer(content_length, DATA_BUFFER)
+            bytes_sent = 0
+            while bytes_sent < content_length:
+                count = min(sizer.size, content_length - bytes_sent)
+                if throttle is not None:
+                    await throttle(count)
+                async with asyncio.timeout(timeout):
+                    sent = await loop.sock_sendfile(sock, f, f.tell(), count, fallback=False)
+                if not sent:
+                    break
+                bytes_sent += sent
+                sizer.update(sent)
+            return bytes_sent
+        except asyncio.SendfileNotAvailableError:
+            pass
+
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    bytes_sent = 0
+    while bytes_sent < content_length:
+        view = sizer.view()
+        read = f.readinto(view[:content_length - bytes_sent])
+        if not read:
+            break
+        if throttle is not None:
+            await throttle(read)
+        async with asyncio.timeout(timeout):
+            await loop.sock_sendall(sock, view[:read])
+        bytes_sent += read
+        sizer.update(read)
+    return bytes_sent
+
+async def async_send_compressed_data(sock: socket.socket, f, content_length: int, codec: str,
+                                     throttle=None) -> int:
+    """Compress the contents of an open file as it is sent over a non-blocking socket
+
+    Compression runs in a worker thread, so other connections are served meanwhile.
+
+    Args:
+        sock (socket.socket): Non-blocking socket to send the data through
+        f (_type_): File object opened in binary mode, positioned at the start of the data
+        content_length (int): Number of uncompressed bytes to send
+        codec (str): Codec to compress the data with
+        throttle (_type_, optional): Awaited with the number of compressed bytes in each
+            chunk before it is sent, to hold the transfer to a rate limit. Defaults to None.
+
+    Returns:
+        int: Number of compressed bytes sent
+    """
+    compressor = get_compressor(codec)
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    bytes_read = 0
+    wire_length = 0
+    while bytes_read < content_length:
+        view = sizer.view()
+        read = f.readinto(view[:content_length - bytes_read])
+        if not read:
+            break
+        bytes_read += read
+        data = await asyncio.to_thread(compressor.compress, view[:read])
+        if throttle is not None and data:
+            await throttle(len(data))
+        wire_length += await async_send_data_frames(sock, data)
+        sizer.update(read)
+    data = compressor.flush()
+    if throttle is not None and data:
+        await throttle(len(data))
+    wire_length += await async_send_data_frames(sock, data)
+    # An empty frame marks the end of the data
+    async with asyncio.timeout(SOCKET_TIMEOUTS.get(sock)):
+        await asyncio.get_running_loop().sock_sendall(sock, encode_frame(FRAME_TYPES.DATA, b""))
+    return wire_length
+
+async def async_send_data_frames(sock: socket.socket, data: bytes) -> int:
+    """Send some data over a non-blocking socket as DATA frames no bigger than MAX_FRAME_SIZE
+
+    Args:
+        sock (socket.socket): Non-blocking socket to send the data through
+        data (bytes): Data to send, nothing is sent if it is empty
+
+    Returns:
+        int: Number of bytes of data sent
+    """
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(data), MAX_FRAME_SIZE):
+        async with asyncio.timeout(SOCKET_TIMEOUTS.get(sock)):
+            await loop.sock_sendall(sock, encode_frame(FRAME_TYPES.DATA,
+                                                       data[start:start + MAX_FRAME_SIZE]))
+    return len(data)
+
+async def async_send_archive(sock: socket.socket, filenames: list[str], metrics: dict = None,
+                             throttle=None) -> bool:
+    """Stream many files over a non-blocking socket as a single archive
+
+    Each file is sent as a PUT header followed by its data, with no handshake in
+    between. A final ALLOW marks the end of the archive, and the receiver's ALLOW
+    confirms it.
+
+    Args:
+        sock (socket.socket): Socket to send the files through
+        filenames (list[str]): Names of the local files to send
+        metrics (dict, optional): Filled in with the "bytes" of file data sent. Defaults to None.
+        throttle (_type_, optional): Awaited with the number of bytes in each chunk before
+            it is sent, to hold the transfer to a rate limit. Defaults to None.
+
+    Returns:
+        bool: Whether the receiver confirmed it got the whole archive
+    """
+    metrics = {} if metrics is None else metrics
+    metrics["bytes"] = 0
+    sent = 0
+    # Small files' headers and data are packed into full segments until the end
+    set_cork(sock, True)
+    for filename in filenames:
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            # Removed since the request was matched, skip it
+            continue
+
+        with f:
+            content_length = os.fstat(f.fileno()).st_size
+            await async_send_message(sock, {
+                "type": REQ_TYPES.PUT.value,
+                "filename": filename,
+                "content_length": content_length
+            })
+            bytes_sent = await async_send_file_data(sock, f, content_length, throttle=throttle)
+            metrics["bytes"] += bytes_sent
+            if bytes_sent != content_length:
+                # The file shrank while being sent, the receiver can't recover from that
+                print(f"Error: {filename} changed while being sent")
+                sock.close()
+                return False
+        sent += 1
+
+    await async_allow(sock, "Archive complete", count=sent)
+    set_cork(sock, False)
+    message = await async_get_response(sock)
+    if message.get("status_code") == STATUS_CODES.ALLOW.value:
+        print(f"Archive of {sent} files sent successfully")
+        return True
+    print(f"Error sending archive: {message.get('message')}")
+    return False
+
+async def async_receive_file(sock: socket.socket, filename: str, content_length, use_mmap=False,
+                             offset=0, publish_as=None, compression=None, metrics: dict = None,
+                             progress=None, throttle=None) -> bool:
+    """Receive a file from a non-blocking socket connection
+
+    If the transfer is interrupted the data received so far is kept, so it can be
+    resumed from where it stopped.
+
+    Args:
+        sock (socket.socket): Socket to receive file over
+        filename (str): Name of the file to be received
+        content_length (_type_): Size in bytes of the data to be received
+        use_mmap (bool, optional): Receive straight into a memory map of the file. Defaults to False.
+        offset (int, optional): Position in the file the data starts at. Defaults to 0.
+        publish_as (str | Callable, optional): Name to rename the file to once it is
+            complete, before the transfer is acknowledged, or a function to call with the
+            file's name to publish it instead. Defaults to None.
+        compression (str, optional): Codec the data is compressed with, or None if it
+            is sent as it is. Defaults to None.
+        metrics (dict, optional): Filled in with the "bytes" of file data and the
+            "wire_bytes" received. Defaults to None.
+        progress (_type_, optional): Called with the number of bytes in each chunk.
+            Defaults to None.
+        throttle (_type_, optional): Awaited with the number of bytes in each chunk after
+            it is received, to hold the transfer to a rate limit. Defaults to None.
+
+    Returns:
+        bool: Whether the whole file was received
+    """
+    metrics = {} if metrics is None else metrics
+    with mark_mapped(filename, use_mmap), open_for_receive(filename, offset) as f:
+        preallocate(f, content_length, offset)
+        bytes_received = 0
+
+        def count(received):
+            nonlocal bytes_received
+            bytes_received += received
+            if progress is not None:
+                progress(received)
+
+        try:
+            if compression:
+                wire_length = await async_receive_compressed_data(sock, f, content_length,
+                                                                  compression, count, offset,
+                                                                  throttle)
+            else:
+                wire_length = await async_receive_file_data(sock, f, content_length, count,
+                                                            use_mmap, offset, throttle)
+        except IOError:
+            print("Error writing data to file")
+            sock.close()
+            # Keep what arrived, so a retry only has to move the missing bytes
+            f.truncate(offset + bytes_received)
+            return False
+        except BaseException:
+            # Cut off by a deadline, shutdown or Ctrl-C, what arrived can still be resumed from
+            f.truncate(offset + bytes_received)
+            raise
+        finally:
+            metrics["bytes"] = metrics["wire_bytes"] = bytes_received
+    metrics["wire_bytes"] = wire_length
+
+    if callable(publish_as):
+        await asyncio.to_thread(publish_as, filename)
+    elif publish_as is not None:
+        os.replace(filename, publish_as)
+
+    print("File transfer complete")
+
+    # We tell the connection we have successfully received the file
+    await async_allow(sock, "File transfer complete", wire_length=wire_length)
+    return True
+
+async def async_receive_file_data(sock: socket.socket, f, content_length: int, progress=None,
+                                  use_mmap=False, offset=0, throttle=None) -> int:
+    """Receive file data from a non-blocking socket without allocating per chunk
+
+    Args:
+        sock (socket.socket): Non-blocking socket to receive from
+        f (_type_): File object opened for reading and writing
+        content_length (int): Number of bytes to receive
+        progress (_type_, optional): Called with the number of bytes in each chunk. Defaults to None.
+        use_mmap (bool, optional): Receive straight into a memory map of the file. Defaults to False.
+        offset (int, optional): Position in the file to write the data at. Defaults to 0.
+        throttle (_type_, optional): Awaited with the number of bytes in each chunk after
+            it is received, to hold the transfer to a rate limit. Defaults to None.
+
+    Raises:
+        IOError: Raised if the connection closes before all the data arrives
+
+    Returns:
+        int: Number of bytes received
+    """
+    loop = asyncio.get_running_loop()
+
+    if content_length == 0:
+        return 0
+
+    sizer = ChunkSizer(content_length, DATA_BUFFER)
+    if use_mmap:
+        # The mapped range has to be backed by the file, so it is sized up front. The
+        # caller cuts it back to the data that arrived if the transfer stops short.
+        if os.fstat(f.fileno()).st_size < offset + content_length:
+            f.truncate(offset + content_length)
+        # Mappings have to start on an allocation boundary
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(f.fileno(), offset + content_length - start, offset=start)
+        mapped = memoryview(mapping)[offset - start:]
+    else:
+        mapping = None
+        f.seek(offset)
+
+    timeout = SOCKET_TIMEOUTS.get(sock)
+    bytes_received = 0
+    try:
+        while bytes_received < content_length:
+            remaining = content_length - bytes_received
+            if mapping is not None:
+                with mapped[bytes_received:bytes_received + sizer.size] as chunk:
+                    async with asyncio.timeout(timeout):
+                        received = await loop.sock_recv_into(sock, chunk)
+            else:
+                view = sizer.view()
+                async with asyncio.timeout(timeout):
+                    received = await loop.sock_recv_into(sock, view[:remaining])
+                f.write(view[:received])
+
+            if not received:
+                print("--Connection closed unexpectedly--")
+                raise IOError("Connection closed unexpectedly")
+
+            bytes_received += received
+            sizer.update(received)
+            if progress is not None:
+                progress(received)
+            if throttle is not None:
+                # Not reading meanwhile lets TCP flow control slow the sender down
+                await throttle(received)
+    finally:
+        if mapping is not None:
+            mapped.release()
+            mapping.close()
+
+    return bytes_received
+
+async def async_receive_compressed_data(sock: socket.socket, f, content_length: int, codec: str,
+                                        progress=None, offset=0, throttle=None) -> int:
+    """Receive compressed file data from a non-blocking socket and write it out decompressed
+
+    Args:
+        sock (socket.socket): Non-blocking socket to receive from
+        f (_type_): File object opened for writing
+        content_length (int): Number of uncompressed bytes expected
+        codec (str): Codec the data is compressed with
+        progress (_type_, optional): Called with the number of uncompressed bytes in each
+            chunk. Defaults to None.
+        offset (int, optional): Position in the file to write the data at. Defaults to 0.
+        throttle (_type_, optional): Awaited with the number of compressed bytes in each
+            frame after it is received, to hold the transfer to a rate limit. Defaults to None.
+
+    Raises:
+        IOError: Raised if the connection closes early or the data doesn't decompress
+            to content_length bytes
+
+    Returns:
+        int: Number of compressed bytes received
+    """
+    decompressor = get_decompressor(codec)
+    f.seek(offset)
+    bytes_received = 0
+    wire_length = 0
+    while True:
+        length = parse_frame_header(await async_recv_exactly(sock, FRAME_HEADER.size), FRAME_TYPES.DATA)
+        if length == 0:
+            break
+        data = await async_recv_exactly(sock, length) if length is not None else b""
+        if length is None or len(data) < length:
+            print("--Connection closed unexpectedly--")
+            raise IOError("Connection closed unexpectedly")
+        wire_length += length
+        if throttle is not None:
+            await throttle(length)
+
+        chunks = decompress_chunks(decompressor, data)
+        while True:
+            # One chunk at a time, so memory stays bounded however well the data compressed
+            try:
+                chunk = await asyncio.to_thread(next, chunks, None)
+            except DECOMPRESS_ERRORS as e:
+                print(f"Error decompressing data: {e}")
+                raise IOError("Invalid compressed data")
+            if chunk is None:
+                break
+            if bytes_received + len(chunk) > content_length:
+                print("Error: compressed data is longer than expected")
+                raise IOError("More data than expected")
+            f.write(chunk)
+            bytes_received += len(chunk)
+            if progress is not None:
+                progress(len(chunk))
+
+    if bytes_received != content_length:
+        print("Error: compressed data ended early")
+        raise IOError("Compressed data ended early")
+    return wire_length
+
+async def async_receive_delta(sock: socket.socket, base: str, filename: str, block_size: int,
+                              content_length: int, digest: str, publish_as=None,
+                              metrics: dict = None) -> bool:
+    """Rebuild a file from a delta against another version of it
+
+    The delta is applied to a separate file, which only replaces anything once it is
+    complete and matches the digest the client sent.
+
+    Args:
+        sock (socket.socket): Socket to receive the delta over
+        base (str): Name of the version the delta was computed against
+        filename (str): Name of the file to rebuild into
+        block_size (int): Block size of the signatures the client was sent
+        content_length (int): Size in bytes of the new version
+        digest (str): SHA-256 hex digest of the new version
+        publish_as (str | Callable, optional): Name to rename the file to once it is
+            complete, before the transfer is acknowledged, or a function to call with the
+            file's name to publish it instead. Defaults to None.
+        metrics (dict, optional): Filled in with the "bytes" of the file rebuilt and the
+            "wire_bytes" of delta received. Defaults to None.
+
+    Returns:
+        bool: Whether the file was rebuilt
+    """
+    metrics = {} if metrics is None else metrics
+    base_file = open(base, "rb") if os.path.isfile(base) else None
+    base_size = os.fstat(base_file.fileno()).st_size if base_file else 0
+    position = wire_length = 0
+
+    try:
+        with open(filename, "w+b") as f:
+            preallocate(f, content_length)
+            while True:
+                length = parse_frame_header(await async_recv_exactly(sock, FRAME_HEADER.size),
+                                            FRAME_TYPES.DATA)
+                if length == 0:
+                    break
+                data = await async_recv_exactly(sock, length) if length is not None else b""
+                if length is None or len(data) < length:
+                    print("--Connection closed unexpectedly--")
+                    raise IOError("Connection closed unexpectedly")
+                wire_length += length
+
+                if data[:1] == DELTA_COPY and len(data) == 1 + COPY_RUN.size:
+                    first, count = COPY_RUN.unpack_from(data, 1)
+                    start = first * block_size
+                    size = min(count * block_size, base_size - start)
+                    if base_file is None or size <= 0 or position + size > content_length:
+                        raise IOError("Invalid block reference")
+                    await asyncio.to_thread(copy_range, base_file.fileno(), f.fileno(), start,
+                                            position, size)
+                elif data[:1] == DELTA_LITERAL:
+                    size = len(data) - 1
+                    if position + size > content_length:
+                        raise IOError("More data than expected")
+                    os.pwrite(f.fileno(), memoryview(data)[1:], position)
+                else:
+                    raise IOError("Invalid delta instruction")
+                position += size
+
+            f.seek(0)
+            if position != content_length:
+                raise IOError("Delta ended early")
+            if await asyncio.to_thread(lambda: hashlib.file_digest(f, "sha256").hexdigest()) != digest:
+                await async_reject(sock, "Rebuilt file does not match digest")
+                os.remove(filename)
+                return False
+    except IOError as e:
+        print(f"Error applying delta: {e}")
+        sock.close()
+        if os.path.exists(filename):
+            os.remove(filename)
+        return False
+    finally:
+        metrics["bytes"] = position
+        metrics["wire_bytes"] = wire_length
+        if base_file is not None:
+            base_file.close()
+
+    if callable(publish_as):
+        await asyncio.to_thread(publish_as, filename)
+    elif publish_as is not None:
+        os.replace(filename, publish_as)
+
+    print(f"Delta applied, {wire_length} bytes received for a {content_length} byte file")
+    await async_allow(sock, "File transfer complete", wire_length=wire_length)
+    return True
+
+async def async_send_listing(sock: socket.socket, files=None, next_cursor=None):
+    """Send a list of files over a non-blocking socket, by default those in the local directory
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        files (list, optional): Page of the listing to send. Defaults to None.
+        next_cursor (list, optional): Cursor for the page after this one, or None
+            if this is the last page. Defaults to None.
+    """
+    if files is None:
+        files = [name for name in os.listdir(".") if not name.endswith(PARTIAL_SUFFIX)]
+    try:
+        print("Sending directory listing")
+        await async_send_message(sock, {
+            "status_code": STATUS_CODES.ALLOW.value,
+            "message": "File listing message",
+            "files": files,
+            "next_cursor": next_cursor
+        })
+    except socket.error:
+        print("Error sending directory listing")
+        sock.close()
+        print("--Closed connection--")
+    else:
+        print("Successfully sent directory listing")
+
+async def async_get_response(sock: socket.socket) -> dict:
+    """Receive a packet from a non-blocking socket and decode the JSON
+
+    Args:
+        sock (socket.socket): Socket to be received from
+
+    Raises:
+        ServerBusyError: Raised if the server turned the request away as it is overloaded
+
+    Returns:
+        dict: A dictionary corresponding to the JSON data
+    """
+    if sock in LEGACY_SOCKETS:
+        return check_busy(await async_get_legacy_message(sock))
+
+    header = await async_recv_exactly(sock, FRAME_HEADER.size)
+    if header.startswith(b"{"):
+        # Bare JSON from a peer using the original unframed protocol
+        LEGACY_SOCKETS.add(sock)
+        return check_busy(await async_get_legacy_message(sock, header))
+
+    length = parse_frame_header(header, FRAME_TYPES.MESSAGE)
+    if length is None:
+        return {}
+    return check_busy(decode_message(await async_recv_exactly(sock, length)))
+
+async def async_get_legacy_message(sock: socket.socket, prefix: bytes = b"") -> dict:
+    """Receive one unframed JSON message from a non-blocking socket without consuming
+    any data sent after it
+
+    Args:
+        sock (socket.socket): Socket to be received from
+        prefix (bytes, optional): Start of the message, already received. Defaults to b"".
+
+    Returns:
+        dict: A dictionary corresponding to the JSON data
+    """
+    data = prefix + await async_recv_peek(sock, RECV_BUFFER - len(prefix))
+    end = find_message_end(data)
+    if end is None:
+        end = len(data)
+    await async_recv_exactly(sock, end - len(prefix))
+    return decode_message(data[:end])
+
+async def async_recv_peek(sock: socket.socket, length: int) -> bytes:
+    """Look at up to length bytes waiting on a non-blocking socket without consuming them
+
+    Args:
+        sock (socket.socket): Socket to be received from
+        length (int): Maximum number of bytes to look at
+
+    Returns:
+        bytes: The data waiting on the socket
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return sock.recv(length, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        readable = loop.create_future()
+        loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            async with asyncio.timeout(SOCKET_TIMEOUTS.get(sock)):
+                await readable
+        finally:
+            loop.remove_reader(sock.fileno())
+
+async def async_send_message(sock: socket.socket, message: dict):
+    """Encode a message as JSON and send it over a non-blocking socket
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (dict): Message to be sent
+    """
+    loop = asyncio.get_running_loop()
+    payload = json.dumps(message).encode()
+    async with asyncio.timeout(SOCKET_TIMEOUTS.get(sock)):
+        if sock in LEGACY_SOCKETS:
+            await loop.sock_sendall(sock, payload.ljust(RECV_BUFFER))
+        else:
+            await loop.sock_sendall(sock, encode_frame(FRAME_TYPES.MESSAGE, payload))
+
+async def async_recv_exactly(sock: socket.socket, length: int) -> bytes:
+    """Receive exactly length bytes from a non-blocking socket, or fewer if it closes first
+
+    Args:
+        sock (socket.socket): Socket to be received from
+        length (int): Number of bytes to receive
+
+    Returns:
+        bytes: The data received
+    """
+    loop = asyncio.get_running_loop()
+    timeout = SOCKET_TIMEOUTS.get(sock)
+    data = bytearray()
+    while len(data) < length:
+        async with asyncio.timeout(timeout):
+            chunk = await loop.sock_recv(sock, length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+async def async_allow(sock: socket.socket, message="Approved", **fields):
+    """Sends an ALLOW packet over a non-blocking socket
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Approved".
+        **fields: Extra fields to include in the packet
+    """
+    try:
+        await async_send_message(sock, {
+            "status_code": STATUS_CODES.ALLOW.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending approval packet")
+        sock.close()
+        print("--Closed connection--")
+
+async def async_not_modified(sock: socket.socket, message="Not modified", **fields):
+    """Sends a NOT MODIFIED packet over a non-blocking socket
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Not modified".
+        **fields: Extra fields to include in the packet
+    """
+    try:
+        await async_send_message(sock, {
+            "status_code": STATUS_CODES.NOT_MODIFIED.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending not modified packet")
+        sock.close()
+        print("--Closed connection--")
+
+async def async_reject(sock: socket.socket, message="Rejected", **fields):
+    """Sends a REJECT packet over a non-blocking socket
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Rejected".
+        **fields: Extra fields to include in the packet
+    """
+    try:
+        await async_send_message(sock, {
+            "status_code": STATUS_CODES.DENY.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending rejection packet")
+        sock.close()
+        print("--Closed connection--")
+
+async def async_busy(sock: socket.socket, message="Server busy", **fields):
+    """Sends a BUSY packet over a non-blocking socket, turning a request away under load
+
+    Args:
+        sock (socket.socket): Socket to be sent over
+        message (str, optional): Message to be sent. Defaults to "Server busy".
+        **fields: Extra fields to include in the packet, retry_after giving the seconds
+            the client should wait before trying again
+    """
+    try:
+        await async_send_message(sock, {
+            "status_code": STATUS_CODES.BUSY.value,
+            "message": message,
+            **fields
+        })
+    except socket.error:
+        print("Error sending busy packet")
+        sock.close()
+        print("--Closed connection--")
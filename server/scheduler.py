@@ -0,0 +1,207 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import contextmanager
+from typing import Iterator
+
+# Seconds of traffic at its full rate a token bucket saves up while idle, so short
+# bursts go out at once while the average stays at the limit
+BURST_TIME = 0.25
+# Transfers are scheduled ahead of all others until they have moved this many bytes,
+# so small files keep a low latency while big transfers are running
+PRIORITY_BYTES = 1024 * 1024
+# Most bytes granted from the global bucket at once, so however big the chunks of
+# the data loops get, a transfer never waits behind more than this from any other
+GRANT_SIZE = 64 * 1024
+
+class TokenBucket:
+    """Rate limit of a stream of bytes
+
+    Chunks may be bigger than the bucket, so it is allowed to go into debt, and a
+    chunk only waits until the previous ones have been paid for.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        """
+        Args:
+            rate (float): Bytes per second
+            burst (float, optional): Most bytes saved up while idle. Defaults to
+                rate * BURST_TIME.
+        """
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate * BURST_TIME
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """
+        Returns:
+            float: Seconds until the bucket is out of debt, 0 if it can be spent from now
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, -self.tokens / self.rate)
+
+    def spend(self, amount: int):
+        """
+        Args:
+            amount (int): Number of bytes to take from the bucket
+        """
+        self.tokens -= amount
+
+    async def take(self, amount: int):
+        """Wait until the bucket is out of debt, then take some bytes from it
+
+        Args:
+            amount (int): Number of bytes to take
+        """
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.spend(amount)
+
+class Transfer:
+    """The data phase of one transfer, as seen by the scheduler"""
+
+    def __init__(self, scheduler: "TransferScheduler", bucket: TokenBucket = None):
+        """
+        Args:
+            scheduler (TransferScheduler): Scheduler the transfer belongs to
+            bucket (TokenBucket, optional): Rate limit shared by its client's transfers,
+                or None if clients aren't limited. Defaults to None.
+        """
+        self.scheduler = scheduler
+        self.bucket = bucket
+        self.moved = 0
+        self.finish = 0
+
+    async def throttle(self, amount: int):
+        """Wait until a chunk may be moved, passed to the data loops as their throttle
+
+        Args:
+            amount (int): Number of bytes in the chunk
+        """
+        if self.bucket is not None:
+            await self.bucket.take(amount)
+        if self.scheduler.bucket is not None:
+            await self.scheduler.grant(self, amount)
+
+class TransferScheduler:
+    """Rate limits and fair sharing of bandwidth between the transfers of a server
+
+    Each client's transfers share a token bucket, and every transfer's chunks go
+    through a global one. Chunks waiting for the global bucket are granted in
+    start-time fair queueing order, so transfers get equal shares of the bandwidth
+    whatever their chunk sizes, except that transfers which have moved less than
+    PRIORITY_BYTES go first.
+
+    Everything runs on the event loop, so no locking is needed.
+    """
+
+    def __init__(self, rate: float = None, client_rate: float = None):
+        """
+        Args:
+            rate (float, optional): Bytes per second of all transfers together, or None
+                for no limit. Defaults to None.
+            client_rate (float, optional): Bytes per second of each client's transfers
+                together, or None for no limit. Defaults to None.
+        """
+        self.bucket = TokenBucket(rate) if rate else None
+        self.client_rate = client_rate
+        # Client address -> [its token bucket, number of its active transfers]
+        self.clients = {}
+        self.waiting = []
+        self.order = itertools.count()
+        self.virtual_time = 0
+        self.dispatcher = None
+        self.granted = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any rate limit is set"""
+        return self.bucket is not None or bool(self.client_rate)
+
+    @contextmanager
+    def transfer(self, client: str) -> Iterator:
+        """Register a transfer for the duration of a with block
+
+        Args:
+            client (str): Address of the client
+
+        Yields:
+            Callable | None: Throttle to pass to the data loops, or None if nothing is
+                limited so they can run at full speed
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        entry = self.clients.get(client)
+        if entry is None:
+            bucket = TokenBucket(self.client_rate) if self.client_rate else None
+            entry = self.clients[client] = [bucket, 0]
+        entry[1] += 1
+        try:
+            yield Transfer(self, entry[0]).throttle
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                # Idle clients' buckets would be full again by their next transfer anyway
+                del self.clients[client]
+
+    async def grant(self, transfer: Transfer, amount: int):
+        """Queue a chunk for the global bucket and wait for its turn
+
+        Chunks bigger than GRANT_SIZE are granted a part at a time, taking their turn
+        with the other transfers' for each part.
+
+        Args:
+            transfer (Transfer): Transfer the chunk belongs to
+            amount (int): Number of bytes in the chunk
+        """
+        loop = asyncio.get_running_loop()
+        while amount > 0:
+            part = min(amount, GRANT_SIZE)
+            start = max(self.virtual_time, transfer.finish)
+            transfer.finish = start + part
+            bulk = transfer.moved >= PRIORITY_BYTES
+            turn = loop.create_future()
+            heapq.heappush(self.waiting, (bulk, start, next(self.order), part, turn))
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = asyncio.create_task(self.dispatch())
+            await turn
+            transfer.moved += part
+            amount -= part
+
+    async def dispatch(self):
+        """Hand out the global bucket's bytes to waiting chunks until none are left"""
+        while self.waiting:
+            delay = self.bucket.delay()
+            if delay > 0:
+                # Chunks that arrive meanwhile may go ahead of the current head
+                await asyncio.sleep(delay)
+                continue
+            _, start, _, amount, turn = heapq.heappop(self.waiting)
+            if turn.done():
+                # Its transfer was cancelled while it waited
+                continue
+            self.virtual_time = start
+            self.bucket.spend(amount)
+            self.granted += amount
+            turn.set_result(None)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The limits, clients with active transfers, chunks waiting for the
+                global bucket and the bytes granted from it
+        """
+        return {
+            "rate": self.bucket.rate if self.bucket is not None else None,
+            "client_rate": self.client_rate,
+            "clients": len(self.clients),
+            "transfers": sum(count for _, count in self.clients.values()),
+            "waiting": len(self.waiting),
+            "granted": self.granted
+        }
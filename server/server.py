@@ -1,73 +1,1102 @@
 import socket
+import asyncio
+import argparse
+import signal
 import os
-import sys
-from protocol_utils import send_file, receive_file, REQ_TYPES, allow, reject, get_response, send_listing
+import glob
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from typing import Iterator
+from protocol_utils import (REQ_TYPES, LEGACY_SOCKETS, DATA_BUFFER, PARTIAL_SUFFIX, async_send_file,
+                            async_receive_file, async_allow, async_reject, async_get_response,
+                            async_send_listing, async_send_archive, is_safe_path,
+                            async_receive_delta, async_not_modified, async_busy, SOCKET_TIMEOUTS,
+                            resumable_size)
+from workers import WorkerSupervisor
+from listing_index import ListingIndex, SORT_FIELDS
+from compression import negotiate_codec
+from delta import choose_block_size, file_signatures
+from content_store import ContentStore, OBJECT_DIR
+from digest_cache import DigestCache
+from telemetry import Telemetry, OUTCOMES, write_stats
+from file_cache import FileCache, FILE_CACHE_SIZE, NOT_CACHEABLE
+from tuning import tune_socket
+from scheduler import TransferScheduler
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks uploads are only kept apart within each worker
+    fcntl = None
 
 HOST = "0.0.0.0"
-PORT = sys.argv[1]
 FILENAME_MAX_LENGTH = 32
+MAX_CONNECTIONS = 100
+# Most connections served at once from one client address
+MAX_CONNECTIONS_PER_IP = 32
+# Seconds a new connection has to send its first request
+HANDSHAKE_TIMEOUT = 10
+# Seconds a session may sit between requests before the server closes it
+IDLE_TIMEOUT = 60
+# Seconds each send or receive during a request may wait for the client, so one
+# that stops reading or sending part way through can't hold its connection forever
+STALL_TIMEOUT = 30
+# Seconds clients turned away as busy are asked to wait before trying again
+BUSY_RETRY_AFTER = 1
+# Rejected fast-path uploads up to this size are read and discarded so the session
+# survives; larger ones are aborted by closing the connection
+FAST_REJECT_DRAIN = 1024 * 1024
+# Deltas are rebuilt into "<filename>.<random>.delta.part", apart from the partial file
+# a resumable upload of the same name may still be using. Ending in PARTIAL_SUFFIX
+# keeps it out of listings like any other unfinished upload.
+DELTA_SUFFIX = ".delta" + PARTIAL_SUFFIX
+# Largest LIST page the server will send
+MAX_LIST_PAGE = 10000
+# Seconds in-flight transfers are given to finish when the server is stopped
+SHUTDOWN_GRACE = 10
+# Seconds between writes of the stats file, when one is given
+STATS_INTERVAL = 10
 
-def main():
+def create_listening_socket(port: int, reuse_port: bool = False) -> socket.socket:
+    """Create a non-blocking socket listening on all interfaces
 
+    Args:
+        port (int): Port to listen on
+        reuse_port (bool, optional): Set SO_REUSEPORT so several processes can
+            bind the same port. Defaults to False.
+
+    Returns:
+        socket.socket: The listening socket
+    """
     srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    srv_sock.bind(("", int(sys.argv[1])))
+    srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    srv_sock.bind(("", port))
+    srv_sock.listen(socket.SOMAXCONN)
+    srv_sock.setblocking(False)
+    return srv_sock
+
+class FileServer:
+    """Asyncio server that handles many client connections concurrently"""
+
+    def __init__(self, port: int, max_connections: int = MAX_CONNECTIONS, use_mmap: bool = False,
+                 idle_timeout: float = IDLE_TIMEOUT, content_store: bool = False,
+                 cache_size: int = FILE_CACHE_SIZE, stats_file: str = None,
+                 socket_buffer: int = None, rate_limit: float = None, client_rate_limit: float = None,
+                 max_per_ip: int = MAX_CONNECTIONS_PER_IP, handshake_timeout: float = HANDSHAKE_TIMEOUT,
+                 stall_timeout: float = STALL_TIMEOUT, request_timeout: float = None):
+        """
+        Args:
+            port (int): Port to listen on
+            max_connections (int, optional): Maximum number of connections served
+                at once, any more are turned away as busy. Defaults to MAX_CONNECTIONS.
+            use_mmap (bool, optional): Write uploads through a memory map of the
+                file. Defaults to False.
+            idle_timeout (float, optional): Seconds a session may sit between
+                requests. Defaults to IDLE_TIMEOUT.
+            content_store (bool, optional): Keep file contents in a ContentStore, so
+                identical files share disk space and uploads of content the server
+                already holds skip their data phase. Defaults to False.
+            cache_size (int, optional): Bytes of small, frequently downloaded files to
+                serve from memory, 0 disables the cache. Defaults to FILE_CACHE_SIZE.
+            stats_file (str, optional): File to keep a JSON dump of the server's metrics
+                in. Defaults to None.
+            socket_buffer (int, optional): Kernel send and receive buffer size of each
+                connection, None leaves them to the kernel's autotuning. Defaults to None.
+            rate_limit (float, optional): Bytes per second of all transfers together,
+                shared fairly between them. Defaults to None.
+            client_rate_limit (float, optional): Bytes per second of each client
+                address's transfers together. Defaults to None.
+            max_per_ip (int, optional): Maximum number of connections served at once
+                from one client address, 0 for no limit. Defaults to MAX_CONNECTIONS_PER_IP.
+            handshake_timeout (float, optional): Seconds a new connection has to send
+                its first request. Defaults to HANDSHAKE_TIMEOUT.
+            stall_timeout (float, optional): Seconds each send or receive during a
+                request may wait for the client, 0 to wait indefinitely. Defaults to
+                STALL_TIMEOUT.
+            request_timeout (float, optional): Seconds a whole request, transfer
+                included, may take, or None for no limit. Defaults to None.
+        """
+        self.port = port
+        self.max_connections = max_connections
+        self.use_mmap = use_mmap
+        self.idle_timeout = idle_timeout
+        self.max_per_ip = max_per_ip
+        self.handshake_timeout = handshake_timeout
+        self.stall_timeout = stall_timeout
+        self.request_timeout = request_timeout
+        self.digests = DigestCache()
+        self.listing = ListingIndex(".", self.digests)
+        self.store = ContentStore(".") if content_store else None
+        self.cache = FileCache(cache_size) if cache_size > 0 else None
+        self.telemetry = Telemetry()
+        self.stats_file = stats_file
+        self.socket_buffer = socket_buffer
+        self.scheduler = TransferScheduler(rate_limit, client_rate_limit)
+        # Connections being served, in total and by client address
+        self.connection_count = 0
+        self.connections = Counter()
+        # Connections being answered with BUSY
+        self.turning_away = 0
+        # Names with an upload in progress
+        self.uploading = set()
+
+    async def serve_forever(self, srv_sock: socket.socket = None):
+        """Accept connections and hand each one to its own task
+
+        Args:
+            srv_sock (socket.socket, optional): Listening socket to accept on. One is
+                created if not given. Defaults to None.
+        """
+        loop = asyncio.get_running_loop()
 
-    print(f"{HOST}:{PORT}")
-    print("Server up and running")
+        if srv_sock is None:
+            srv_sock = create_listening_socket(self.port)
 
-    srv_sock.listen(5)
+        # Let SIGTERM stop the server the same way Ctrl-C does
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
-    while True:
-        cli_sock, cli_addr = srv_sock.accept()
+        print(f"{HOST}:{self.port}")
+        print(f"Server {os.getpid()} up and running (max {self.max_connections} connections)")
+
+        tasks = set()
+        dumper = asyncio.create_task(self.dump_stats(self.stats_file)) if self.stats_file else None
+        try:
+            while True:
+                cli_sock, cli_addr = await loop.sock_accept(srv_sock)
+                # Replies are written as a header then data, which Nagle's algorithm
+                # would hold back waiting for the client's delayed ACK
+                tune_socket(cli_sock, self.socket_buffer)
+                reason = self.admission_refusal(cli_addr)
+                if reason is None:
+                    self.connection_count += 1
+                    self.connections[cli_addr[0]] += 1
+                    task = asyncio.create_task(self.handle_client(cli_sock, cli_addr))
+                elif self.turning_away < self.max_connections:
+                    # Rejected straight away rather than left queueing, so the
+                    # connections that are admitted keep their latency
+                    task = asyncio.create_task(self.turn_away(cli_sock, cli_addr, reason))
+                else:
+                    # Too many even to answer, the client just sees the connection close
+                    cli_sock.close()
+                    continue
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except asyncio.CancelledError:
+            # Stop accepting, then give in-flight transfers a chance to finish
+            srv_sock.close()
+            if tasks:
+                print(f"Waiting for {len(tasks)} transfers to finish")
+                await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE)
+            if dumper is not None:
+                dumper.cancel()
+                write_stats(self.stats_file, self.stats(recent=True))
+
+    async def handle_client(self, cli_sock: socket.socket, cli_addr):
+        """Serve requests from a client connection until it closes or goes idle
+
+        Clients using the framed protocol may send any number of requests over one
+        connection. Legacy clients get a single request, as before.
+
+        Args:
+            cli_sock (socket.socket): Socket connected to the client
+            cli_addr (_type_): Address of the client
+        """
         print(f"Connection from {cli_addr}")
+        cli_sock.setblocking(False)
+        # The first request has to come quickly, so idle connections can't pile up
+        timeout = self.handshake_timeout
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(async_get_response(cli_sock), timeout)
+                except asyncio.TimeoutError:
+                    print(f"{cli_addr} idle for {timeout}s, closing session")
+                    break
+                timeout = self.idle_timeout
+
+                if not request:
+                    # Client closed the session
+                    break
+
+                await self.handle_request(cli_sock, cli_addr, request)
+
+                if cli_sock in LEGACY_SOCKETS or cli_sock.fileno() == -1:
+                    break
+
+        except OSError as e:
+            print(f"Connection error with {cli_addr}: {e}")
+        finally:
+            cli_sock.close()
+            print(f"--Closed connection to {cli_addr}--")
+            self.connection_count -= 1
+            self.connections[cli_addr[0]] -= 1
+            if not self.connections[cli_addr[0]]:
+                del self.connections[cli_addr[0]]
 
-        request = get_response(cli_sock)
+    def admission_refusal(self, cli_addr):
+        """Check whether a new connection can be served
+
+        Args:
+            cli_addr (_type_): Address of the client
+
+        Returns:
+            str | None: Why the connection has to be turned away, or None if it can be served
+        """
+        if self.connection_count >= self.max_connections:
+            return "Server busy"
+        if self.max_per_ip and self.connections[cli_addr[0]] >= self.max_per_ip:
+            return "Too many connections from your address"
+        return None
+
+    async def turn_away(self, cli_sock: socket.socket, cli_addr, reason: str):
+        """Answer a connection the server has no room for with BUSY, then close it
+
+        The request is read first, so the client gets the reply rather than a reset
+        connection, and a fast-path upload's data is dealt with as for any rejected upload.
+
+        Args:
+            cli_sock (socket.socket): Socket connected to the client
+            cli_addr (_type_): Address of the client
+            reason (str): Why it is turned away
+        """
+        print(f"Turning {cli_addr} away: {reason}")
+        cli_sock.setblocking(False)
+        SOCKET_TIMEOUTS[cli_sock] = self.handshake_timeout
+        self.turning_away += 1
+        started = time.monotonic()
+        request = {}
+        try:
+            request = await asyncio.wait_for(async_get_response(cli_sock), self.handshake_timeout)
+            if request.get("type") == REQ_TYPES.PUT.value:
+                await self.reject_upload(cli_sock, request, reason, async_busy,
+                                         retry_after=BUSY_RETRY_AFTER)
+            elif request:
+                await async_busy(cli_sock, reason, retry_after=BUSY_RETRY_AFTER)
+        except OSError:
+            pass
+        finally:
+            self.turning_away -= 1
+            cli_sock.close()
+            if request:
+                self.telemetry.record(request_kind(request), request.get("filename"), OUTCOMES.BUSY,
+                                      time.monotonic() - started)
+
+    async def handle_request(self, cli_sock: socket.socket, cli_addr, request: dict):
+        """Serve a single request and record its metrics
+
+        Args:
+            cli_sock (socket.socket): Socket connected to the client
+            cli_addr (_type_): Address of the client
+            request (dict): The decoded request
+        """
+        started = time.monotonic()
+        metrics = {}
+        outcome = OUTCOMES.FAILED
+        self.telemetry.in_flight += 1
+        if self.stall_timeout:
+            SOCKET_TIMEOUTS[cli_sock] = self.stall_timeout
+        try:
+            async with asyncio.timeout(self.request_timeout) as deadline:
+                outcome = await self.serve_request(cli_sock, cli_addr, request, metrics)
+        except TimeoutError:
+            if not deadline.expired():
+                # A send or receive stalled, which ends the session like any socket error
+                raise
+            print(f"{cli_addr} request took over {self.request_timeout}s, closing session")
+            outcome = OUTCOMES.TIMED_OUT
+            cli_sock.close()
+        finally:
+            # Waiting for the next request is bounded by the idle timeout instead
+            SOCKET_TIMEOUTS.pop(cli_sock, None)
+            self.telemetry.in_flight -= 1
+            self.telemetry.record(request_kind(request), request.get("filename"), outcome,
+                                  time.monotonic() - started, metrics)
+
+    async def serve_request(self, cli_sock: socket.socket, cli_addr, request: dict,
+                            metrics: dict) -> OUTCOMES:
+        """Serve a single request
+
+        Args:
+            cli_sock (socket.socket): Socket connected to the client
+            cli_addr (_type_): Address of the client
+            request (dict): The decoded request
+            metrics (dict): Filled in with the bytes moved and handshake time of a transfer
+
+        Returns:
+            OUTCOMES: How the request ended
+        """
         req_type = request.get("type")
 
-        if req_type == REQ_TYPES.GET.value:
+        problem = check_transfer_fields(request)
+        if problem is not None:
+            print(f"{cli_addr} sent an invalid request: {problem}")
+            if req_type == REQ_TYPES.PUT.value:
+                await self.reject_upload(cli_sock, request, problem)
+            else:
+                await async_reject(cli_sock, problem)
+            return OUTCOMES.REJECTED
+
+        if req_type == REQ_TYPES.GET.value and request.get("filenames"):
+            print(f"{cli_addr} wants an archive of {' '.join(request['filenames'])}")
+            with self.scheduler.transfer(cli_addr[0]) as throttle:
+                return await self.send_archive(cli_sock, request["filenames"], metrics, throttle)
+
+        elif req_type == REQ_TYPES.GET.value:
             filename = request.get("filename")
             print(f"{cli_addr} wants to download {filename}")
-            send_file(cli_sock, filename)
+            stat = await self.get_unmodified_stat(filename, request)
+            if stat is not None:
+                print(f"{filename} not modified")
+                await async_not_modified(cli_sock, "File not modified", file_size=stat.st_size,
+                                         mtime_ns=stat.st_mtime_ns)
+                return OUTCOMES.NOT_MODIFIED
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(filename)
+                if cached is NOT_CACHEABLE:
+                    cached = None
+                elif cached is None:
+                    cached = await asyncio.to_thread(self.cache.load, filename)
+            with self.scheduler.transfer(cli_addr[0]) as throttle:
+                sent = await async_send_file(cli_sock, filename, request.get("fast", False),
+                                             request.get("offset") or 0, request.get("length"),
+                                             request.get("compression"), cached, metrics, throttle)
+            return OUTCOMES.OK if sent else OUTCOMES.FAILED
 
         elif req_type == REQ_TYPES.PUT.value:
             filename = request.get("filename")
             content_length = request.get("content_length")
             if len(filename) > FILENAME_MAX_LENGTH:
-                reject(cli_sock, "Filename exceeds max length")
+                await self.reject_upload(cli_sock, request, "Filename exceeds max length")
+                return OUTCOMES.REJECTED
             print(f"{cli_addr} wants to upload {filename}")
-            try:
-                with open(filename, "xb") as f:
-                    accept_file(cli_sock, filename, content_length)     
-            except FileExistsError:
-                print("Error: file already exists, cannot overwrite")
-                reject(cli_sock, "Cannot overwrite remote file")
+            if request.get("delta"):
+                # Deltas are how an existing file is replaced, so instead of the overwrite
+                # check only a regular file may be replaced
+                if os.path.islink(filename) or (os.path.lexists(filename)
+                                                and not os.path.isfile(filename)):
+                    print(f"Error: {filename} is not a regular file, cannot replace")
+                    await async_reject(cli_sock, "Can only replace a regular file")
+                    return OUTCOMES.REJECTED
+                with self.reserve_upload(filename) as reserved:
+                    if not reserved:
+                        print(f"Error: {filename} is already being uploaded")
+                        await async_reject(cli_sock, "File is already being uploaded")
+                        return OUTCOMES.REJECTED
+                    received = await self.accept_delta(cli_sock, filename, request, metrics)
+                return OUTCOMES.OK if received else OUTCOMES.FAILED
+            codec = request.get("compression")
+            if codec and negotiate_codec([codec]) is None:
+                await self.reject_upload(cli_sock, request, f"Unsupported compression {codec}")
+                return OUTCOMES.REJECTED
+            with self.reserve_upload(filename) as reserved:
+                if not reserved:
+                    print(f"Error: {filename} is already being uploaded")
+                    await self.reject_upload(cli_sock, request, "File is already being uploaded")
+                    return OUTCOMES.REJECTED
+                if os.path.exists(filename):
+                    print("Error: file already exists, cannot overwrite")
+                    await self.reject_upload(cli_sock, request, "Cannot overwrite remote file")
+                    return OUTCOMES.REJECTED
+
+                if (self.store is not None and not request.get("fast")
+                        and await asyncio.to_thread(self.store.link, request.get("digest"), filename,
+                                                    content_length)):
+                    # The content is already held, so the upload is complete without any data
+                    print(f"{filename} deduplicated")
+                    self.file_changed(filename)
+                    await async_allow(cli_sock, "File already stored", stored=True)
+                    return OUTCOMES.DEDUPLICATED
+
+                # Data goes into a partial file that is kept if the upload is interrupted
+                partial = filename + PARTIAL_SUFFIX
+                partial_size = resumable_size(partial)
+                if request.get("resume"):
+                    offset = min(partial_size, content_length)
+                else:
+                    offset = request.get("offset") or 0
+                    if offset not in (0, partial_size):
+                        await self.reject_upload(cli_sock, request,
+                                                 "Offset does not match partial upload",
+                                                 offset=partial_size)
+                        return OUTCOMES.REJECTED
+
+                with self.scheduler.transfer(cli_addr[0]) as throttle:
+                    if request.get("fast"):
+                        received = await self.accept_file_fast(cli_sock, filename, content_length,
+                                                               offset, codec, request.get("mtime_ns"),
+                                                               metrics, throttle)
+                    else:
+                        received = await self.accept_file(cli_sock, filename, content_length, offset,
+                                                          codec, request.get("mtime_ns"), metrics,
+                                                          throttle)
+                return OUTCOMES.OK if received else OUTCOMES.FAILED
 
         elif req_type == REQ_TYPES.LIST.value:
             print(f"{cli_addr} wants directory listing")
-            send_listing(cli_sock)
+            return await self.serve_listing(cli_sock, request)
+
+        elif req_type == REQ_TYPES.SYNC.value:
+            print(f"{cli_addr} wants to sync")
+            return await self.serve_sync(cli_sock, request)
+
+        elif req_type == REQ_TYPES.STATS.value:
+            print(f"{cli_addr} wants server stats")
+            await async_allow(cli_sock, "Server stats", stats=self.stats())
+            return OUTCOMES.OK
+
+        await async_reject(cli_sock, "Unknown request type")
+        return OUTCOMES.REJECTED
+
+    @contextmanager
+    def reserve_upload(self, filename: str) -> Iterator[bool]:
+        """Reserve a name for one upload at a time, for the duration of a with block
+
+        Besides being noted in the server's own set, the partial file is locked, so
+        workers sharing the directory can't receive into it or publish it at once.
+
+        Args:
+            filename (str): Name the upload is published under
+
+        Yields:
+            bool: Whether the name was reserved, False if another upload has it
+        """
+        if filename in self.uploading:
+            yield False
+            return
+
+        partial = filename + PARTIAL_SUFFIX
+        fd = None
+        if fcntl is not None:
+            while True:
+                fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    yield False
+                    return
+                # The partial file may have been published or removed before the lock
+                # was taken, in which case the lock is on a file no longer under its name
+                try:
+                    if os.path.samestat(os.fstat(fd), os.stat(partial)):
+                        break
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+
+        self.uploading.add(filename)
+        try:
+            yield True
+        finally:
+            self.uploading.discard(filename)
+            if fd is not None:
+                try:
+                    # Don't leave behind an empty partial file that the lock created
+                    stat = os.fstat(fd)
+                    if not stat.st_size and os.path.samestat(stat, os.stat(partial)):
+                        os.remove(partial)
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+
+    async def get_unmodified_stat(self, filename: str, request: dict):
+        """Check whether a conditional GET's description of the client's copy still matches
+
+        Args:
+            filename (str): Name of the requested file
+            request (dict): The GET request
+
+        Returns:
+            os.stat_result | None: The file's stat if the client's copy is the same, or
+                None if the file has to be sent
+        """
+        if "if_size" not in request or request.get("offset"):
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if stat.st_size != request["if_size"]:
+            return None
+
+        if request.get("if_digest"):
+            try:
+                digest = await asyncio.to_thread(self.digests.get, filename)
+            except OSError:
+                return None
+            return stat if digest == request["if_digest"] else None
+        if request.get("if_mtime_ns") is not None:
+            return stat if stat.st_mtime_ns == request["if_mtime_ns"] else None
+        return None
+
+    async def accept_file(self, sock: socket.socket, filename: str, content_length: int, offset: int = 0,
+                          compression: str = None, mtime_ns: int = None, metrics: dict = None,
+                          throttle=None) -> bool:
+        """Accept a file upload request
+
+        Args:
+            sock (socket.socket): Socket to accept file from
+            filename (str): Name of the file to accept
+            content_length (int): Size in bytes of the file
+            offset (int, optional): Position to resume the upload from. Defaults to 0.
+            compression (str, optional): Codec the data is compressed with. Defaults to None.
+            mtime_ns (int, optional): Modification time to give the file. Defaults to None.
+            metrics (dict, optional): Filled in with the bytes received and the handshake
+                time. Defaults to None.
+            throttle (_type_, optional): Rate limit of the data, from the scheduler.
+                Defaults to None.
+
+        Returns:
+            bool: Whether the whole file was received
+        """
+        metrics = {} if metrics is None else metrics
+
+        print("File upload approved")
+        handshake_start = time.monotonic()
+        await async_allow(sock, "File upload approved", offset=offset)
+
+        # Now we expect acknowledgement
+        acknowledgement = await async_get_response(sock)
+        metrics["handshake"] = time.monotonic() - handshake_start
+        if acknowledgement.get("status_code") == "000":
+            if await async_receive_file(sock, filename + PARTIAL_SUFFIX, content_length - offset,
+                                        self.use_mmap, offset, publish_as=self.publisher(filename, mtime_ns),
+                                        compression=compression, metrics=metrics, throttle=throttle):
+                self.file_changed(filename)
+                return True
+        return False
+
+    async def accept_file_fast(self, sock: socket.socket, filename: str, content_length: int,
+                               offset: int = 0, compression: str = None, mtime_ns: int = None,
+                               metrics: dict = None, throttle=None) -> bool:
+        """Accept a fast-path file upload, whose data follows the request straight away
+
+        Args:
+            sock (socket.socket): Socket to accept file from
+            filename (str): Name of the file to accept
+            content_length (int): Size in bytes of the file
+            offset (int, optional): Position the client is sending from. Defaults to 0.
+            compression (str, optional): Codec the data is compressed with. Defaults to None.
+            mtime_ns (int, optional): Modification time to give the file. Defaults to None.
+            metrics (dict, optional): Filled in with the bytes received. Defaults to None.
+            throttle (_type_, optional): Rate limit of the data, from the scheduler.
+                Defaults to None.
+
+        Returns:
+            bool: Whether the whole file was received
+        """
+        print("File upload approved")
+
+        if await async_receive_file(sock, filename + PARTIAL_SUFFIX, content_length - offset,
+                                    self.use_mmap, offset, publish_as=self.publisher(filename, mtime_ns),
+                                    compression=compression, metrics=metrics, throttle=throttle):
+            self.file_changed(filename)
+            return True
+        return False
+
+    async def accept_delta(self, sock: socket.socket, filename: str, request: dict,
+                           metrics: dict = None) -> bool:
+        """Accept an upload sent as a delta against the current copy of the file
+
+        Args:
+            sock (socket.socket): Socket the request came in on
+            filename (str): Name of the file to replace
+            request (dict): The upload request
+            metrics (dict, optional): Filled in with the bytes rebuilt and received.
+                Defaults to None.
+
+        Returns:
+            bool: Whether the file was replaced
+        """
+        base_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        block_size = choose_block_size(base_size)
+        signatures = await asyncio.to_thread(file_signatures, filename, block_size) if base_size else []
+
+        print(f"Delta upload approved, {len(signatures)} block signatures")
+        await async_allow(sock, "Delta upload approved", block_size=block_size, base_size=base_size,
+                          signatures=signatures)
+
+        rebuilt = f"{filename}.{os.urandom(4).hex()}{DELTA_SUFFIX}"
+        try:
+            if await async_receive_delta(sock, filename, rebuilt, block_size,
+                                         request.get("content_length"), request.get("digest"),
+                                         publish_as=self.publisher(filename, request.get("mtime_ns")),
+                                         metrics=metrics):
+                self.file_changed(filename)
+                return True
+            return False
+        finally:
+            # Only still there if the delta wasn't applied
+            if os.path.exists(rebuilt):
+                os.remove(rebuilt)
+
+    def file_changed(self, filename: str):
+        """Bring the listing and the file cache up to date after a file is published
+
+        Args:
+            filename (str): Name of the file
+        """
+        self.listing.update(filename)
+        if self.cache is not None:
+            self.cache.invalidate(filename)
+
+    def publisher(self, filename: str, mtime_ns: int = None):
+        """Get how a completed upload is published under its name
+
+        Args:
+            filename (str): Name the upload is published under
+            mtime_ns (int, optional): Modification time the client asked the file to
+                have. Defaults to None.
+
+        Returns:
+            str | Callable: The name to rename the upload to, or a function that publishes
+                it given its current name
+        """
+        if self.store is None and mtime_ns is None:
+            return filename
+        return partial(self.publish, name=filename, mtime_ns=mtime_ns)
+
+    def publish(self, path: str, name: str, mtime_ns: int = None):
+        """Publish a completed upload, run in a worker thread
+
+        Args:
+            path (str): Where the upload was received
+            name (str): Name to publish it under
+            mtime_ns (int, optional): Modification time to give it. Content the store
+                already held keeps its own. Defaults to None.
+        """
+        if mtime_ns is not None:
+            os.utime(path, ns=(time.time_ns(), mtime_ns))
+        if self.store is not None:
+            self.store.store(path, name)
+        else:
+            os.replace(path, name)
 
-        cli_sock.close()
+    async def send_archive(self, sock: socket.socket, names: list[str], metrics: dict = None,
+                           throttle=None) -> OUTCOMES:
+        """Send every file matched by a multi-file GET as one archive
 
+        Args:
+            sock (socket.socket): Socket the request came in on
+            names (list[str]): File names, directories or glob patterns
+            metrics (dict, optional): Filled in with the bytes sent. Defaults to None.
+            throttle (_type_, optional): Rate limit of the data, from the scheduler.
+                Defaults to None.
 
-def accept_file(sock: socket.socket, filename: str, content_length: int):
-    """Accept a file upload request
+        Returns:
+            OUTCOMES: How the request ended
+        """
+        unsafe = [name for name in names if not is_safe_path(name)]
+        if unsafe:
+            await async_reject(sock, f"Invalid path {unsafe[0]}")
+            return OUTCOMES.REJECTED
+
+        filenames = await asyncio.to_thread(expand_archive_request, names)
+        if not filenames:
+            await async_reject(sock, "No matching files")
+            return OUTCOMES.REJECTED
+
+        print(f"Sending archive of {len(filenames)} files")
+        sent = await async_send_archive(sock, filenames, metrics, throttle)
+        return OUTCOMES.OK if sent else OUTCOMES.FAILED
+
+    async def serve_listing(self, sock: socket.socket, request: dict) -> OUTCOMES:
+        """Send one page of the directory listing from the index
+
+        Args:
+            sock (socket.socket): Socket the request came in on
+            request (dict): The LIST request
+
+        Returns:
+            OUTCOMES: How the request ended
+        """
+        if self.listing.needs_refresh():
+            await asyncio.to_thread(self.listing.refresh)
+
+        sort = request.get("sort") or "name"
+        if sort not in SORT_FIELDS:
+            await async_reject(sock, f"Cannot sort by {sort}")
+            return OUTCOMES.REJECTED
+
+        # Requests without a limit come from legacy clients, which expect everything
+        limit = request.get("limit")
+        if limit is not None:
+            try:
+                limit = max(1, min(int(limit), MAX_LIST_PAGE))
+            except (TypeError, ValueError, OverflowError):
+                await async_reject(sock, f"Invalid limit {limit}")
+                return OUTCOMES.REJECTED
+
+        try:
+            entries, next_cursor = self.listing.query(request.get("prefix") or "", sort,
+                                                      bool(request.get("reverse")),
+                                                      request.get("cursor"), limit)
+        except TypeError:
+            await async_reject(sock, "Invalid cursor")
+            return OUTCOMES.REJECTED
+
+        if request.get("detail"):
+            files = []
+            for entry in entries:
+                info = {"name": entry.name, "size": entry.size, "mtime": entry.mtime}
+                if request.get("digests"):
+                    info["digest"] = await asyncio.to_thread(self.listing.get_digest, entry.name)
+                files.append(info)
+        else:
+            files = [entry.name for entry in entries]
+
+        await async_send_listing(sock, files, next_cursor)
+        return OUTCOMES.OK
+
+    async def serve_sync(self, sock: socket.socket, request: dict) -> OUTCOMES:
+        """Compare a client's manifest with the served files and send back the sync plan
+
+        Args:
+            sock (socket.socket): Socket the request came in on
+            request (dict): The SYNC request
+
+        Returns:
+            OUTCOMES: How the request ended
+        """
+        files = request.get("files")
+        if not isinstance(files, list):
+            await async_reject(sock, "Invalid manifest")
+            return OUTCOMES.REJECTED
+
+        if self.listing.needs_refresh():
+            await asyncio.to_thread(self.listing.refresh)
+        entries, _ = self.listing.query()
+        plan = await asyncio.to_thread(plan_sync, files, [entry.name for entry in entries],
+                                       self.digests, bool(request.get("partial")))
+        await async_allow(sock, "Sync plan", **plan)
+        return OUTCOMES.OK
+
+    def stats(self, recent=False) -> dict:
+        """Get the server's transfer metrics and file cache counters
+
+        Args:
+            recent (bool, optional): Include the most recent transfers. Defaults to False.
+
+        Returns:
+            dict: Telemetry snapshot, with connection counts under "connections", the file
+                cache counters under "file_cache" and the rate limiting under "scheduler"
+        """
+        stats = self.telemetry.snapshot(recent)
+        stats["connections"] = {
+            "active": self.connection_count,
+            "max": self.max_connections,
+            "clients": len(self.connections),
+            "turning_away": self.turning_away
+        }
+        if self.cache is not None:
+            stats["file_cache"] = self.cache.stats()
+        if self.scheduler.enabled:
+            stats["scheduler"] = self.scheduler.stats()
+        return stats
+
+    async def dump_stats(self, path: str, interval: float = STATS_INTERVAL):
+        """Write the server's metrics to a file as JSON every so often, until cancelled
+
+        Args:
+            path (str): File to write
+            interval (float, optional): Seconds between writes. Defaults to STATS_INTERVAL.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(write_stats, path, self.stats(recent=True))
+            except OSError as e:
+                print(f"Error writing stats to {path}: {e}")
+
+    async def reject_upload(self, sock: socket.socket, request: dict, message: str, reply=async_reject,
+                            **fields):
+        """Reject an upload request
+
+        A fast-path client is already streaming the file, so its data has to be
+        discarded, or the connection aborted, for the rejection to be seen.
+
+        Args:
+            sock (socket.socket): Socket the request came in on
+            request (dict): The upload request
+            message (str): Reason for the rejection
+            reply (_type_, optional): Coroutine function sending the rejection. Defaults
+                to async_reject.
+            **fields: Extra fields to include in the rejection
+        """
+        if not request.get("fast"):
+            await reply(sock, message, **fields)
+            return
+
+        offset = request.get("offset") or 0
+        content_length = request.get("content_length") or 0
+        if is_count(content_length) and is_count(offset):
+            content_length -= offset
+        else:
+            # Nothing says how much data follows, so it can't be skipped
+            content_length = FAST_REJECT_DRAIN + 1
+        # Compressed data can't be skipped by length, so it is aborted as well
+        if content_length > FAST_REJECT_DRAIN or request.get("compression"):
+            await reply(sock, message, **fields)
+            sock.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        discard = bytearray(min(DATA_BUFFER, max(content_length, 1)))
+        remaining = content_length
+        while remaining > 0:
+            async with asyncio.timeout(SOCKET_TIMEOUTS.get(sock)):
+                received = await loop.sock_recv_into(sock, memoryview(discard)[:remaining])
+            if not received:
+                return
+            remaining -= received
+        await reply(sock, message, **fields)
+
+def is_count(value) -> bool:
+    """
+    Args:
+        value (_type_): A field of a request
+
+    Returns:
+        bool: Whether it is a whole number of bytes, 0 or more
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def check_transfer_fields(request: dict) -> str:
+    """Check the fields of a GET or PUT request have the types and ranges they are used as,
+    and that its file is inside the served directory
+
+    Args:
+        request (dict): The decoded request
+
+    Returns:
+        str | None: What is wrong with the first invalid field, or None if nothing is
+    """
+    req_type = request.get("type")
+    if req_type not in (REQ_TYPES.GET.value, REQ_TYPES.PUT.value):
+        return None
+
+    filenames = request.get("filenames")
+    if req_type == REQ_TYPES.GET.value and filenames is not None:
+        if not isinstance(filenames, list) or not all(isinstance(name, str) for name in filenames):
+            return "Invalid filenames"
+        if filenames:
+            return None
+
+    if not isinstance(request.get("filename"), str) or not request["filename"]:
+        return "Invalid filename"
+    if not is_safe_path(os.path.normpath(request["filename"])):
+        return f"Invalid path {request['filename']}"
+    for field in ("offset", "length"):
+        if request.get(field) is not None and not is_count(request[field]):
+            return f"Invalid {field}"
+
+    if req_type == REQ_TYPES.GET.value:
+        compression = request.get("compression")
+        if compression is not None and not (isinstance(compression, list)
+                                            and all(isinstance(codec, str) for codec in compression)):
+            return "Invalid compression"
+        return None
+
+    if not is_count(request.get("content_length")):
+        return "Invalid content_length"
+    if request.get("offset") is not None and request["offset"] > request["content_length"]:
+        return "Offset is past the end of the file"
+    if request.get("compression") is not None and not isinstance(request["compression"], str):
+        return "Invalid compression"
+    if request.get("mtime_ns") is not None and not isinstance(request["mtime_ns"], int):
+        return "Invalid mtime_ns"
+    return None
+
+def request_kind(request: dict) -> str:
+    """Name the kind of a request, for its metrics
+
+    Args:
+        request (dict): The decoded request
+
+    Returns:
+        str: The request type, with multi-file GETs as "archive" and delta PUTs as "delta"
+    """
+    req_type = request.get("type")
+    if req_type == REQ_TYPES.GET.value and request.get("filenames"):
+        return "archive"
+    if req_type == REQ_TYPES.PUT.value and request.get("delta"):
+        return "delta"
+    if req_type in {req.value for req in REQ_TYPES}:
+        return req_type
+    return "unknown"
+
+def plan_sync(files: list[dict], server_names: list[str], digests: DigestCache, partial=False) -> dict:
+    """Work out the transfers that bring a client's files and the served files in line
+
+    Files on only one side are copied to the other. Files on both are left alone if
+    their size matches and their modification time or digest does, otherwise the
+    more recently modified copy wins. When only the digest could tell, the client is
+    asked to check again with digests.
+
+    Args:
+        files (list[dict]): The client's manifest, with name, size, mtime_ns and
+            optionally digest for each file
+        server_names (list[str]): Names of the served files
+        digests (DigestCache): Cache to get the served files' digests from
+        partial (bool, optional): Only consider the files in the manifest. Defaults to False.
+
+    Returns:
+        dict: Lists of names to "get", "put" (new on the server), "replace" and "check",
+            and "same" mapping unchanged names to the server's mtime_ns
+    """
+    plan = {"get": [], "put": [], "replace": [], "check": [], "same": {}}
+    local = {file["name"]: file for file in files
+             if isinstance(file, dict) and isinstance(file.get("name"), str)}
+    served = set(server_names)
+    names = set(local) if partial else set(local) | served
+
+    for name in sorted(names):
+        file = local.get(name)
+        stat = None
+        if name in served:
+            try:
+                stat = os.stat(name)
+            except OSError:
+                pass
+        if stat is None:
+            if file is not None:
+                plan["put"].append(name)
+            continue
+        if file is None:
+            plan["get"].append(name)
+            continue
+
+        if stat.st_size == file.get("size"):
+            if stat.st_mtime_ns == file.get("mtime_ns"):
+                plan["same"][name] = stat.st_mtime_ns
+                continue
+            if not file.get("digest"):
+                plan["check"].append(name)
+                continue
+            try:
+                if digests.get(name) == file["digest"]:
+                    plan["same"][name] = stat.st_mtime_ns
+                    continue
+            except OSError:
+                pass
+
+        if (file.get("mtime_ns") or 0) > stat.st_mtime_ns:
+            plan["replace"].append(name)
+        else:
+            plan["get"].append(name)
+    return plan
+
+def expand_archive_request(names: list[str]) -> list[str]:
+    """Find the files matched by the names in a multi-file GET
+
+    Directories are walked recursively and names containing wildcards are matched
+    as glob patterns, with "**" matching any number of directories.
 
     Args:
-        sock (socket.socket): Socket to accept file from
-        filename (str): Name of the file to accept
-        content_length (int): Size in bytes of the file
+        names (list[str]): File names, directories or glob patterns
+
+    Returns:
+        list[str]: Matching file names in request order, without duplicates or
+            partial uploads
     """
-    
-    print("File upload approved")
-    allow(sock, "File upload approved")
-    
-    # Delete the file we just created to check its existence
-    os.remove(filename)
-    
-    # Now we expect acknowledgement
-    acknowledgement = get_response(sock)
-    if acknowledgement.get("status_code") == "000":    
-        receive_file(sock, filename, content_length)
+    filenames = {}
+    for name in names:
+        matches = glob.glob(name, recursive=True) if glob.has_magic(name) else [name]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs[:] = sorted(d for d in dirs if d != OBJECT_DIR)
+                    for file in sorted(files):
+                        filenames.setdefault(os.path.join(root, file))
+            elif os.path.isfile(match):
+                filenames.setdefault(match)
+
+    return [filename for filename in filenames
+            if not filename.endswith(PARTIAL_SUFFIX) and is_safe_path(os.path.normpath(filename))]
+
+def run_server(args: argparse.Namespace, srv_sock: socket.socket = None):
+    """Run a FileServer on a fresh event loop until it is stopped
+
+    Args:
+        args (argparse.Namespace): Parsed command line options
+        srv_sock (socket.socket, optional): Already listening socket to use. Defaults to None.
+    """
+    stats_file = args.stats_file
+    if stats_file and args.workers > 1:
+        # Each worker keeps its own metrics
+        stats_file = f"{stats_file}.{os.getpid()}"
+    server = FileServer(args.port, args.max_connections, args.mmap, args.idle_timeout, args.cas,
+                        args.cache_size, stats_file, args.socket_buffer, args.rate_limit,
+                        args.client_rate_limit, args.max_per_ip, args.handshake_timeout,
+                        args.stall_timeout, args.request_timeout)
+    try:
+        asyncio.run(server.serve_forever(srv_sock))
+    except KeyboardInterrupt:
+        pass
+    if server.cache is not None:
+        stats = server.cache.stats()
+        print(f"File cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['files']} files ({stats['bytes']} of {stats['max_bytes']} bytes) held")
+    print("Server shutting down")
+
+def main():
+    parser = argparse.ArgumentParser(description="SimPY File server")
+    parser.add_argument("port", type=int, help="Port to listen on")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Maximum number of connections served at once, per worker. Any "
+                             "more are told the server is busy")
+    parser.add_argument("--max-per-ip", type=int, default=MAX_CONNECTIONS_PER_IP,
+                        help="Maximum number of connections served at once from one client "
+                             "address, per worker, 0 for no limit")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes sharing the port")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Write uploads through a memory map of the file")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="Seconds a new connection has to send its first request")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="Seconds a session may sit between requests")
+    parser.add_argument("--stall-timeout", type=float, default=STALL_TIMEOUT,
+                        help="Seconds each send or receive during a request may wait for the "
+                             "client, 0 to wait indefinitely")
+    parser.add_argument("--request-timeout", type=float,
+                        help="Seconds a whole request, transfer included, may take")
+    parser.add_argument("--cas", action="store_true",
+                        help="Store file contents by hash, so duplicate uploads take no space or time")
+    parser.add_argument("--cache-size", type=int, default=FILE_CACHE_SIZE,
+                        help="Bytes of small, frequently downloaded files to serve from memory, "
+                             "0 to disable")
+    parser.add_argument("--stats-file",
+                        help="Keep a JSON dump of the server's transfer metrics in this file")
+    parser.add_argument("--socket-buffer", type=int,
+                        help="Kernel send and receive buffer size of each connection, for links "
+                             "the kernel's autotuning doesn't keep up with")
+    parser.add_argument("--rate-limit", type=float,
+                        help="Bytes per second of all transfers together, per worker, shared fairly "
+                             "between them with small transfers first")
+    parser.add_argument("--client-rate-limit", type=float,
+                        help="Bytes per second of each client address's transfers together, per worker")
+    args = parser.parse_args()
+
+    if args.cas:
+        # Done before any workers start, as one of them could be linking an object
+        removed = ContentStore(".").prune()
+        if removed:
+            print(f"Removed {removed} unreferenced objects from the content store")
+
+    if args.workers > 1:
+        supervisor = WorkerSupervisor(
+            args.port, args.workers,
+            lambda srv_sock: run_server(args, srv_sock),
+            create_listening_socket)
+        supervisor.run()
+    else:
+        run_server(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import bisect
+from collections import deque
+from enum import Enum
+
+# Upper bounds in seconds of the latency histogram buckets, slower requests go in a
+# final overflow bucket
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Number of the most recent transfers kept in full
+RECENT_TRANSFERS = 100
+
+class OUTCOMES(Enum):
+    OK = "ok"
+    NOT_MODIFIED = "not_modified"
+    DEDUPLICATED = "deduplicated"
+    REJECTED = "rejected"
+    FAILED = "failed"
+    BUSY = "busy"
+    TIMED_OUT = "timed_out"
+
+class Histogram:
+    """Counts of observed durations by latency bucket"""
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        """
+        Args:
+            bounds (tuple, optional): Upper bound of each bucket in seconds, in increasing
+                order. Defaults to LATENCY_BUCKETS.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        """Add a duration
+
+        Args:
+            seconds (float): The duration
+        """
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile from the buckets
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: Upper bound of the bucket holding the quantile, or the largest
+                duration seen if it is in the overflow bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: count, sum, mean, max, p50, p90 and p99 in seconds, and the bucket
+                counts keyed by upper bound ("inf" for the overflow bucket)
+        """
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": buckets
+        }
+
+class RequestStats:
+    """Aggregate counters of one kind of request"""
+
+    def __init__(self):
+        self.count = 0
+        self.outcomes = dict.fromkeys((outcome.value for outcome in OUTCOMES), 0)
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.transfer_time = 0.0
+        self.latency = Histogram()
+        self.handshake = Histogram()
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: Counters, the mean throughput in bytes per second of the data moved,
+                and the latency and handshake histograms
+        """
+        return {
+            "count": self.count,
+            "outcomes": dict(self.outcomes),
+            "bytes": self.bytes,
+            "wire_bytes": self.wire_bytes,
+            "throughput": self.bytes / self.transfer_time if self.transfer_time else 0.0,
+            "latency": self.latency.snapshot(),
+            "handshake": self.handshake.snapshot()
+        }
+
+class Telemetry:
+    """Per-request metrics and their running aggregates for one server process
+
+    Everything is updated from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, recent: int = RECENT_TRANSFERS):
+        """
+        Args:
+            recent (int, optional): Number of the most recent transfers to keep in
+                full. Defaults to RECENT_TRANSFERS.
+        """
+        self.started = time.time()
+        self.requests = {}
+        self.recent = deque(maxlen=recent)
+        self.in_flight = 0
+
+    def record(self, kind: str, filename: str, outcome: OUTCOMES, duration: float,
+               metrics: dict = None) -> dict:
+        """Record a finished request
+
+        Args:
+            kind (str): What the request was, e.g. "get", "put" or "list"
+            filename (str): File the request was for, if any
+            outcome (OUTCOMES): How the request ended
+            duration (float): Seconds from receiving the request to finishing it
+            metrics (dict, optional): "bytes" and "wire_bytes" of file data moved and
+                "handshake" seconds, as filled in by the transfer. Defaults to None.
+
+        Returns:
+            dict: The structured record of the request
+        """
+        metrics = metrics or {}
+        stats = self.requests.setdefault(kind, RequestStats())
+        stats.count += 1
+        stats.outcomes[outcome.value] += 1
+        stats.latency.observe(duration)
+
+        record = {"time": time.time(), "kind": kind, "filename": filename,
+                  "outcome": outcome.value, "duration": duration}
+        transferred = "bytes" in metrics
+        if transferred:
+            data_bytes = metrics["bytes"]
+            stats.bytes += data_bytes
+            stats.wire_bytes += metrics.get("wire_bytes", data_bytes)
+            stats.transfer_time += duration
+            record["bytes"] = data_bytes
+            record["wire_bytes"] = metrics.get("wire_bytes", data_bytes)
+            record["throughput"] = data_bytes / duration if duration else 0.0
+        if "handshake" in metrics:
+            stats.handshake.observe(metrics["handshake"])
+            record["handshake"] = metrics["handshake"]
+        if transferred:
+            self.recent.append(record)
+        return record
+
+    def snapshot(self, recent=False) -> dict:
+        """Get every aggregate as plain data
+
+        Args:
+            recent (bool, optional): Include the most recent transfers. Defaults to False.
+
+        Returns:
+            dict: Process id, uptime and in-flight count, and the stats of each kind of request
+        """
+        snapshot = {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "in_flight": self.in_flight,
+            "requests": {kind: stats.snapshot() for kind, stats in self.requests.items()}
+        }
+        if recent:
+            snapshot["recent"] = list(self.recent)
+        return snapshot
+
+def write_stats(path: str, stats: dict):
+    """Write a stats snapshot to a file as JSON, replacing it atomically
+
+    Args:
+        path (str): File to write
+        stats (dict): The snapshot
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(temporary, path)
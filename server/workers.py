@@ -0,0 +1,113 @@
+import socket
+import signal
+import os
+import time
+
+# A worker that dies sooner than this after starting is restarted with a delay,
+# so a worker that can never start (e.g. port in use) doesn't spin the supervisor
+RESTART_BACKOFF = 1.0
+
+class WorkerSupervisor:
+    """Forks worker processes that share one listening port and restarts any that die
+
+    If the platform supports SO_REUSEPORT every worker binds its own listening socket
+    and the kernel spreads incoming connections between them. Otherwise the supervisor
+    binds a single socket before forking and the workers all accept on it (pre-fork).
+    """
+
+    def __init__(self, port: int, workers: int, worker_main, create_socket):
+        """
+        Args:
+            port (int): Port the workers listen on
+            workers (int): Number of worker processes to keep running
+            worker_main (_type_): Called in each worker with its listening socket
+            create_socket (_type_): Called with (port, reuse_port) to create a listening socket
+        """
+        self.port = port
+        self.workers = workers
+        self.worker_main = worker_main
+        self.create_socket = create_socket
+        self.reuse_port = hasattr(socket, "SO_REUSEPORT")
+        self.shared_sock = None
+        self.children = {}
+        self.shutting_down = False
+
+    def run(self):
+        """Start the workers and supervise them until told to shut down"""
+        if not self.reuse_port:
+            self.shared_sock = self.create_socket(self.port, False)
+
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+
+        mode = "SO_REUSEPORT" if self.reuse_port else "pre-fork"
+        print(f"Supervisor {os.getpid()} starting {self.workers} workers ({mode})")
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id, started = self.children.pop(pid, (None, None))
+            if worker_id is None:
+                continue
+
+            if self.shutting_down:
+                print(f"Worker {worker_id} ({pid}) stopped")
+                continue
+
+            print(f"Worker {worker_id} ({pid}) died with status {status}, restarting")
+            if time.monotonic() - started < RESTART_BACKOFF:
+                time.sleep(RESTART_BACKOFF)
+            self.spawn(worker_id)
+
+        if self.shared_sock is not None:
+            self.shared_sock.close()
+        print("All workers stopped")
+
+    def spawn(self, worker_id: int):
+        """Fork a single worker process
+
+        Args:
+            worker_id (int): Index of the worker, kept across restarts
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Child: drop the supervisor's handlers so signals stop the event loop instead
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            exit_code = 0
+            try:
+                sock = self.shared_sock or self.create_socket(self.port, True)
+                self.worker_main(sock)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"Worker {worker_id} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self.children[pid] = (worker_id, time.monotonic())
+        print(f"Worker {worker_id} started with pid {pid}")
+
+    def shutdown(self, signum, frame):
+        """Signal handler that stops all workers
+
+        Args:
+            signum (_type_): Signal received
+            frame (_type_): Current stack frame
+        """
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+        print("Supervisor shutting down workers")
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
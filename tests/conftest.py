@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The client modules import each other by bare name, as they do when client.py is run
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+# Seconds to wait for a started server to accept connections
+SERVER_START_TIMEOUT = 10
+
+def free_port() -> int:
+    """
+    Returns:
+        int: A local TCP port nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def server_dir(tmp_path):
+    """Directory the server serves files from"""
+    path = tmp_path / "srv"
+    path.mkdir()
+    return path
+
+@pytest.fixture
+def client_dir(tmp_path, monkeypatch):
+    """Directory the client works in, made the current directory"""
+    path = tmp_path / "cli"
+    path.mkdir()
+    monkeypatch.chdir(path)
+    return path
+
+def start_server(directory, *args: str) -> tuple[subprocess.Popen, tuple[str, int]]:
+    """Start server.py on a free port and wait until it accepts connections
+
+    Args:
+        directory (_type_): Directory to serve
+        *args (str): Extra server command line options
+
+    Returns:
+        tuple[subprocess.Popen, tuple[str, int]]: The server process and its address
+    """
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server", "server.py"), str(port),
+                                *args],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, ("127.0.0.1", port)
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail("Server did not start")
+            time.sleep(0.05)
+
+@pytest.fixture
+def server(server_dir):
+    """Run server.py on a free port for the duration of a test
+
+    Yields:
+        tuple[str, int]: Address and port to connect to
+    """
+    process, address = start_server(server_dir)
+    try:
+        yield address
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,37 @@
+import socket
+import threading
+import time
+import pytest
+from protocol_utils import REQ_TYPES, send_message, get_response
+from file_client import Client
+
+def slow_size_server(listener: socket.socket, delay: float):
+    """Answer one size request on a listening socket after staying quiet for a while"""
+    sock, _ = listener.accept()
+    with sock:
+        get_response(sock)
+        time.sleep(delay)
+        send_message(sock, {"type": REQ_TYPES.PUT.value, "content_length": 0, "file_size": 1234})
+        get_response(sock)
+
+@pytest.fixture
+def listener():
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        # So a test that never connects doesn't leave its server thread waiting
+        sock.settimeout(5)
+        yield sock
+
+def test_connect_timeout_does_not_limit_operations(listener):
+    thread = threading.Thread(target=slow_size_server, args=(listener, 0.5))
+    thread.start()
+    with Client(*listener.getsockname(), timeout=0.1, progress=None) as client:
+        assert client.size("slow.bin") == 1234
+    thread.join()
+
+def test_operation_timeout(listener):
+    thread = threading.Thread(target=slow_size_server, args=(listener, 0.5))
+    thread.start()
+    with Client(*listener.getsockname(), progress=None, operation_timeout=0.1) as client:
+        with pytest.raises(TimeoutError):
+            client.size("slow.bin")
+    thread.join()
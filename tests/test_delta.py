@@ -0,0 +1,74 @@
+import io
+import os
+import socket
+from delta import choose_block_size, file_signatures, generate_delta
+from protocol_utils import STATUS_CODES, send_delta
+from test_uploads import request_upload
+
+def rebuild(old: bytes, ops) -> bytes:
+    """Apply the instructions of a delta to the version it was made against"""
+    block_size = choose_block_size(len(old))
+    parts = []
+    for kind, value in ops:
+        if kind == "copy":
+            parts.append(old[value * block_size:(value + 1) * block_size])
+        else:
+            parts.append(value)
+    return b"".join(parts)
+
+def make_delta(tmp_path, old: bytes, new: bytes) -> list[tuple]:
+    """Compute the delta of new against the signatures of old"""
+    path = tmp_path / "old.bin"
+    path.write_bytes(old)
+    block_size = choose_block_size(len(old))
+    signatures = file_signatures(str(path), block_size)
+    return list(generate_delta(io.BytesIO(new), block_size, signatures, len(old)))
+
+def test_unchanged_file_is_all_copies(tmp_path):
+    old = os.urandom(300_000)
+    ops = make_delta(tmp_path, old, old)
+    assert all(kind == "copy" for kind, _ in ops)
+    assert rebuild(old, ops) == old
+
+def test_insertion_is_sent_as_a_small_literal(tmp_path):
+    old = os.urandom(300_000)
+    new = old[:123_457] + b"inserted" + old[123_457:]
+    ops = make_delta(tmp_path, old, new)
+    literal = sum(len(value) for kind, value in ops if kind == "literal")
+    assert literal < 2 * choose_block_size(len(old))
+    assert rebuild(old, ops) == new
+
+def test_accept_delta_replaces_file(server, server_dir, client_dir):
+    old = os.urandom(400_000)
+    new = old[:200_000] + b"changed" + old[200_001:] + b"appended"
+    (server_dir / "doc.bin").write_bytes(old)
+    (client_dir / "doc.bin").write_bytes(new)
+
+    with socket.create_connection(server, timeout=10) as sock:
+        assert send_delta(sock, "doc.bin")
+
+    assert (server_dir / "doc.bin").read_bytes() == new
+    assert sorted(path.name for path in server_dir.iterdir()) == ["doc.bin"]
+
+def test_delta_outside_served_directory_is_rejected(server, server_dir, client_dir, monkeypatch):
+    # The client's ../victim.txt differs from the server's, so a delta would be sent
+    (server_dir.parent / "victim.txt").write_bytes(b"precious")
+    (client_dir / "victim.txt").write_bytes(b"pwned")
+    (client_dir / "sub").mkdir()
+    monkeypatch.chdir(client_dir / "sub")
+
+    with socket.create_connection(server, timeout=10) as sock:
+        assert not send_delta(sock, "../victim.txt")
+
+    assert (server_dir.parent / "victim.txt").read_bytes() == b"precious"
+
+def test_delta_during_upload_of_same_name_is_rejected(server, server_dir, client_dir):
+    (client_dir / "doc.bin").write_bytes(b"new contents")
+    upload, answer = request_upload(server, "doc.bin", 100)
+    with upload:
+        assert answer["status_code"] == STATUS_CODES.ALLOW.value
+        # A copy appearing mid-upload gives the delta something to be made against
+        (server_dir / "doc.bin").write_bytes(b"old contents")
+        with socket.create_connection(server, timeout=10) as sock:
+            assert not send_delta(sock, "doc.bin")
+        assert (server_dir / "doc.bin").read_bytes() == b"old contents"
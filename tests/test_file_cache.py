@@ -0,0 +1,13 @@
+from file_client import Client
+
+def test_large_files_bypass_the_cache(server, server_dir, client_dir):
+    (server_dir / "large.bin").write_bytes(bytes(5 * 1024 * 1024))
+    (server_dir / "small.txt").write_bytes(b"small")
+    with Client(*server, progress=None) as client:
+        for _ in range(2):
+            assert client.get("large.bin")
+            assert client.get("small.txt")
+        cache = client.stats()["file_cache"]
+    assert cache["misses"] == 1
+    assert cache["hits"] == 1
+    assert cache["files"] == 1
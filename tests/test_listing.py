@@ -0,0 +1,14 @@
+import socket
+import pytest
+from protocol_utils import REQ_TYPES, STATUS_CODES, send_message, get_response
+
+@pytest.mark.parametrize("limit", ["ten", [10], float("inf")])
+def test_invalid_limit_is_rejected(server, limit):
+    with socket.create_connection(server, timeout=10) as sock:
+        send_message(sock, {"type": REQ_TYPES.LIST.value, "limit": limit})
+        answer = get_response(sock)
+        assert answer["status_code"] == STATUS_CODES.DENY.value
+
+        # The session survives the rejection
+        send_message(sock, {"type": REQ_TYPES.LIST.value, "limit": 10})
+        assert get_response(sock)["status_code"] == STATUS_CODES.ALLOW.value
@@ -0,0 +1,56 @@
+import os
+from file_client import Client
+from multistream import MIN_STREAM_SIZE, download_parallel
+
+def test_empty_file_over_streams(server, server_dir, client_dir):
+    (server_dir / "empty.txt").write_bytes(b"")
+    with Client(*server, progress=None) as client:
+        assert client.get("empty.txt", streams=2)
+    assert (client_dir / "empty.txt").read_bytes() == b""
+
+def test_small_file_over_streams(server, server_dir, client_dir):
+    data = bytes(range(256)) * 100
+    (server_dir / "small.bin").write_bytes(data)
+    with Client(*server, progress=None) as client:
+        assert client.get("small.bin", streams=4)
+    assert (client_dir / "small.bin").read_bytes() == data
+
+def test_download_parallel_of_empty_file(server, server_dir, client_dir):
+    (server_dir / "empty.txt").write_bytes(b"")
+    assert download_parallel(*server, "empty.txt", 0, 2, progress=None)
+    assert (client_dir / "empty.txt").read_bytes() == b""
+
+def test_large_file_is_split(server, server_dir, client_dir):
+    data = bytes(range(256)) * (2 * MIN_STREAM_SIZE // 256 + 1000)
+    (server_dir / "large.bin").write_bytes(data)
+    with Client(*server, progress=None) as client:
+        assert client.get("large.bin", streams=2)
+    assert (client_dir / "large.bin").read_bytes() == data
+
+def test_large_file_gets_server_mtime(server, server_dir, client_dir):
+    data = bytes(range(256)) * (2 * MIN_STREAM_SIZE // 256 + 1000)
+    (server_dir / "large.bin").write_bytes(data)
+    os.utime(server_dir / "large.bin", ns=(0, 1_234_567_890_000_000_000))
+    with Client(*server, progress=None) as client:
+        assert client.get("large.bin", streams=2)
+    assert (client_dir / "large.bin").stat().st_mtime_ns == 1_234_567_890_000_000_000
+
+def test_update_over_streams_skips_unchanged_file(server, server_dir, client_dir):
+    size = 2 * MIN_STREAM_SIZE + 1000
+    (server_dir / "large.bin").write_bytes(b"s" * size)
+    # Same size and mtime but different contents, so only a skipped download leaves it as is
+    (client_dir / "large.bin").write_bytes(b"c" * size)
+    mtime_ns = (server_dir / "large.bin").stat().st_mtime_ns
+    os.utime(client_dir / "large.bin", ns=(0, mtime_ns))
+    with Client(*server, progress=None) as client:
+        assert client.get("large.bin", update=True, streams=2)
+    assert (client_dir / "large.bin").read_bytes() == b"c" * size
+
+def test_resume_over_streams_continues_partial_copy(server, server_dir, client_dir):
+    size = 2 * MIN_STREAM_SIZE + 1000
+    (server_dir / "large.bin").write_bytes(b"s" * size)
+    # A prefix that differs from the server's shows it was kept rather than downloaded again
+    (client_dir / "large.bin").write_bytes(b"c" * 1000)
+    with Client(*server, progress=None) as client:
+        assert client.get("large.bin", resume=True, streams=2)
+    assert (client_dir / "large.bin").read_bytes() == b"c" * 1000 + b"s" * (size - 1000)
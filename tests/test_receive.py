@@ -0,0 +1,27 @@
+import socket
+import threading
+import pytest
+from protocol_utils import preallocate, receive_file
+
+def test_preallocate_keeps_size(tmp_path):
+    with open(tmp_path / "file.bin", "w+b") as f:
+        f.write(b"start")
+        preallocate(f, 10_000_000, 5)
+    assert (tmp_path / "file.bin").stat().st_size == 5
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_interrupted_receive_keeps_only_what_arrived(tmp_path, use_mmap):
+    data = bytes(range(256)) * 4000
+    sender, receiver = socket.socketpair()
+
+    def send_part():
+        with sender:
+            sender.sendall(data[:300_000])
+
+    thread = threading.Thread(target=send_part)
+    thread.start()
+    path = tmp_path / "file.bin"
+    with receiver:
+        assert not receive_file(receiver, str(path), len(data), use_mmap)
+    thread.join()
+    assert path.read_bytes() == data[:300_000]
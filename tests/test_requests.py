@@ -0,0 +1,46 @@
+import socket
+import pytest
+from protocol_utils import REQ_TYPES, STATUS_CODES, send_message, get_response
+
+@pytest.mark.parametrize("request_fields", [
+    {"type": REQ_TYPES.GET.value},
+    {"type": REQ_TYPES.GET.value, "filename": ["file.txt"]},
+    {"type": REQ_TYPES.GET.value, "filename": "file.txt", "offset": "10"},
+    {"type": REQ_TYPES.GET.value, "filename": "file.txt", "length": -1},
+    {"type": REQ_TYPES.GET.value, "filename": "file.txt", "compression": "zlib"},
+    {"type": REQ_TYPES.GET.value, "filename": "file.txt", "compression": [["zlib"]]},
+    {"type": REQ_TYPES.GET.value, "filenames": "."},
+    {"type": REQ_TYPES.GET.value, "filenames": [1, 2]},
+    {"type": REQ_TYPES.PUT.value, "content_length": 4},
+    {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": "4"},
+    {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": True},
+    {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": 4, "offset": 5},
+    {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": 4, "compression": 1},
+    {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": 4, "mtime_ns": "now"},
+])
+def test_invalid_fields_are_rejected(server, server_dir, request_fields):
+    (server_dir / "file.txt").write_bytes(b"data")
+    with socket.create_connection(server, timeout=10) as sock:
+        send_message(sock, request_fields)
+        assert get_response(sock)["status_code"] == STATUS_CODES.DENY.value
+
+        # The session survives the rejection
+        send_message(sock, {"type": REQ_TYPES.LIST.value, "limit": 10})
+        assert get_response(sock)["status_code"] == STATUS_CODES.ALLOW.value
+    assert not (server_dir / "new.txt").exists()
+
+def test_invalid_fast_upload_is_aborted(server, server_dir):
+    with socket.create_connection(server, timeout=10) as sock:
+        send_message(sock, {"type": REQ_TYPES.PUT.value, "filename": "new.txt", "content_length": "4",
+                            "fast": True})
+        sock.sendall(b"data")
+        # Nothing says where its data ends, so the session is ended
+        with pytest.raises((ConnectionResetError, EOFError)):
+            while sock.recv(4096):
+                pass
+            raise EOFError
+    assert not (server_dir / "new.txt").exists()
+
+    with socket.create_connection(server, timeout=10) as sock:
+        send_message(sock, {"type": REQ_TYPES.LIST.value, "limit": 10})
+        assert get_response(sock)["status_code"] == STATUS_CODES.ALLOW.value
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+import threading
+import pytest
+from conftest import ROOT, start_server
+from protocol_utils import PARTIAL_SUFFIX
+from file_client import Client
+
+SIZE = 20_000_000
+# Slow enough that a transfer is still running when its peer is killed
+RATE = str(10_000_000)
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.02)
+
+@pytest.mark.parametrize("mmap_option", [[], ["--mmap"]])
+def test_put_resumes_after_server_is_killed(server_dir, client_dir, mmap_option):
+    data = os.urandom(SIZE)
+    (client_dir / "x.bin").write_bytes(data)
+    partial = server_dir / ("x.bin" + PARTIAL_SUFFIX)
+
+    process, address = start_server(server_dir, "--rate-limit", RATE, *mmap_option)
+    with Client(*address, progress=None) as client:
+        upload = threading.Thread(target=client.put, args=("x.bin",), kwargs={"resume": True})
+        upload.start()
+        wait_for(lambda: partial.exists() and partial.stat().st_size > 0)
+        time.sleep(0.5)
+        process.kill()
+        process.wait()
+        upload.join()
+    assert not (server_dir / "x.bin").exists()
+
+    process, address = start_server(server_dir)
+    try:
+        with Client(*address, progress=None) as client:
+            assert client.put("x.bin", resume=True)
+    finally:
+        process.terminate()
+        process.wait()
+    assert (server_dir / "x.bin").read_bytes() == data
+
+def test_get_resumes_after_client_is_killed(server_dir, client_dir):
+    data = os.urandom(SIZE)
+    (server_dir / "x.bin").write_bytes(data)
+    local = client_dir / "x.bin"
+
+    process, address = start_server(server_dir, "--rate-limit", RATE)
+    try:
+        download = subprocess.Popen([sys.executable, os.path.join(ROOT, "client", "client.py"),
+                                     *map(str, address), "get", "x.bin"],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for(lambda: local.exists() and local.stat().st_size > 0)
+        time.sleep(0.5)
+        download.send_signal(signal.SIGKILL)
+        download.wait()
+        assert 0 < local.stat().st_size < SIZE
+        assert data.startswith(local.read_bytes())
+
+        with Client(*address, progress=None) as client:
+            assert client.get("x.bin", resume=True)
+    finally:
+        process.terminate()
+        process.wait()
+    assert local.read_bytes() == data
@@ -0,0 +1,58 @@
+import socket
+from protocol_utils import (REQ_TYPES, STATUS_CODES, PARTIAL_SUFFIX, send_message, get_response, allow,
+                            send_delta)
+
+def request_upload(address, filename: str, content_length: int) -> tuple[socket.socket, dict]:
+    """Start a handshake upload, stopping before any data is sent
+
+    Returns:
+        tuple[socket.socket, dict]: The connection and the server's answer to the request
+    """
+    sock = socket.create_connection(address, timeout=10)
+    send_message(sock, {
+        "type": REQ_TYPES.PUT.value,
+        "filename": filename,
+        "content_length": content_length,
+        "fast": False
+    })
+    return sock, get_response(sock)
+
+def test_overlapping_uploads_of_same_name(server, server_dir):
+    first_data = b"A" * 3_000_000
+    first, answer = request_upload(server, "same.bin", len(first_data))
+    with first:
+        assert answer["status_code"] == STATUS_CODES.ALLOW.value
+        allow(first, "Sending")
+        first.sendall(first_data[:len(first_data) // 2])
+
+        second, answer = request_upload(server, "same.bin", 3_000_000)
+        second.close()
+        assert answer["status_code"] == STATUS_CODES.DENY.value
+        assert "already being uploaded" in answer["message"]
+
+        first.sendall(first_data[len(first_data) // 2:])
+        assert get_response(first)["status_code"] == STATUS_CODES.ALLOW.value
+
+    assert (server_dir / "same.bin").read_bytes() == first_data
+    assert not (server_dir / ("same.bin" + PARTIAL_SUFFIX)).exists()
+
+def test_upload_after_rejected_overwrite_leaves_no_partial(server, server_dir):
+    (server_dir / "taken.bin").write_bytes(b"old")
+    sock, answer = request_upload(server, "taken.bin", 3)
+    sock.close()
+    assert answer["status_code"] == STATUS_CODES.DENY.value
+    assert not (server_dir / ("taken.bin" + PARTIAL_SUFFIX)).exists()
+
+def test_delta_upload_keeps_resumable_partial(server, server_dir, client_dir):
+    old = bytes(range(256)) * 4000
+    new = old[:500_000] + b"changed" + old[500_000:]
+    (server_dir / "doc.bin").write_bytes(old)
+    (server_dir / ("doc.bin" + PARTIAL_SUFFIX)).write_bytes(b"half of another upload")
+    (client_dir / "doc.bin").write_bytes(new)
+
+    with socket.create_connection(server, timeout=10) as sock:
+        assert send_delta(sock, "doc.bin")
+
+    assert (server_dir / "doc.bin").read_bytes() == new
+    assert (server_dir / ("doc.bin" + PARTIAL_SUFFIX)).read_bytes() == b"half of another upload"
+    assert sorted(path.name for path in server_dir.iterdir()) == ["doc.bin", "doc.bin" + PARTIAL_SUFFIX]